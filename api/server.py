@@ -64,6 +64,7 @@ class APIServer:
         log.debug("start", "Server booting, port %s." % port_no)
         db.connect(auto_retry=False, retry_only_this_time=True)
         cache.connect()
+        cache.enable_local_tier()
         memory_trace.setup(port_no)
 
         api.locale.load_translations()
@@ -93,7 +93,7 @@ class MainIndex(api.web.HTMLRequest):
             )
             return
 
-        if not cache.get_station(self.sid, "sched_current"):
+        if not cache.get_schedule_snapshot(self.sid).current:
             raise APIException(
                 "server_just_started",
                 "Rainwave is Rebooting, Please Try Again in a Few Minutes",
@@ -7,6 +7,8 @@ import api_requests.vote
 import api_requests.playlist
 import api_requests.tune_in
 from rainwave.events.event import BaseEvent
+from rainwave import rating
+import rainwave.live_voting
 
 from libs import cache
 from libs import config
@@ -91,7 +93,8 @@ def attach_info_to_request(
     sched_current = None
     if request.user and not request.user.is_anonymous():
         request.append("requests", request.user.get_requests(request.sid))
-        sched_current = cache.get_station(request.sid, "sched_current")
+        schedule = cache.get_schedule_snapshot(request.sid)
+        sched_current = schedule.current
         if not sched_current:
             raise APIException(
                 "server_just_started",
@@ -100,13 +103,16 @@ def attach_info_to_request(
             )
         if request.user.is_tunedin():
             sched_current.get_song().data["rating_allowed"] = True
-        sched_current = sched_current.to_dict(request.user)
-        sched_next = []
-        sched_next_objects = cast(
-            list[BaseEvent], cache.get_station(request.sid, "sched_next")
+        sched_next_objects = cast(list[BaseEvent], schedule.next)
+        sched_history_objects = cast(list[BaseEvent], schedule.history)
+        ratings = rating.BatchRatings(
+            request.user.id,
+            _event_songs([sched_current] + sched_next_objects + sched_history_objects),
         )
+        sched_current = sched_current.to_dict(request.user, ratings=ratings)
+        sched_next = []
         for evt in sched_next_objects:
-            sched_next.append(evt.to_dict(request.user))
+            sched_next.append(evt.to_dict(request.user, ratings=ratings))
         if (
             len(sched_next) > 0
             and request.user.is_tunedin()
@@ -122,10 +128,10 @@ def attach_info_to_request(
                 ):
                     sched_next[i]["voting_allowed"] = True
         sched_history = []
-        for evt in cast(
-            list[BaseEvent], cache.get_station(request.sid, "sched_history")
-        ):
-            sched_history.append(evt.to_dict(request.user, check_rating_acl=True))
+        for evt in sched_history_objects:
+            sched_history.append(
+                evt.to_dict(request.user, check_rating_acl=True, ratings=ratings)
+            )
     elif request.user:
         sched_current = cache.get_station(request.sid, "sched_current_dict")
         if not sched_current:
@@ -166,7 +172,139 @@ def attach_info_to_request(
     request.append("all_stations_info", cache.get("all_stations_info"))
 
     if live_voting:
-        request.append("live_voting", cache.get_station(request.sid, "live_voting"))
+        request.append("live_voting", rainwave.live_voting.get_snapshot(request.sid))
+        request.append("live_voting_seq", rainwave.live_voting.get_seq(request.sid))
+
+
+def _event_songs(events):
+    songs = []
+    for evt in events:
+        songs.extend(getattr(evt, "songs", None) or [])
+    return songs
+
+
+def get_sync_base(sid):
+    # The user-independent half of a sync_result.  It is identical for every session
+    # on the station, so sync builds and serializes it once per schedule advance
+    # and sends it alongside each session's attach_sync_overlay_to_request output.
+    sched_current = cache.get_station(sid, "sched_current_dict")
+    if not sched_current:
+        raise APIException(
+            "server_just_started",
+            "Rainwave is Rebooting, Please Try Again in a Few Minutes",
+            http_code=500,
+        )
+    return {
+        "album_diff": cache.get_station(sid, "album_diff"),
+        "request_line": cache.get_station(sid, "request_line"),
+        "sched_current": sched_current,
+        "sched_next": cache.get_station(sid, "sched_next_dict"),
+        "sched_history": cache.get_station(sid, "sched_history_dict"),
+        "all_stations_info": cache.get("all_stations_info"),
+        "live_voting": rainwave.live_voting.get_snapshot(sid),
+        "live_voting_seq": rainwave.live_voting.get_seq(sid),
+    }
+
+
+def _song_rating_allowed(song, user, is_current=False, acl=None):
+    # Mirrors what to_dict(user) and check_rating_acl() end up reporting,
+    # without writing into the song objects shared by every session.
+    if song.data["rating_allowed"] or user.data["rate_anything"]:
+        return True
+    if is_current:
+        return user.is_tunedin()
+    if acl is not None:
+        return song.id in acl and user.id in acl[song.id]
+    return False
+
+
+def attach_sync_overlay_to_request(request: APIHandler):
+    # Everything attach_info_to_request would have personalized inside the schedule,
+    # keyed by event/song/album ID so clients can merge it onto the get_sync_base() data.
+    request.append("user", request.user.to_private_dict())
+    if request.user.is_dj():
+        attach_dj_info_to_request(request)
+
+    voting_allowed = []
+    song_ratings = {}
+    album_ratings = {}
+    if not request.user.is_anonymous():
+        request.append("requests", request.user.get_requests(request.sid))
+        schedule = cache.get_schedule_snapshot(request.sid)
+        sched_current = cast(BaseEvent, schedule.current)
+        if not sched_current:
+            raise APIException(
+                "server_just_started",
+                "Rainwave is Rebooting, Please Try Again in a Few Minutes",
+                http_code=500,
+            )
+        sched_next = cast(list[BaseEvent], schedule.next)
+        if (
+            len(sched_next) > 0
+            and request.user.is_tunedin()
+            and sched_next[0].is_election
+            and len(sched_next[0].songs) > 1
+        ):
+            voting_allowed.append(sched_next[0].id)
+        if request.user.is_tunedin() and request.user.has_perks():
+            for evt in sched_next[1:]:
+                if evt.is_election and len(evt.songs) > 1:
+                    voting_allowed.append(evt.id)
+
+        acl = cache.get_station(request.sid, "user_rating_acl") or {}
+        sched_history = cast(list[BaseEvent], schedule.history)
+        ratings = rating.BatchRatings(
+            request.user.id, _event_songs([sched_current] + sched_next + sched_history)
+        )
+        for evt, is_current, evt_acl in (
+            [(sched_current, True, None)]
+            + [(e, False, None) for e in sched_next]
+            + [(e, False, acl) for e in sched_history]
+        ):
+            for song in getattr(evt, "songs", None) or []:
+                if song.id not in song_ratings:
+                    song_ratings[song.id] = dict(
+                        ratings.get_song_rating(song.id, request.user.id)
+                    )
+                    song_ratings[song.id]["rating_allowed"] = _song_rating_allowed(
+                        song, request.user, is_current, evt_acl
+                    )
+                if song.album and song.album.id not in album_ratings:
+                    album_ratings[song.album.id] = ratings.get_album_rating(
+                        song.album.sid, song.album.id, request.user.id
+                    )
+
+        user_vote_cache = cache.get_user(request.user, "vote_history")
+        if user_vote_cache:
+            request.append("already_voted", user_vote_cache)
+    else:
+        sched_next = cast(list[dict], cache.get_station(request.sid, "sched_next_dict"))
+        if (
+            len(sched_next) > 0
+            and request.user.is_tunedin()
+            and sched_next[0]["type"] == "Election"
+            and len(sched_next[0]["songs"]) > 1
+        ):
+            voting_allowed.append(sched_next[0]["id"])
+        if (
+            len(sched_next) > 0
+            and request.user.data.get("voted_entry")
+            and request.user.data.get("voted_entry") > 0  # type: ignore
+            and request.user.data["lock_sid"] == request.sid
+        ):
+            request.append(
+                "already_voted",
+                [(sched_next[0]["id"], request.user.data["voted_entry"])],
+            )
+
+    request.append(
+        "sync_overlay",
+        {
+            "voting_allowed": voting_allowed,
+            "song_ratings": song_ratings,
+            "album_ratings": album_ratings,
+        },
+    )
 
 
 def check_sync_status(sid, offline_ack: bool | None = False):
@@ -17,6 +17,7 @@ from libs import db
 from libs import config
 from libs.pretty_date import pretty_date
 from rainwave import playlist
+from rainwave import rating
 from rainwave.playlist_objects.metadata import MetadataNotFoundError
 from api.exceptions import APIException
 
@@ -26,8 +27,14 @@ PAGE_LIMIT = 1000
 def get_all_albums(sid, user=None):
     if not user or user.is_anonymous():
         return cache.get_station(sid, "all_albums")
-    else:
+    all_albums = cache.get_station(sid, "all_albums")
+    if not all_albums:
         return playlist.get_all_albums_list(sid, user)
+    overlay = rating.get_album_overlay(sid, user.id)
+    return [
+        dict(album, **overlay[album["id"]]) if album["id"] in overlay else album
+        for album in all_albums
+    ]
 
 
 def get_all_artists(sid):
@@ -28,7 +28,7 @@ class SubmitRatingRequest(APIHandler):
     def rate(self, song_id, rating):
         if not self.user.data["rate_anything"]:
             acl = cache.get_station(self.sid, "user_rating_acl")
-            sched_current = cache.get_station(self.sid, "sched_current")
+            sched_current = cache.get_schedule_snapshot(self.sid).current
             if not sched_current or not sched_current.get_song().id == song_id:
                 if not acl or not song_id in acl or not self.user.id in acl[song_id]:
                     raise APIException("cannot_rate_now")
@@ -3,6 +3,7 @@ from api.exceptions import APIException
 from api.urls import handle_api_html_url, handle_api_url
 from api.web import APIHandler, PrettyPrintAPIMixin
 from libs import cache, db
+import rainwave.request
 
 
 @handle_api_url("request")
@@ -18,6 +19,7 @@ class SubmitRequest(APIHandler):
         if self.user.is_anonymous():
             raise APIException("must_login_and_tune_in_to_request")
         if self.user.add_request(self.sid, self.get_argument("song_id")):
+            rainwave.request.notify_user_changed(self.user.id)
             self.append_standard("request_success")
             self.append("requests", self.user.get_requests(self.sid))
         else:
@@ -35,6 +37,7 @@ class DeleteRequest(APIHandler):
 
     def post(self):
         if self.user.remove_request(self.get_argument("song_id")):
+            rainwave.request.notify_user_changed(self.user.id)
             self.append_standard("request_deleted")
             self.append("requests", self.user.get_requests(self.sid))
         else:
@@ -58,6 +61,7 @@ class OrderRequests(APIHandler):
                 (order, self.user.id, song_id),
             )
             order = order + 1
+        rainwave.request.notify_user_changed(self.user.id)
         self.append_standard("requests_reordered")
         self.append("requests", self.user.get_requests(self.sid))
 
@@ -73,6 +77,7 @@ class RequestUnratedSongs(APIHandler):
 
     def post(self):
         if self.user.add_unrated_requests(self.sid, self.get_argument("limit")) > 0:
+            rainwave.request.notify_user_changed(self.user.id)
             self.append_standard("request_unrated_songs_success")
             self.append("requests", self.user.get_requests(self.sid))
         else:
@@ -90,6 +95,7 @@ class RequestFavoritedSongs(APIHandler):
 
     def post(self):
         if self.user.add_favorited_requests(self.sid, self.get_argument("limit")) > 0:
+            rainwave.request.notify_user_changed(self.user.id)
             self.append_standard("request_favorited_songs_success")
             self.append("requests", self.user.get_requests(self.sid))
         else:
@@ -106,6 +112,7 @@ class ClearRequests(APIHandler):
 
     def post(self):
         self.user.clear_all_requests()
+        rainwave.request.notify_user_changed(self.user.id)
         self.append("requests", self.user.get_requests(self.sid))
 
 
@@ -119,6 +126,7 @@ class ClearRequestsOnCooldown(APIHandler):
 
     def post(self):
         self.user.clear_all_requests_on_cooldown()
+        rainwave.request.notify_user_changed(self.user.id)
         self.append("requests", self.user.get_requests(self.sid))
 
 
@@ -132,6 +140,7 @@ class PauseRequestQueue(APIHandler):
 
     def post(self):
         self.user.pause_requests()
+        rainwave.request.notify_user_changed(self.user.id)
         self.append("user", self.user.to_private_dict())
         if self.user.data["requests_paused"]:
             self.append_standard("request_queue_paused")
@@ -149,6 +158,7 @@ class UnPauseRequestQueue(APIHandler):
 
     def post(self):
         self.user.unpause_requests(self.sid)
+        rainwave.request.notify_user_changed(self.user.id)
         self.append("user", self.user.to_private_dict())
         if self.user.data["requests_paused"]:
             self.append_standard("request_queue_paused")
@@ -30,6 +30,7 @@ import api.locale
 import api_requests.info
 import rainwave.playlist
 import rainwave.schedule
+import rainwave.live_voting
 
 from libs import cache
 from libs import log
@@ -37,75 +38,106 @@ from libs import config
 from libs import zeromq
 
 
+def encode_message(obj):
+    # Serialize once for every socket it goes to; WSHandler.write_message sends
+    # bytes as-is as a text frame, skipping both json.dumps and UTF-8 encoding.
+    message = json.dumps(obj)
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    return message
+
+
 class SessionBank:
     def __init__(self):
         super(SessionBank, self).__init__()
-        self.sessions = []
-        self.websockets = []
+        self.sessions = set()
+        self.websockets = set()
         self.throttled = {}
         self.websockets_by_user = {}
+        # user_id/remote_ip/listen_key -> set of sessions, so the update_user/update_ip/
+        # update_listen_key ZeroMQ messages only touch the sessions they're about.
+        self.by_user = {}
+        self.by_ip = {}
+        self.by_listen_key = {}
+        # session -> the (user_id, remote_ip, listen_key) it was indexed under
+        self.index_keys = {}
 
     def __iter__(self):
-        for item in self.sessions:
+        for item in list(self.sessions):
             yield item
 
+    def _index(self, session):
+        keys = (
+            session.user.id,
+            session.request.remote_ip,
+            session.user.data.get("listen_key"),
+        )
+        self.index_keys[session] = keys
+        for index, key in zip((self.by_user, self.by_ip, self.by_listen_key), keys):
+            if key is not None:
+                index.setdefault(key, set()).add(session)
+
+    def _unindex(self, session):
+        keys = self.index_keys.pop(session, None)
+        if not keys:
+            return
+        for index, key in zip((self.by_user, self.by_ip, self.by_listen_key), keys):
+            if key in index:
+                index[key].discard(session)
+                if not index[key]:
+                    del index[key]
+
+    def reindex(self, session):
+        # listen keys can change when a user's data is refreshed
+        if session in self.index_keys:
+            self._unindex(session)
+            self._index(session)
+
     def append(self, session):
         if session.is_websocket:
-            if not session in self.websockets:
-                self.websockets.append(session)
+            self.websockets.add(session)
             if not session.user.is_anonymous():
-                if not session.user.id in self.websockets_by_user:
-                    self.websockets_by_user[session.user.id] = []
-                self.websockets_by_user[session.user.id].append(session)
-        elif not session in self.sessions:
-            self.sessions.append(session)
+                self.websockets_by_user.setdefault(session.user.id, set()).add(session)
+        else:
+            self.sessions.add(session)
+        self._unindex(session)
+        self._index(session)
 
     def remove(self, session):
         if session in self.throttled:
             tornado.ioloop.IOLoop.instance().remove_timeout(self.throttled[session])
             del self.throttled[session]
         if session in self.websockets:
-            self.websockets.remove(session)
-            if (
-                not session.user.is_anonymous()
-                and session.user.id in self.websockets_by_user
-                and session in self.websockets_by_user
-            ):
-                self.websockets_by_user[session.user.id].remove(session)
+            self.websockets.discard(session)
+            if session.user.id in self.websockets_by_user:
+                self.websockets_by_user[session.user.id].discard(session)
                 if not self.websockets_by_user[session.user.id]:
                     del self.websockets_by_user[session.user.id]
-        elif session in self.sessions:
-            self.sessions.remove(session)
+        else:
+            self.sessions.discard(session)
+        self._unindex(session)
 
     def clear(self):
         for timer in self.throttled.values():
             tornado.ioloop.IOLoop.instance().remove_timeout(timer)
-        self.sessions[:] = []
+        for session in self.sessions:
+            self._unindex(session)
+        self.sessions.clear()
         self.throttled.clear()
 
     def find_user(self, user_id):
-        toret = []
-        for session in self.sessions + self.websockets:
-            if session.user.id == user_id:
-                toret.append(session)
-        return toret
+        return list(self.by_user.get(user_id, ()))
 
     def find_ip(self, ip_address):
-        toret = []
-        for session in self.sessions + self.websockets:
-            if session.request.remote_ip == ip_address:
-                toret.append(session)
-        return toret
+        return list(self.by_ip.get(ip_address, ()))
 
     def find_listen_key(self, listen_key):
-        toret = []
-        for session in self.sessions + self.websockets:
-            if session.user.data.get("listen_key") == listen_key:
-                toret.append(session)
-        return toret
+        if listen_key is None:
+            return []
+        return list(self.by_listen_key.get(listen_key, ()))
 
     def keep_alive(self):
-        for session in self.sessions + self.websockets:
+        for session in list(self.sessions) + list(self.websockets):
             try:
                 session.keep_alive()
             except Exception as e:
@@ -115,9 +147,24 @@ class SessionBank:
     def update_all(self, sid):
         session_count = 0
         session_failed_count = 0
-        for session in self.sessions + self.websockets:
+        # Websockets that asked for sync_overlay all share one pre-serialized copy of the
+        # schedule.  If it can't be built they fall through to a regular update(), which
+        # reports the error to the client the same way it always has.
+        base_frame = None
+        if any(session.sync_overlay for session in self.websockets):
+            try:
+                if cache.get_station(sid, "backend_ok"):
+                    base_frame = encode_message(
+                        {"sync_base": api_requests.info.get_sync_base(sid)}
+                    )
+            except Exception as e:
+                log.exception("sync_update_all", "Failed to build sync_base.", e)
+        for session in list(self.sessions) + list(self.websockets):
             try:
-                session.update()
+                if base_frame and session.is_websocket and session.sync_overlay:
+                    session.update_overlay(base_frame)
+                else:
+                    session.update()
                 session_count += 1
             except Exception as e:
                 try:
@@ -135,7 +182,7 @@ class SessionBank:
         self.clear()
 
     def update_dj(self):
-        for session in self.websockets:
+        for session in list(self.websockets):
             if session.user.is_dj():
                 try:
                     session.update_dj_only()
@@ -191,14 +238,33 @@ class SessionBank:
             return
         if "message_id" in data:
             del data["message_id"]
-        for session in self.websockets_by_user[user_id]:
+        message = encode_message(data)
+        for session in list(self.websockets_by_user[user_id]):
             if not session.uuid == uuid_exclusion:
-                session.write_message(data)
+                session.write_message(message)
 
     def send_to_all(self, uuid_exclusion, data):
-        for session in self.websockets:
+        message = encode_message(data)
+        for session in list(self.websockets):
             if not uuid_exclusion == session.uuid:
-                session.write_message(data)
+                session.write_message(message)
+
+    def send_live_voting(self, sid, delta):
+        # Websockets that opted into deltas get just the changed entries, everyone
+        # else the full tallies - both built from memory and encoded once.
+        delta_message = None
+        full_message = None
+        for session in list(self.websockets):
+            if session.live_voting_delta:
+                if not delta_message:
+                    delta_message = encode_message({"live_voting_delta": delta})
+                session.write_message(delta_message)
+            else:
+                if not full_message:
+                    full_message = encode_message(
+                        {"live_voting": rainwave.live_voting.get_snapshot(sid)}
+                    )
+                session.write_message(full_message)
 
     def _throttle_session(self, session, updated_by_ip=False):
         if not session in self.throttled:
@@ -223,7 +289,6 @@ class SessionBank:
 
 
 sessions = {}
-delayed_live_vote = {}
 delayed_live_vote_timers = {}
 websocket_allow_from = "*"
 votes_by = {}
@@ -237,7 +302,6 @@ def init():
 
     for sid in config.station_ids:
         sessions[sid] = SessionBank()
-        delayed_live_vote[sid] = None
         delayed_live_vote_timers[sid] = None
     websocket_allow_from = config.get("websocket_allow_from")
     tornado.ioloop.PeriodicCallback(_keep_all_alive, 30000).start()
@@ -250,39 +314,48 @@ def _keep_all_alive():
         sessions[sid].keep_alive()
 
 
-def _on_zmq(messages):
+def _on_zmq(frames):
     global votes_by
     global last_vote_by
 
-    for message in messages:
-        try:
-            message = json.loads(message)
-        except Exception as e:
-            log.exception("zeromq", "Error decoding ZeroMQ message.", e)
-            return
+    try:
+        messages = zeromq.decode(frames)
+    except Exception as e:
+        log.exception("zeromq", "Error decoding ZeroMQ message.", e)
+        return
 
+    for message in messages:
         if not "action" in message or not message["action"]:
             log.critical("zeromq", "No action received from ZeroMQ.")
+            continue
 
         try:
             if message["action"] == "result_sync":
                 sessions[message["sid"]].send_to_user(
                     message["user_id"], message["uuid_exclusion"], message["data"]
                 )
-            elif message["action"] == "live_voting":
-                sessions[message["sid"]].send_to_all(
-                    message["uuid_exclusion"], message["data"]
+            elif message["action"] == "live_voting_delta":
+                rainwave.live_voting.apply(
+                    message["sid"], message["changes"], message.get("increments")
                 )
-                delay_live_vote_removal(message["sid"])
-            elif message["action"] == "delayed_live_voting":
-                if not delayed_live_vote_timers[message["sid"]]:
-                    delay_live_vote(message)
-                delayed_live_vote[message["sid"]] = message
+                if not message.get("delayed"):
+                    send_live_voting(message["sid"])
+                elif not delayed_live_vote_timers[message["sid"]]:
+                    delay_live_vote(message["sid"])
             elif message["action"] == "update_all":
                 delay_live_vote_removal(message["sid"])
+                cache.invalidate_local_station(message["sid"])
+                log.debug(
+                    "cache",
+                    "Local tier stats: %s" % (cache.get_local_tier_stats(),),
+                )
                 rainwave.playlist.update_num_songs()
                 rainwave.playlist.prepare_cooldown_algorithm(message["sid"])
-                cache.update_local_cache_for_sid(message["sid"])
+                rainwave.playlist.refresh_art_index()
+                cache.update_local_cache_for_sid(
+                    message["sid"], message.get("sched_version")
+                )
+                rainwave.live_voting.load(message["sid"], message.get("sched_version"))
                 sessions[message["sid"]].update_all(message["sid"])
                 votes_by = {}
                 last_vote_by = {}
@@ -293,9 +366,11 @@ def _on_zmq(messages):
                 for sid in sessions:
                     sessions[sid].update_listen_key(message["listen_key"])
             elif message["action"] == "update_user":
+                cache.invalidate_local_user(message["user_id"])
                 for sid in sessions:
                     sessions[sid].update_user(message["user_id"])
             elif message["action"] == "update_dj":
+                cache.invalidate_local_station(message["sid"])
                 sessions[message["sid"]].update_dj()
             elif message["action"] == "ping":
                 log.debug("zeromq", "Pong")
@@ -308,31 +383,33 @@ def _on_zmq(messages):
             log.exception(
                 "zeromq", "Error handling Zero MQ action '%s'" % message["action"], e
             )
-            return
+            continue
 
 
 def delay_live_vote_removal(sid):
     if delayed_live_vote_timers[sid]:
         tornado.ioloop.IOLoop.instance().remove_timeout(delayed_live_vote_timers[sid])
-        delayed_live_vote[sid] = None
         delayed_live_vote_timers[sid] = None
 
 
-def delay_live_vote(message):
-    delayed_live_vote_timers[
-        message["sid"]
-    ] = tornado.ioloop.IOLoop.instance().add_timeout(
+def delay_live_vote(sid):
+    delayed_live_vote_timers[sid] = tornado.ioloop.IOLoop.instance().add_timeout(
         datetime.timedelta(seconds=vote_once_every_seconds),
-        lambda: process_delayed_live_vote(message["sid"]),
+        lambda: process_delayed_live_vote(sid),
     )
 
 
 def process_delayed_live_vote(sid):
     delayed_live_vote_timers[sid] = None
-    if not delayed_live_vote[sid]:
-        return
-    sessions[sid].send_to_all(None, delayed_live_vote[sid]["data"])
-    delayed_live_vote[sid] = None
+    send_live_voting(sid)
+
+
+def send_live_voting(sid):
+    # whatever a delayed broadcast was holding back goes out with this one
+    delay_live_vote_removal(sid)
+    delta = rainwave.live_voting.take_delta(sid)
+    if delta:
+        sessions[sid].send_live_voting(sid, delta)
 
 
 @handle_api_url("sync")
@@ -516,6 +593,8 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         self.user = User(1)
         self.sid = config.get("default_station")
         self.uuid = str(uuid.uuid4())
+        self.sync_overlay = False
+        self.live_voting_delta = False
 
     def check_origin(self, origin):
         if websocket_allow_from == "*":
@@ -574,7 +653,12 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         super(WSHandler, self).on_close()
 
     def write_message(self, obj, *args, **kwargs):
-        message = json.dumps(obj)
+        # Already-encoded frames (see encode_message) are passed straight through
+        # so fan-out paths only pay for serialization once.
+        if isinstance(obj, (str, bytes)):
+            message = obj
+        else:
+            message = json.dumps(obj)
         try:
             super(WSHandler, self).write_message(message, *args, **kwargs)
         except tornado.websocket.WebSocketClosedError:
@@ -588,6 +672,8 @@ class WSHandler(tornado.websocket.WebSocketHandler):
 
     def refresh_user(self):
         self.user.refresh(self.sid)
+        if self.sid in sessions:
+            sessions[self.sid].reindex(self)
 
     def process_throttle(self):
         if not self.throttled_msgs:
@@ -758,6 +844,15 @@ class WSHandler(tornado.websocket.WebSocketHandler):
             self._do_sched_check(message)
             return
 
+        if message["action"] == "live_voting_snapshot":
+            self.write_message(
+                {
+                    "live_voting": rainwave.live_voting.get_snapshot(self.sid),
+                    "live_voting_seq": rainwave.live_voting.get_seq(self.sid),
+                }
+            )
+            return
+
         message["action"] = "/api4/%s" % message["action"]
         if not message["action"] in api_endpoints:
             self.write_message(
@@ -820,32 +915,13 @@ class WSHandler(tornado.websocket.WebSocketHandler):
                             "uuid_exclusion": self.uuid,
                         }
                     )
-            if (
-                message["action"] == "/api4/vote"
-                and endpoint.return_name in endpoint._output
-                and isinstance(endpoint._output[endpoint.return_name], dict)
-                and endpoint._output[endpoint.return_name]["success"]
-            ):
-                live_voting = rainwave.schedule.update_live_voting(self.sid)
-                endpoint.append("live_voting", live_voting)
-                if self.should_vote_throttle():
-                    zeromq.publish(
-                        {
-                            "action": "delayed_live_voting",
-                            "sid": self.sid,
-                            "uuid_exclusion": self.uuid,
-                            "data": {"live_voting": live_voting},
-                        }
-                    )
-                else:
-                    zeromq.publish(
-                        {
-                            "action": "live_voting",
-                            "sid": self.sid,
-                            "uuid_exclusion": self.uuid,
-                            "data": {"live_voting": live_voting},
-                        }
-                    )
+            if message["action"] == "/api4/vote" and endpoint.live_voting_changes:
+                rainwave.live_voting.publish(
+                    self.sid,
+                    endpoint.live_voting_changes,
+                    delayed=self.should_vote_throttle(),
+                    increments=True,
+                )
         except APIException as e:
             endpoint.write_error(e.code, exc_info=sys.exc_info(), no_finish=True)
             if e.code != 200:
@@ -890,6 +966,35 @@ class WSHandler(tornado.websocket.WebSocketHandler):
             if handler:
                 self.write_message(handler._output)
 
+    def update_overlay(self, base_frame):
+        handler = APIHandler(websocket=True)
+        handler.locale = self.locale
+        handler.request = typing.cast(
+            tornado.httputil.HTTPServerRequest,
+            FakeRequestObject({}, self.request.cookies),
+        )
+        handler.sid = self.sid
+        handler.user = self.user
+        handler.return_name = "sync_result"
+        try:
+            startclock = timestamp()
+            handler.prepare_standalone()
+
+            self.refresh_user()
+            api_requests.info.attach_sync_overlay_to_request(handler)
+            handler.append(
+                "api_info",
+                {"exectime": timestamp() - startclock, "time": round(timestamp(), 0)},
+            )
+            self.write_message(base_frame)
+        except Exception as e:
+            if handler:
+                handler.write_error(500, exc_info=sys.exc_info(), no_finish=True)
+            log.exception("websocket", "Exception during overlay update.", e)
+        finally:
+            if handler:
+                self.write_message(handler._output)
+
     def update_user(self):
         self.write_message({"user": self.user.to_private_dict()})
 
@@ -955,6 +1060,11 @@ class WSHandler(tornado.websocket.WebSocketHandler):
                 return
             self.authorized = True
             self.uuid = str(uuid.uuid4())
+            # Opt-in: receive schedule updates as a shared sync_base plus a per-user sync_overlay
+            self.sync_overlay = bool(message.get("sync_overlay"))
+            # Opt-in: receive live voting as sequenced live_voting_delta changes,
+            # sending "live_voting_snapshot" to resync after a gap in the sequence
+            self.live_voting_delta = bool(message.get("live_voting_delta"))
 
             global sessions
             sessions[self.sid].append(self)
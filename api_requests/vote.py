@@ -5,7 +5,8 @@ from api import fieldtypes
 from api.web import APIHandler
 from api.exceptions import APIException
 from api.urls import handle_api_url
-import rainwave.schedule
+from rainwave import live_voting
+from rainwave import vote_tally
 from rainwave.events.event import BaseEvent
 from rainwave.events.election import Election
 
@@ -13,7 +14,12 @@ from libs import cache
 from libs import config
 from libs import log
 from libs import db
-from libs import zeromq
+
+# With the tally service on, the backend closes an election by setting elec_used
+# before it recounts and prepares it (vote_tally.close_election).  Every statement
+# recording a vote carries this condition, and the row lock makes it wait for or
+# see that close, so a vote either lands before the recount or is rejected.
+_ELECTION_OPEN_SQL = "EXISTS (SELECT 1 FROM r4_elections WHERE elec_id = %s AND elec_used = FALSE FOR SHARE)"
 
 
 def append_success_to_request(request, elec_id, entry_id):
@@ -29,13 +35,15 @@ class SubmitVote(APIHandler):
     description = "Vote for a candidate in an election.  Cannot cancel/delete a vote.  If user has already voted, the vote will be changed to the submitted song."
     fields = {"entry_id": (fieldtypes.integer, True)}
     sync_across_sessions = True
+    # [elec_id, entry_id, +1/-1, txid] for every entry this vote changed
+    live_voting_changes = None
 
     def post(self):
         lock_count = 0
         voted = False
         elec_id = None
         for event in typing.cast(
-            list[BaseEvent], cache.get_station(self.sid, "sched_next")
+            list[BaseEvent], cache.get_schedule_snapshot(self.sid).next
         ):
             lock_count += 1
             if (
@@ -44,6 +52,10 @@ class SubmitVote(APIHandler):
                     self.get_argument("entry_id")
                 )
                 and len(event.songs) > 1
+                # the backend has stopped counting votes for it
+                and not (
+                    vote_tally.enabled() and vote_tally.is_closed(self.sid, event.id)
+                )
             ):
                 elec_id = event.id
                 voted = self.vote(self.get_argument("entry_id"), event, lock_count)
@@ -63,17 +75,18 @@ class SubmitVote(APIHandler):
     # this will never get executed for WebSocket connections, so this code
     # is duplicated in sync.py
     def on_finish(self):
-        live_voting = rainwave.schedule.update_live_voting(self.sid)
-        zeromq.publish(
-            {
-                "action": "live_voting",
-                "sid": self.sid,
-                "uuid_exclusion": None,
-                "data": {"live_voting": live_voting},
-            }
-        )
+        # with the tally service on, the backend broadcasts live voting itself
+        if self.live_voting_changes:
+            live_voting.publish(self.sid, self.live_voting_changes, increments=True)
         super(SubmitVote, self).on_finish()
 
+    def _election_closed(self, event):
+        return bool(
+            db.c.fetch_var(
+                "SELECT elec_used FROM r4_elections WHERE elec_id = %s", (event.id,)
+            )
+        )
+
     def vote(self, entry_id, event, lock_count):
         # Subtract a previous vote from the song's total if there was one
         already_voted = False
@@ -99,16 +112,26 @@ class SubmitVote(APIHandler):
             elif previous_vote:
                 already_voted = previous_vote["entry_id"]
 
+        tally = vote_tally.enabled()
+        open_sql = ""
+        open_params = ()
+        if tally:
+            open_sql = " AND " + _ELECTION_OPEN_SQL
+            open_params = (event.id,)
+        autovoted_entry = None
+        changes = []
         db.c.start_transaction()
         try:
-            if already_voted:
-                if not event.add_vote_to_entry(already_voted, -1):
+            if already_voted and not tally:
+                votes = event.add_vote_to_entry(already_voted, -1)
+                if votes is None:
                     log.warn(
                         "vote",
                         "Could not subtract vote from entry: listener ID %s voting for entry ID %s."
                         % (self.user.data["listener_id"], already_voted),
                     )
                     raise APIException("internal_error")
+                changes.append([event.id, already_voted, -1, votes["txid"]])
 
             # If this is a new vote, we need to check to make sure the listener is not locked.
             if (
@@ -139,9 +162,13 @@ class SubmitVote(APIHandler):
 
             if self.user.is_anonymous():
                 if not db.c.update(
-                    "UPDATE r4_listeners SET listener_voted_entry = %s WHERE listener_id = %s",
-                    (entry_id, self.user.data["listener_id"]),
+                    "UPDATE r4_listeners SET listener_voted_entry = %s WHERE listener_id = %s"
+                    + open_sql,
+                    (entry_id, self.user.data["listener_id"]) + open_params,
                 ):
+                    if tally and self._election_closed(event):
+                        db.c.rollback()
+                        return False
                     log.warn(
                         "vote",
                         "Could not set voted_entry: listener ID %s voting for entry ID %s."
@@ -151,35 +178,53 @@ class SubmitVote(APIHandler):
                 self.user.update({"voted_entry": entry_id})
             else:
                 if already_voted:
-                    db.c.update(
-                        "UPDATE r4_vote_history SET song_id = %s, entry_id = %s WHERE user_id = %s and entry_id = %s",
+                    recorded = db.c.update(
+                        "UPDATE r4_vote_history SET song_id = %s, entry_id = %s WHERE user_id = %s and entry_id = %s"
+                        + open_sql,
                         (
                             event.get_entry(entry_id).id,
                             entry_id,
                             self.user.id,
                             already_voted,
-                        ),
+                        )
+                        + open_params,
                     )
                 else:
-                    db.c.update(
+                    recorded = db.c.update(
                         "INSERT INTO r4_vote_history (elec_id, entry_id, user_id, song_id, sid) "
-                        "VALUES (%s, %s, %s, %s, %s)",
+                        "SELECT %s, %s, %s, %s, %s WHERE TRUE" + open_sql,
                         (
                             event.id,
                             entry_id,
                             self.user.id,
                             event.get_entry(entry_id).id,
                             event.sid,
-                        ),
+                        )
+                        + open_params,
                     )
+                if not recorded and tally and self._election_closed(event):
+                    db.c.rollback()
+                    return False
+                if not already_voted:
                     db.c.update(
                         "UPDATE phpbb_users SET radio_inactive = FALSE, radio_last_active = %s WHERE user_id = %s",
                         (timestamp(), self.user.id),
                     )
 
                     autovoted_entry = event.has_request_by_user(self.user.id)
-                    if autovoted_entry:
-                        event.add_vote_to_entry(autovoted_entry.data["entry_id"], -1)
+                    if autovoted_entry and not tally:
+                        votes = event.add_vote_to_entry(
+                            autovoted_entry.data["entry_id"], -1
+                        )
+                        if votes is not None:
+                            changes.append(
+                                [
+                                    event.id,
+                                    autovoted_entry.data["entry_id"],
+                                    -1,
+                                    votes["txid"],
+                                ]
+                            )
 
                 user_vote_cache = cache.get_user(self.user, "vote_history")
                 if not user_vote_cache:
@@ -196,16 +241,36 @@ class SubmitVote(APIHandler):
                 cache.set_user(self.user, "vote_history", user_vote_cache)
 
             # Register vote
-            if not event.add_vote_to_entry(entry_id):
-                log.warn(
-                    "vote",
-                    "Could not add vote to entry: listener ID %s voting for entry ID %s."
-                    % (self.user.data["listener_id"], entry_id),
-                )
-                raise APIException("internal_error")
+            if not tally:
+                votes = event.add_vote_to_entry(entry_id)
+                if votes is None:
+                    log.warn(
+                        "vote",
+                        "Could not add vote to entry: listener ID %s voting for entry ID %s."
+                        % (self.user.data["listener_id"], entry_id),
+                    )
+                    raise APIException("internal_error")
+                changes.append([event.id, entry_id, 1, votes["txid"]])
             db.c.commit()
         except:
             db.c.rollback()
             raise
+        self.live_voting_changes = changes
+
+        if tally:
+            if self.user.is_anonymous():
+                voter = "l%s" % self.user.data["listener_id"]
+            else:
+                voter = "u%s" % self.user.id
+            vote_tally.submit_vote(
+                self.sid,
+                event.id,
+                entry_id,
+                voter,
+                previous_entry_id=already_voted or None,
+                autovote_entry_id=(
+                    autovoted_entry.data["entry_id"] if autovoted_entry else None
+                ),
+            )
 
         return True
@@ -3,6 +3,9 @@ import os.path
 from time import time as timestamp
 import mimetypes
 import sys
+import concurrent.futures
+import hashlib
+import json
 import psutil
 import traceback
 from PIL import Image
@@ -13,14 +16,35 @@ from libs import config
 from libs import log
 from libs import cache
 from libs import db
+from libs import replaygain
 
 from rainwave import playlist
 from rainwave.playlist_objects.song import PassableScanError
 
 mimetypes.init()
 
-_found_album_art = []
+# directory -> [(filename, sids)] of art found there during the scan
+_found_album_art = {}
+# art files that were matched to at least one album
+_matched_album_art = set()
+# directory -> sorted album IDs its art has been matched against
+_directory_album_ids = {}
 _on_screen = False
+# song IDs found unchanged on disk during a scan, marked scanned in one UPDATE
+_unchanged_song_ids = []
+
+
+ALBUM_ART_SIZES = (120, 240, 320)
+ALBUM_ART_MANIFEST = "album_art_manifest.json"
+_album_art_manifest = None
+_album_art_manifest_changed = False
+# filename -> ((size, mtime), sha1) of art already hashed by this process
+_album_art_hashes = {}
+_album_art_pool = None
+# future -> (filename, output prefixes, source hash)
+_album_art_pending = {}
+# output prefix -> future that is going to write it
+_album_art_outputs = {}
 
 
 class AlbumArtNoAlbumFoundError(PassableScanError):
@@ -31,9 +55,11 @@ def write_unmatched_art_log():
     with open(
         os.path.join(config.get_directory("log_dir"), "rw_unmatched_art.log"), "w"
     ) as unmatched_log:
-        for album_art_tuple in _found_album_art:
-            unmatched_log.write(album_art_tuple[0])
-            unmatched_log.write("\n")
+        for art in _found_album_art.values():
+            for filename, _sids in art:
+                if not filename in _matched_album_art:
+                    unmatched_log.write(filename)
+                    unmatched_log.write("\n")
 
 
 def set_on_screen(on_screen):
@@ -55,7 +81,7 @@ def _common_init():
         pass
 
 
-def full_music_scan(full_reset):
+def full_music_scan(full_reset, workers=1):
     _common_init()
     db.connect()
     cache.connect()
@@ -65,8 +91,17 @@ def full_music_scan(full_reset):
         if full_reset:
             db.c.update("UPDATE r4_songs SET song_file_mtime = 0")
         db.c.update("UPDATE r4_songs SET song_scanned = FALSE")
+        known_files = _load_known_files()
+        replaygain.start_pool(workers)
+        start_album_art_pool(workers)
 
-        _scan_all_directories()
+        if workers > 1:
+            _scan_all_directories_parallel(workers, known_files)
+        else:
+            _scan_all_directories(known_files=known_files)
+        _print_to_screen_inline("Waiting for replay gain analysis...")
+        _backfill_replay_gain(wait=True)
+        _print_to_screen_inline("\n")
 
         # This procedure is slow but steady and easy to use.
         dead_songs = db.c.fetch_list(
@@ -84,13 +119,20 @@ def full_music_scan(full_reset):
     except:
         db.c.rollback()
         raise
+    finally:
+        replaygain.stop_pool()
+        stop_album_art_pool()
 
 
-def full_art_update():
+def full_art_update(workers=1):
     _common_init()
-    _scan_all_directories(art_only=True)
-    _process_found_album_art()
-    write_unmatched_art_log()
+    start_album_art_pool(workers)
+    try:
+        _scan_all_directories(art_only=True)
+        _process_found_album_art()
+        write_unmatched_art_log()
+    finally:
+        stop_album_art_pool()
     print()
 
 
@@ -101,7 +143,59 @@ def _print_to_screen_inline(txt):
         sys.stdout.flush()
 
 
-def _scan_all_directories(art_only=False):
+def _load_known_files(directory=None):
+    # filename -> song row, so scans can compare mtimes without a query per file
+    del _unchanged_song_ids[:]
+    if directory:
+        rows = db.c.fetch_all(
+            "SELECT song_id, song_filename, song_file_mtime, song_replay_gain FROM r4_songs WHERE song_filename LIKE %s || '%%' AND song_verified = TRUE",
+            (directory,),
+        )
+    else:
+        rows = db.c.fetch_all(
+            "SELECT song_id, song_filename, song_file_mtime, song_replay_gain FROM r4_songs WHERE song_verified = TRUE"
+        )
+    return {row["song_filename"]: row for row in rows}
+
+
+def _backfill_replay_gain(wait=False):
+    for filename, e in replaygain.backfill(wait):
+        _add_scan_error(filename, e)
+        _disable_file(filename)
+
+
+def _mark_unchanged_scanned():
+    if _unchanged_song_ids:
+        db.c.update(
+            "UPDATE r4_songs SET song_scanned = TRUE WHERE song_id IN %s",
+            (tuple(_unchanged_song_ids),),
+        )
+        del _unchanged_song_ids[:]
+
+
+def _walk_files(directory):
+    # os.walk(followlinks=True) order, but yields (filename, mtime) using the
+    # stat results of os.scandir's entries.  mtime is None if stat failed.
+    try:
+        entries = list(os.scandir(directory))
+    except OSError as e:
+        log.debug("scan", "Could not list %s: %s" % (directory, e))
+        return
+    subdirs = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+                continue
+            mtime = int(entry.stat().st_mtime)
+        except OSError:
+            mtime = None
+        yield entry.path, mtime
+    for subdir in subdirs:
+        yield from _walk_files(subdir)
+
+
+def _scan_all_directories(art_only=False, known_files=None):
     total_files = 0
     file_counter = 0
     for directory, sids in config.get("song_dirs").items():
@@ -110,32 +204,145 @@ def _scan_all_directories(art_only=False):
             _print_to_screen_inline(f"Prepping {total_files}")
 
     for directory, sids in config.get("song_dirs").items():
-        for root, _subdirs, files in os.walk(directory, followlinks=True):
-            for filename in files:
-                filename = os.path.join(root, filename)
-                if art_only and not _is_image(filename):
-                    pass
-                else:
-                    _scan_file(filename, sids)
-                file_counter += 1
-                _print_to_screen_inline(
-                    "%s %s / %s" % (directory, file_counter, total_files)
-                )
+        for filename, mtime in _walk_files(directory):
+            if art_only and not _is_image(filename):
+                pass
+            else:
+                _scan_file(filename, sids, mtime, known_files)
+            file_counter += 1
+            if file_counter % 50 == 0:
+                _backfill_replay_gain()
+            _print_to_screen_inline(
+                "%s %s / %s" % (directory, file_counter, total_files)
+            )
+        _mark_unchanged_scanned()
         _print_to_screen_inline("\n")
 
 
+# How many files can be waiting on or sitting in the worker pool per worker
+PARALLEL_QUEUE_PER_WORKER = 4
+# How many songs the writer saves per transaction
+PARALLEL_COMMIT_EVERY = 200
+
+
+def _read_song_file(filename, with_audio_hash):
+    # Runs in the worker processes, which must never touch the database
+    return playlist.Song.read_file_tags(filename, with_audio_hash)
+
+
+def _scan_all_directories_parallel(workers, known_files):
+    # Workers read tags and compute replay gain, the most expensive parts of a scan.
+    # This process walks the directories, decides what needs scanning, and is the
+    # only one to write to the database, committing every PARALLEL_COMMIT_EVERY songs.
+    max_in_flight = workers * PARALLEL_QUEUE_PER_WORKER
+    in_flight = {}
+    counts = {"files": 0, "read": 0, "saved": 0}
+    start_time = timestamp()
+
+    def report():
+        elapsed = max(timestamp() - start_time, 0.001)
+        _print_to_screen_inline(
+            "%s files, %s read, %s saved, %.1f files/s"
+            % (
+                counts["files"],
+                counts["read"],
+                counts["saved"],
+                counts["files"] / elapsed,
+            )
+        )
+
+    def write_done(wait_for):
+        done, _not_done = concurrent.futures.wait(in_flight, return_when=wait_for)
+        for future in done:
+            filename, sids = in_flight.pop(future)
+            counts["read"] += 1
+            try:
+                _save_song(filename, sids, future.result())
+                _process_found_album_art(os.path.dirname(filename))
+            except (IOError, OSError) as e:
+                _add_scan_error(filename, e)
+                _disable_file(filename)
+            except Exception as e:
+                _add_scan_error(filename, e, sys.exc_info())
+                _disable_file(filename)
+            counts["saved"] += 1
+            if counts["saved"] % PARALLEL_COMMIT_EVERY == 0:
+                _backfill_replay_gain()
+                db.c.commit()
+                db.c.start_transaction()
+        report()
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_common_init
+    ) as pool:
+        for directory, sids in config.get("song_dirs").items():
+            for filename, mtime in _walk_files(directory):
+                counts["files"] += 1
+                if not _is_mp3(filename):
+                    _scan_file(filename, sids)
+                    continue
+                try:
+                    needs_scan, needs_audio_hash = _needs_scan(
+                        filename, mtime, known_files
+                    )
+                except (IOError, OSError) as e:
+                    _add_scan_error(filename, e)
+                    _disable_file(filename)
+                    continue
+                if not needs_scan:
+                    continue
+                # backpressure: don't walk further ahead of the workers than this
+                while len(in_flight) >= max_in_flight:
+                    write_done(concurrent.futures.FIRST_COMPLETED)
+                future = pool.submit(_read_song_file, filename, needs_audio_hash)
+                in_flight[future] = (filename, sids)
+                report()
+            _mark_unchanged_scanned()
+        while in_flight:
+            write_done(concurrent.futures.FIRST_COMPLETED)
+    _print_to_screen_inline("\n")
+
+    elapsed = max(timestamp() - start_time, 0.001)
+    log.info(
+        "scan",
+        "Parallel scan with %s workers: %s files, %s songs read in %.1fs (%.1f files/s)"
+        % (
+            workers,
+            counts["files"],
+            counts["read"],
+            elapsed,
+            counts["files"] / elapsed,
+        ),
+    )
+
+
+def _needs_scan(filename, mtime, known_files):
+    # Returns whether the file has to be read, and whether it needs its audio hashed
+    # for a replay gain lookup if it does.  Files that don't need reading are queued
+    # to be marked as scanned.  Songs still pending a replay gain are read again.
+    if mtime is None:
+        mtime = os.stat(filename)[8]
+    known = known_files.get(filename)
+    if (
+        known
+        and known["song_file_mtime"]
+        and known["song_file_mtime"] == mtime
+        and known["song_replay_gain"] is not None
+    ):
+        log.debug("scan", "mtime match, no action taken.")
+        _unchanged_song_ids.append(known["song_id"])
+        return False, False
+    return True, not known or known["song_replay_gain"] is None
+
+
 def _scan_directory(directory, sids):
     # Normalize and add a trailing separator to the directory name
     directory = os.path.join(os.path.normpath(directory), "")
 
-    songs = db.c.fetch_list(
-        "SELECT song_id FROM r4_songs WHERE song_filename LIKE %s || '%%' AND song_verified = TRUE",
+    db.c.update(
+        "UPDATE r4_songs SET song_scanned = FALSE WHERE song_filename LIKE %s || '%%' AND song_verified = TRUE",
         (directory,),
     )
-    for song_id in songs:
-        db.c.update(
-            "UPDATE r4_songs SET song_scanned = FALSE WHERE song_id = %s", (song_id,)
-        )
 
     do_scan = False
     try:
@@ -145,10 +352,10 @@ def _scan_directory(directory, sids):
         log.debug("scan", "Directory %s no longer exists." % directory)
 
     if do_scan and len(sids) > 0:
-        for root, _subdirs, files in os.walk(directory, followlinks=True):
-            for filename in files:
-                filename = os.path.join(root, filename)
-                _scan_file(filename, sids)
+        known_files = _load_known_files(directory)
+        for filename, mtime in _walk_files(directory):
+            _scan_file(filename, sids, mtime, known_files)
+        _mark_unchanged_scanned()
 
     songs = db.c.fetch_list(
         "SELECT song_id FROM r4_songs WHERE song_filename LIKE %s || '%%' AND song_scanned = FALSE AND song_verified = TRUE",
@@ -160,42 +367,48 @@ def _scan_directory(directory, sids):
         s.disable()
 
 
-def _scan_file(filename, sids):
+def _scan_file(filename, sids, mtime=None, known_files=None, process_art=True):
+    # known_files comes from _load_known_files; when given, unchanged songs are only
+    # queued for _mark_unchanged_scanned instead of being queried and updated one by one
     s = None
     if _is_mp3(filename):
-        new_mtime = None
+        new_mtime = mtime
         try:
-            new_mtime = os.stat(filename)[8]
+            if new_mtime is None:
+                new_mtime = os.stat(filename)[8]
         except IOError as e:
             _add_scan_error(filename, e)
             _disable_file(filename)
         try:
             log.debug("scan", "sids: {} Scanning file: {}".format(sids, filename))
             # Only scan the file if we don't have a previous mtime for it, or the mtime is different
-            old_mtime = db.c.fetch_var(
-                "SELECT song_file_mtime FROM r4_songs WHERE song_filename = %s AND song_verified = TRUE",
-                (filename,),
-            )
+            if known_files is not None:
+                known = known_files.get(filename)
+                # songs still pending a replay gain get another go
+                if known and known["song_replay_gain"] is not None:
+                    old_mtime = known["song_file_mtime"]
+                else:
+                    old_mtime = None
+            else:
+                known = None
+                old_mtime = db.c.fetch_var(
+                    "SELECT song_file_mtime FROM r4_songs WHERE song_filename = %s AND song_verified = TRUE",
+                    (filename,),
+                )
             if old_mtime != new_mtime or not old_mtime:
                 log.debug("scan", "mtime mismatch, scanning for changes")
-                s = playlist.Song.load_from_file(filename, sids)
-                if not db.c.fetch_var(
-                    "SELECT album_id FROM r4_songs WHERE song_id = %s", (s.id,)
-                ):
-                    _add_scan_error(
-                        s.filename,
-                        PassableScanError(
-                            "%s was scanned but has no album ID." % s.filename
-                        ),
-                    )
-                    s.disable()
+                _save_song(filename, sids)
+                if process_art:
+                    _process_found_album_art(os.path.dirname(filename))
+            elif known:
+                log.debug("scan", "mtime match, no action taken.")
+                _unchanged_song_ids.append(known["song_id"])
             else:
                 log.debug("scan", "mtime match, no action taken.")
                 db.c.update(
                     "UPDATE r4_songs SET song_scanned = TRUE WHERE song_filename = %s",
                     (filename,),
                 )
-            _process_found_album_art(os.path.dirname(filename))
         except IOError as e:
             _add_scan_error(filename, e)
             _disable_file(filename)
@@ -203,13 +416,20 @@ def _scan_file(filename, sids):
             _add_scan_error(filename, e, sys.exc_info())
             _disable_file(filename)
     elif _is_image(filename):
-        try:
-            _process_album_art(filename, sids)
-        except AlbumArtNoAlbumFoundError:
-            _found_album_art.append((filename, sids))
+        _queue_album_art(filename, sids)
     return True
 
 
+def _save_song(filename, sids, file_tags=None):
+    s = playlist.Song.load_from_file(filename, sids, file_tags)
+    if not db.c.fetch_var("SELECT album_id FROM r4_songs WHERE song_id = %s", (s.id,)):
+        _add_scan_error(
+            s.filename,
+            PassableScanError("%s was scanned but has no album ID." % s.filename),
+        )
+        s.disable()
+
+
 bad_extensions = (".tmp", ".filepart")
 
 
@@ -245,122 +465,289 @@ def _is_image(filename):
     return False
 
 
+def _queue_album_art(filename, sids):
+    directory = os.path.dirname(filename) + os.sep
+    art = _found_album_art.setdefault(directory, [])
+    if not (filename, sids) in art:
+        art.append((filename, sids))
+    album_ids = _get_directory_album_ids(directory)
+    # art already in the directory may have been matched against different albums
+    _directory_album_ids.setdefault(directory, album_ids)
+    try:
+        _process_album_art(filename, sids, album_ids)
+    except AlbumArtNoAlbumFoundError:
+        pass
+
+
 def _process_found_album_art(dirname=None):
-    if dirname and not dirname.endswith(os.sep):
-        dirname += os.sep
+    # Art stays indexed by directory for the whole scan, since songs of another album
+    # can still turn up in the same directory.  A directory's art is only matched
+    # again when a song saved there or the end of scan pass finds its albums changed.
+    if dirname:
+        if not dirname.endswith(os.sep):
+            dirname += os.sep
+        art = _found_album_art.get(dirname)
+        if not art:
+            return
+        album_ids = _get_directory_album_ids(dirname)
+        if not album_ids or _directory_album_ids.get(dirname) == album_ids:
+            return
+        _directory_album_ids[dirname] = album_ids
+        for filename, sids in art:
+            try:
+                if _process_album_art(filename, sids, album_ids):
+                    print(f"Found album art for {dirname}")
+            except:
+                pass
+        return
+
     matched_count = 0
-    for album_art_tuple in _found_album_art:
-        filename, sids = album_art_tuple
-        if not dirname or (os.path.dirname(filename) + os.sep) == dirname:
+    total = sum(len(art) for art in _found_album_art.values())
+    for directory, art in _found_album_art.items():
+        album_ids = _get_directory_album_ids(directory)
+        rematch = album_ids and _directory_album_ids.get(directory) != album_ids
+        _directory_album_ids[directory] = album_ids
+        for filename, sids in art:
             try:
-                if _process_album_art(filename, sids):
-                    matched_count += 1
+                if rematch:
+                    _process_album_art(filename, sids, album_ids)
             except:
                 pass
-            if not dirname:
-                _print_to_screen_inline(
-                    "Matched album art: %s/%s"
-                    % (matched_count, len(_found_album_art) - 1)
-                )
-            else:
-                print(f"Found album art for {dirname}")
-    if not dirname:
-        _print_to_screen_inline("\n")
+            if filename in _matched_album_art:
+                matched_count += 1
+            _print_to_screen_inline("Matched album art: %s/%s" % (matched_count, total))
+    _collect_album_art(wait=True)
+    _save_album_art_manifest()
+    _print_to_screen_inline("\n")
 
 
-def _process_album_art(filename, sids):
-    # Processes album art by finding the album IDs that are associated with the songs that exist
-    # in the same directory as the image file.
-    if not config.get("album_art_enabled"):
-        return True
+def _get_directory_album_ids(directory):
+    return db.c.fetch_list(
+        "SELECT DISTINCT album_id FROM r4_songs WHERE song_filename LIKE %s || '%%' ORDER BY album_id",
+        (directory,),
+    )
+
+
+def _forget_album_art(directory):
+    # The monitor lives for as long as the station does, so art found while
+    # processing a directory's events is dropped once they've been handled.
+    for art_directory in [d for d in _found_album_art if d.startswith(directory)]:
+        for filename, _sids in _found_album_art.pop(art_directory):
+            _matched_album_art.discard(filename)
+            _album_art_hashes.pop(filename, None)
+    for art_directory in [d for d in _directory_album_ids if d.startswith(directory)]:
+        del _directory_album_ids[art_directory]
+
+
+def _get_album_art_manifest():
+    # output prefix (e.g. "1_55") -> hash of the image it was last rendered from
+    global _album_art_manifest
+    if _album_art_manifest is None:
+        try:
+            with open(
+                os.path.join(config.get("album_art_file_path"), ALBUM_ART_MANIFEST)
+            ) as f:
+                _album_art_manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            _album_art_manifest = {}
+    return _album_art_manifest
+
+
+def _save_album_art_manifest():
+    global _album_art_manifest_changed
+    if not _album_art_manifest_changed:
+        return
+    _album_art_manifest_changed = False
     try:
-        directory = os.path.dirname(filename) + os.sep
-        album_ids = db.c.fetch_list(
-            "SELECT DISTINCT album_id FROM r4_songs WHERE song_filename LIKE %s || '%%'",
-            (directory,),
+        path = os.path.join(config.get("album_art_file_path"), ALBUM_ART_MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(_album_art_manifest, f)
+        os.replace(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        log.warn("album_art", "Could not save album art manifest: %s" % e)
+
+
+def _get_album_art_hash(filename):
+    stat = os.stat(filename)
+    key = (stat.st_size, stat.st_mtime)
+    cached = _album_art_hashes.get(filename)
+    if cached and cached[0] == key:
+        return cached[1]
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            sha.update(chunk)
+    _album_art_hashes[filename] = (key, sha.hexdigest())
+    return _album_art_hashes[filename][1]
+
+
+def _album_art_is_current(prefix, source_hash):
+    if _get_album_art_manifest().get(prefix) != source_hash:
+        return False
+    for size in ALBUM_ART_SIZES:
+        if not os.path.exists(
+            os.path.join(
+                config.get("album_art_file_path"), "%s_%s.jpg" % (prefix, size)
+            )
+        ):
+            return False
+    return True
+
+
+def _album_art_is_pending(prefix, source_hash):
+    future = _album_art_outputs.get(prefix)
+    return bool(future) and _album_art_pending[future][2] == source_hash
+
+
+def start_album_art_pool(workers):
+    global _album_art_pool
+    if not _album_art_pool and workers > 1:
+        _album_art_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_common_init
         )
-        if not album_ids or len(album_ids) == 0:
-            raise AlbumArtNoAlbumFoundError
-        with Image.open(filename) as im_original:
-            if not im_original:
-                raise IOError
-            if im_original.mode != "RGB":
-                im_original = im_original.convert("RGB")
-            im_320 = im_original
-            im_240 = im_original
-            im_120 = im_original
-            if im_original.size[0] > 420 or im_original.size[1] > 420:
-                im_320 = im_original.copy()
-                im_320.thumbnail((320, 320), Image.Resampling.LANCZOS)
-            if im_original.size[0] > 240 or im_original.size[1] > 240:
-                im_240 = im_original.copy()
-                im_240.thumbnail((240, 240), Image.Resampling.LANCZOS)
-            if im_original.size[0] > 160 or im_original.size[1] > 160:
-                im_120 = im_original.copy()
-                im_120.thumbnail((120, 120), Image.Resampling.LANCZOS)
-            if im_original.size[0] < 320 or im_original.size[1] < 320:
-                _add_scan_error(
-                    filename,
-                    PassableScanError(
-                        "Small Art Warning: %sx%s"
-                        % (im_original.size[0], im_original.size[1])
-                    ),
-                )
-            for album_id in album_ids:
-                for sid in sids:
-                    im_120.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_120.jpg" % (sid, album_id),
-                        )
-                    )
-                    im_240.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_240.jpg" % (sid, album_id),
-                        )
-                    )
-                    im_320.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_320.jpg" % (sid, album_id),
-                        )
+
+
+def stop_album_art_pool():
+    global _album_art_pool
+    if _album_art_pool:
+        _collect_album_art(wait=True)
+        _save_album_art_manifest()
+        _album_art_pool.shutdown(wait=True)
+        _album_art_pool = None
+
+
+def _render_album_art(filename, prefixes):
+    # Decodes the image once and writes every size for every output prefix.
+    # Runs in the art pool's worker processes, so it must not touch the database.
+    with Image.open(filename) as im_original:
+        if not im_original:
+            raise IOError
+        if im_original.mode != "RGB":
+            im_original = im_original.convert("RGB")
+        im_320 = im_original
+        im_240 = im_original
+        im_120 = im_original
+        if im_original.size[0] > 420 or im_original.size[1] > 420:
+            im_320 = im_original.copy()
+            im_320.thumbnail((320, 320), Image.Resampling.LANCZOS)
+        if im_original.size[0] > 240 or im_original.size[1] > 240:
+            im_240 = im_original.copy()
+            im_240.thumbnail((240, 240), Image.Resampling.LANCZOS)
+        if im_original.size[0] > 160 or im_original.size[1] > 160:
+            im_120 = im_original.copy()
+            im_120.thumbnail((120, 120), Image.Resampling.LANCZOS)
+        for prefix in prefixes:
+            for size, im in ((120, im_120), (240, im_240), (320, im_320)):
+                im.save(
+                    os.path.join(
+                        config.get("album_art_file_path"), "%s_%s.jpg" % (prefix, size)
                     )
-                a_120_path = os.path.join(
-                    config.get("album_art_file_path"), "a_%s_120.jpg" % (album_id)
                 )
-                # sids[0] is the origin SID
-                if sids[0] == config.get("album_art_master_sid") or not os.path.exists(
-                    a_120_path
-                ):
-                    im_120.save(a_120_path)
-                    im_240.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "a_%s_240.jpg" % (album_id),
-                        )
-                    )
-                    im_320.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "a_%s_320.jpg" % (album_id),
-                        )
-                    )
-            log.debug(
-                "album_art", "Scanned %s for album ID %s." % (filename, album_ids)
-            )
-            return True
-    except (IOError, OSError) as err:
+        return im_original.size
+
+
+def _finish_album_art(filename, prefixes, source_hash, size):
+    global _album_art_manifest_changed
+    if size[0] < 320 or size[1] < 320:
+        _add_scan_error(
+            filename,
+            PassableScanError("Small Art Warning: %sx%s" % (size[0], size[1])),
+        )
+    manifest = _get_album_art_manifest()
+    for prefix in prefixes:
+        manifest[prefix] = source_hash
+    _album_art_manifest_changed = True
+    playlist.add_to_art_index(prefixes)
+    log.debug("album_art", "Scanned %s for %s." % (filename, prefixes))
+
+
+def _handle_album_art_error(filename, err):
+    if isinstance(err, (IOError, OSError)):
         _add_scan_error(
             filename,
             PassableScanError(
                 f"Could not open album art. (this can happen if a directory has been deleted) {err}"
             ),
         )
+    else:
+        _add_scan_error(filename, err)
+
+
+def _collect_album_art(wait=False, futures=None):
+    if not _album_art_pending:
+        return
+    if futures or wait:
+        concurrent.futures.wait(futures or list(_album_art_pending))
+    for future in [future for future in _album_art_pending if future.done()]:
+        filename, prefixes, source_hash = _album_art_pending.pop(future)
+        for prefix in prefixes:
+            if _album_art_outputs.get(prefix) is future:
+                del _album_art_outputs[prefix]
+        try:
+            _finish_album_art(filename, prefixes, source_hash, future.result())
+        except Exception as e:
+            _handle_album_art_error(filename, e)
+
+
+def _process_album_art(filename, sids, album_ids=None):
+    # Processes album art by finding the album IDs that are associated with the songs that exist
+    # in the same directory as the image file.  Returns True if any art had to be (re)rendered.
+    if not config.get("album_art_enabled"):
+        return True
+    try:
+        if album_ids is None:
+            album_ids = _get_directory_album_ids(os.path.dirname(filename) + os.sep)
+        if not album_ids or len(album_ids) == 0:
+            raise AlbumArtNoAlbumFoundError
+        _matched_album_art.add(filename)
+        source_hash = _get_album_art_hash(filename)
+
+        prefixes = []
+        for album_id in album_ids:
+            for sid in sids:
+                prefixes.append("%s_%s" % (sid, album_id))
+            a_120_path = os.path.join(
+                config.get("album_art_file_path"), "a_%s_120.jpg" % (album_id)
+            )
+            # sids[0] is the origin SID
+            if (
+                sids[0] == config.get("album_art_master_sid")
+                or not os.path.exists(a_120_path)
+                and not "a_%s" % album_id in _album_art_outputs
+            ):
+                prefixes.append("a_%s" % album_id)
+        # skip outputs already rendered from this image, or on their way to being
+        prefixes = [
+            p
+            for p in prefixes
+            if not _album_art_is_pending(p, source_hash)
+            and not _album_art_is_current(p, source_hash)
+        ]
+        if not prefixes:
+            return False
+
+        if not _album_art_pool:
+            _finish_album_art(
+                filename, prefixes, source_hash, _render_album_art(filename, prefixes)
+            )
+            return True
+
+        # keep the last write to an output the last one submitted
+        earlier = set(
+            _album_art_outputs[p] for p in prefixes if p in _album_art_outputs
+        )
+        if earlier:
+            _collect_album_art(futures=earlier)
+        _collect_album_art()
+        future = _album_art_pool.submit(_render_album_art, filename, prefixes)
+        _album_art_pending[future] = (filename, prefixes, source_hash)
+        for prefix in prefixes:
+            _album_art_outputs[prefix] = future
+        return True
     except AlbumArtNoAlbumFoundError:
         raise
     except Exception as e:
-        _add_scan_error(filename, e)
+        _handle_album_art_error(filename, e)
     return False
 
 
@@ -416,16 +803,109 @@ def _add_scan_error(filename, xception, full_exc=None):
 
 DELETE_OPERATION = (IN_DELETE, IN_MOVED_FROM)
 
-
-class NewDirectoryException(Exception):
-    pass
+# Events are gathered per directory and acted on once the directory has been quiet
+# for this many seconds (monitor_quiet_period), or has been busy for MAX_DEBOUNCE_WAIT.
+DEFAULT_QUIET_PERIOD = 5
+MAX_DEBOUNCE_WAIT = 60
+# directory -> {"files", "scan_directory", "first", "last"}
+_pending_directories = {}
 
 
 class DeletedDirectoryException(Exception):
     pass
 
 
+def _get_sids_for_path(pathname):
+    matched_sids = []
+    for song_dirs_path, sids in config.get("song_dirs").items():
+        if pathname.startswith(song_dirs_path):
+            matched_sids.extend(sids)
+    return matched_sids
+
+
+def _queue_event(pathname, is_dir):
+    if is_dir:
+        directory = os.path.join(os.path.normpath(pathname), "")
+    else:
+        directory = os.path.dirname(pathname) + os.sep
+    now = timestamp()
+    pending = _pending_directories.setdefault(
+        directory,
+        {"files": set(), "scan_directory": False, "first": now, "last": now},
+    )
+    pending["last"] = now
+    # a directory waiting to be scanned stays waiting while anything under it is busy
+    for parent, parent_pending in _pending_directories.items():
+        if parent_pending["scan_directory"] and directory.startswith(parent):
+            parent_pending["last"] = now
+    if is_dir:
+        pending["scan_directory"] = True
+    else:
+        pending["files"].add(pathname)
+
+
+def process_pending_events(force=False):
+    quiet_period = DEFAULT_QUIET_PERIOD
+    if config.has("monitor_quiet_period"):
+        quiet_period = config.get("monitor_quiet_period")
+    now = timestamp()
+    for directory, pending in list(_pending_directories.items()):
+        if (
+            force
+            or now - pending["last"] >= quiet_period
+            or now - pending["first"] >= MAX_DEBOUNCE_WAIT
+        ):
+            if not directory in _pending_directories:
+                continue
+            del _pending_directories[directory]
+            if pending["scan_directory"]:
+                # the directory scan walks its subdirectories too
+                for subdirectory in list(_pending_directories):
+                    if subdirectory.startswith(directory):
+                        del _pending_directories[subdirectory]
+            _process_directory_events(directory, pending)
+    _save_album_art_manifest()
+
+
+def _process_directory_events(directory, pending):
+    sids = _get_sids_for_path(directory)
+    log.debug(
+        "scan",
+        "Processing %s events in %s %s"
+        % (len(pending["files"]) or "directory", directory, sids),
+    )
+    try:
+        db.c.start_transaction()
+        if pending["scan_directory"]:
+            _scan_directory(directory, sids)
+        else:
+            known_files = _load_known_files(directory)
+            # songs before art, so the art has albums to match
+            for filename in sorted(pending["files"], key=_is_image):
+                if not os.path.exists(filename):
+                    if _is_mp3(filename):
+                        _disable_file(filename)
+                elif len(sids) == 0:
+                    _disable_file(filename)
+                else:
+                    _scan_file(
+                        filename, sids, known_files=known_files, process_art=False
+                    )
+            _mark_unchanged_scanned()
+        _process_found_album_art(directory)
+        db.c.commit()
+    except Exception as xception:
+        db.c.rollback()
+        _add_scan_error(directory, xception)
+    finally:
+        _forget_album_art(directory)
+
+
 class FileEventHandler(ProcessEvent):
+    def my_init(self, wm=None, mask=None):
+        self.wm = wm
+        self.mask = mask
+
     def process_IN_ATTRIB(self, event):
         # ATTRIB events are:
         # - Some file renames (see: WinSCP)
@@ -440,6 +920,7 @@ class FileEventHandler(ProcessEvent):
         self._process(event)
 
     def process_IN_CREATE(self, event):
+        # auto_add has already added a watch for the new directory
         if event.dir:
             self._process(event)
 
@@ -467,11 +948,13 @@ class FileEventHandler(ProcessEvent):
         self._process(event)
 
     def process_IN_MOVED_TO(self, event):
+        # Directories moved in from outside the watch need watching, and only that
+        # directory needs to be added, not the whole tree re-watched.
+        if event.dir and self.wm and self.wm.get_wd(event.pathname) is None:
+            log.debug("scan", "Watching new directory %s" % event.pathname)
+            self.wm.add_watch(event.pathname, self.mask, rec=True, auto_add=True)
         self._process(event)
 
-        if event.dir:
-            raise NewDirectoryException
-
     def process_IN_MOVED_FROM(self, event):
         if not event.dir and not _is_mp3(event.pathname):
             log.debug(
@@ -489,25 +972,8 @@ class FileEventHandler(ProcessEvent):
         if event.pathname.endswith(".filepart"):
             return
 
-        try:
-            matched_sids = []
-            for song_dirs_path, sids in config.get("song_dirs").items():
-                if event.pathname.startswith(song_dirs_path):
-                    matched_sids.extend(sids)
-        except Exception as xception:
-            _add_scan_error(event.pathname, xception)
-
-        log.debug("scan", "%s %s %s" % (event.maskname, event.pathname, matched_sids))
-
-        try:
-            if event.dir:
-                _scan_directory(event.pathname, matched_sids)
-            elif len(matched_sids) == 0 or event.mask in DELETE_OPERATION:
-                _disable_file(event.pathname)
-            else:
-                _scan_file(event.pathname, matched_sids)
-        except Exception as xception:
-            _add_scan_error(event.pathname, xception)
+        log.debug("scan", "%s %s" % (event.maskname, event.pathname))
+        _queue_event(event.pathname, event.dir)
 
 
 def monitor():
@@ -531,10 +997,11 @@ def monitor():
                 log.info("scan", "File monitor started.")
                 wm = pyinotify.WatchManager()
                 wm.add_watch(config.get("monitor_dir"), mask, rec=True, auto_add=True)
-                pyinotify.Notifier(wm, FileEventHandler()).loop()
+                # the timeout lets pending events be processed once they've gone quiet
+                pyinotify.Notifier(
+                    wm, FileEventHandler(wm=wm, mask=mask), timeout=1000
+                ).loop(callback=lambda notifier: process_pending_events())
                 go = False
-            except NewDirectoryException:
-                log.debug("scan", "New directory added, restarting watch.")
             except DeletedDirectoryException:
                 log.debug("scan", "Directory was deleted, restarting watch.")
             finally:
@@ -543,4 +1010,5 @@ def monitor():
                 except:
                     pass
     finally:
+        process_pending_events(force=True)
         log.info("scan", "File monitor shutdown.")
@@ -9,6 +9,8 @@ import tornado.options
 from backend import sync_to_front
 from rainwave import schedule
 from rainwave import playlist
+from rainwave import request
+from rainwave import vote_tally
 from libs import log
 from libs import config
 from libs import db
@@ -138,7 +140,22 @@ class BackendServer:
 
         for station_id in config.station_ids:
             playlist.prepare_cooldown_algorithm(station_id)
+        request.start(sid)
         schedule.load()
+        # Events from the API that this station's backend keeps in-memory state for
+        topics = ["*/request_line_user", "*/update_user", "%s/refresh_line" % sid]
+        if vote_tally.enabled():
+            topics.append("%s/tally_vote" % sid)
+            vote_tally.start(sid)
+        zeromq.init_sub(topics)
+        zeromq.set_sub_callback(lambda frames: self._on_zmq(sid, frames))
+        check_interval = 300
+        if config.has("request_line_check_interval"):
+            check_interval = config.get("request_line_check_interval")
+        if check_interval:
+            tornado.ioloop.PeriodicCallback(
+                lambda: self._check_request_line(sid), check_interval * 1000
+            ).start()
         log.debug(
             "start",
             "Backend server started, station %s port %s, ready to go."
@@ -155,6 +172,37 @@ class BackendServer:
             log.info("stop", "Backend has been shutdown.")
             log.close()
 
+    def _on_zmq(self, sid, frames):
+        try:
+            messages = zeromq.decode(frames)
+        except Exception as e:
+            log.exception("zeromq", "Error decoding ZeroMQ message.", e)
+            return
+        for message in messages:
+            try:
+                if message["action"] == "tally_vote":
+                    vote_tally.on_message(message)
+                elif message["action"] in ("request_line_user", "update_user"):
+                    # requests changed, or the user tuned in or out
+                    request.refresh_line(sid, [message["user_id"]])
+                elif message["action"] == "refresh_line":
+                    # songs were election blocked outside the backend, e.g. a DJ's election
+                    request.refresh_line(
+                        sid, message.get("user_ids"), message.get("song_ids")
+                    )
+            except Exception as e:
+                log.exception(
+                    "zeromq",
+                    "Error handling Zero MQ action '%s'" % message.get("action"),
+                    e,
+                )
+
+    def _check_request_line(self, sid):
+        try:
+            request.check_line(sid)
+        except Exception as e:
+            log.exception("request_line", "Request line consistency check failed.", e)
+
     def _import_cron_modules(self):
         # pylint: disable=import-outside-toplevel,unused-import
         # This method breaks pylint and quite on purpose, its job is to just load
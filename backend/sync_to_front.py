@@ -1,8 +1,15 @@
+from libs import cache
 from libs import zeromq
 
 
 def sync_frontend_all(sid):
-    zeromq.publish({"action": "update_all", "sid": sid})
+    zeromq.publish(
+        {
+            "action": "update_all",
+            "sid": sid,
+            "sched_version": cache.get_station(sid, "sched_version"),
+        }
+    )
 
 
 def sync_frontend_ip(ip_address):
@@ -1,3 +1,11 @@
+import math
+import re
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from time import monotonic
+from time import time_ns
+
 from libs import config
 from libs import db
 import pylibmc as libmc
@@ -14,8 +22,14 @@ _memcache_behaviors = {
     "connect_timeout": 1000000,
     "receive_timeout": 5000000,
     "send_timeout": 5000000,
+    "cas": True,
 }
 local = {}
+# memcache key -> (expiry, ratings blob).  Cleared on every schedule update, entries
+# also expire so processes that never get update_all don't serve stale or pile up blobs.
+_local_ratings_blobs = {}
+_LOCAL_RATINGS_BLOB_TTL = 60
+_LOCAL_RATINGS_BLOBS_MAX = 2000
 
 
 class TestModeCache:
@@ -31,6 +45,169 @@ class TestModeCache:
     def set(self, key, value):
         self.vars[key] = value
 
+    def get_multi(self, keys):
+        return {key: self.vars[key] for key in keys if key in self.vars}
+
+    def set_multi(self, mapping):
+        self.vars.update(mapping)
+
+    def gets(self, key):
+        if not key in self.vars:
+            return (None, None)
+        return (self.vars[key], id(self.vars[key]))
+
+    def cas(self, key, value, cas_id):
+        if not key in self.vars or id(self.vars[key]) != cas_id:
+            return False
+        self.vars[key] = value
+        return True
+
+    def add(self, key, value):
+        if key in self.vars:
+            return False
+        self.vars[key] = value
+        return True
+
+
+class LocalTier:
+    """
+    Bounded, TTL-aware LRU sitting in front of memcache inside one process.
+    Entries can carry a tag, e.g. ("sid", 1), so invalidate_tag() can drop every
+    key belonging to a station or user at once.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns (found, value)."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return (False, None)
+        if entry[0] < monotonic():
+            self.expirations += 1
+            self.misses += 1
+            self._drop(key)
+            return (False, None)
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return (True, entry[1])
+
+    def set(self, key, value, ttl, tag=None):
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (monotonic() + ttl, value, tag)
+        if tag is not None:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_size:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self.entries:
+            self._drop(key)
+            self.invalidations += 1
+
+    def invalidate_tag(self, tag):
+        for key in list(self.tags.get(tag, ())):
+            self._drop(key)
+            self.invalidations += 1
+
+    def _drop(self, key):
+        tag = self.entries.pop(key)[2]
+        if tag is not None and tag in self.tags:
+            self.tags[tag].discard(key)
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+# Key family -> seconds a value may be served from the local tier.  Families not listed
+# always go to memcache.  Station keys (sid<id>_...) are listed by their suffix, user
+# keys (u<id>_..., the ones behind get_user/set_user) by their suffix prefixed with "u_".
+# Station and user keys are also dropped early when the matching
+# update_all/update_dj/update_user ZeroMQ message arrives.
+local_tier_ttls = {
+    "backend_ok": 5,
+    "backend_paused": 5,
+    "backend_paused_playing": 5,
+    "pause_title": 5,
+    "dj_user_ids": 10,
+    "all_albums": 60,
+    "all_artists": 60,
+    "all_groups": 60,
+    "all_groups_power": 60,
+    "api_key_listen_key": 300,
+    "u_api_keys": 30,
+    "u_vote_history": 5,
+}
+_local_tier = None
+_tagged_key_re = re.compile(r"^(sid|u)(\d+)_(.+)$")
+
+
+def enable_local_tier():
+    global _local_tier
+
+    max_size = 10000
+    if config.has("cache_local_tier_size"):
+        max_size = config.get("cache_local_tier_size")
+    if config.has("cache_local_tier_ttls"):
+        local_tier_ttls.update(config.get("cache_local_tier_ttls"))
+    if max_size:
+        _local_tier = LocalTier(max_size)
+
+
+def _local_tier_policy(key):
+    """Returns (ttl, tag) for a key, ttl being None for keys the tier doesn't hold."""
+    if isinstance(key, bytes):
+        key = key.decode("ascii", "ignore")
+    match = _tagged_key_re.match(key)
+    if match:
+        family = match.group(3)
+        if match.group(1) == "u":
+            family = "u_" + family
+        return (
+            local_tier_ttls.get(family),
+            (match.group(1), int(match.group(2))),
+        )
+    if key.startswith("api_key_listen_key_"):
+        return (local_tier_ttls.get("api_key_listen_key"), None)
+    return (local_tier_ttls.get(key), None)
+
+
+def get_local_tier_stats():
+    if not _local_tier:
+        return None
+    return _local_tier.stats()
+
+
+def invalidate_local_station(sid):
+    if _local_tier:
+        _local_tier.invalidate_tag(("sid", sid))
+
+
+def invalidate_local_user(user_id):
+    if _local_tier:
+        _local_tier.invalidate_tag(("u", user_id))
+
 
 def connect():
     global _memcache
@@ -65,6 +242,10 @@ def set_global(key, value, save_local=False):
     if save_local or key in local:
         local[key] = value
     _memcache.set(key, value)
+    if _local_tier:
+        ttl, tag = _local_tier_policy(key)
+        if ttl:
+            _local_tier.set(key, value, ttl, tag)
 
 
 def get(key):
@@ -72,9 +253,44 @@ def get(key):
         raise APIException("internal_error", "No memcache connection.", http_code=500)
     if key in local:
         return local[key]
+    if _local_tier:
+        ttl, tag = _local_tier_policy(key)
+        if ttl:
+            found, value = _local_tier.get(key)
+            if not found:
+                value = _memcache.get(key)
+                _local_tier.set(key, value, ttl, tag)
+            return value
     return _memcache.get(key)
 
 
+def update_global(key, update, retries=10):
+    """
+    Read-modify-write of a key that several processes write to.  update() gets
+    the current value (None when missing) and returns the new one, or None to
+    leave the key alone.  Uses memcache CAS, retrying when another process wrote
+    in between.  Returns False when the write never went through.
+    """
+    if not _memcache:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    for _ in range(retries):
+        value, cas_id = _memcache.gets(key)
+        value = update(value)
+        if value is None:
+            return True
+        if cas_id is None:
+            written = _memcache.add(key, value)
+        else:
+            written = _memcache.cas(key, value, cas_id)
+        if written:
+            if key in local:
+                local[key] = value
+            if _local_tier:
+                _local_tier.invalidate(key)
+            return True
+    return False
+
+
 def set_user(user, key, value):
     if user.__class__.__name__ == "int" or user.__class__.__name__ == "long":
         set_global("u%s_%s" % (user, key), value)
@@ -97,6 +313,10 @@ def get_station(sid, key):
     return get("sid%s_%s" % (sid, key))
 
 
+def update_station(sid, key, update):
+    return update_global("sid%s_%s" % (sid, key), update)
+
+
 def set_song_rating(song_id, user_id, rating):
     if not _memcache_ratings:
         raise APIException("internal_error", "No memcache connection.", http_code=500)
@@ -115,6 +335,25 @@ def set_album_rating(sid, album_id, user_id, rating):
     _memcache_ratings.set("rating_album_%s_%s_%s" % (sid, album_id, user_id), rating)
 
 
+def get_song_ratings(song_ids, user_id):
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    keys = {"rating_song_%s_%s" % (song_id, user_id): song_id for song_id in song_ids}
+    found = _memcache_ratings.get_multi(list(keys))
+    return {keys[key]: rating for key, rating in found.items() if rating}
+
+
+def set_song_ratings(ratings, user_id):
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    _memcache_ratings.set_multi(
+        {
+            "rating_song_%s_%s" % (song_id, user_id): rating
+            for song_id, rating in ratings.items()
+        }
+    )
+
+
 def set_album_faves(sid, album_id, user_id, fave):
     rating = get_album_rating(sid, album_id, user_id)
     if rating:
@@ -128,21 +367,151 @@ def get_album_rating(sid, album_id, user_id):
     return _memcache_ratings.get("rating_album_%s_%s_%s" % (sid, album_id, user_id))
 
 
+# Ratings blobs hold every user's rating for one song or album as three byte strings,
+# sorted by user ID: user IDs (uint32), ratings and flags (fave: 0 None, 1 False,
+# 2 True; +4 for rating_complete).  Song ratings come in steps of 0.5 and are stored
+# as uint16 (rating * 10 + 1, 0 for None).  Album ratings are averages and are stored
+# as doubles at full precision (NaN for None).  One value per
+# song/album keeps priming at O(songs) memcache writes regardless of how many users
+# there are, and lookups are a binary search straight over the bytes.
+_FAVE_TO_FLAG = {None: 0, False: 1, True: 2}
+_FLAG_TO_FAVE = (None, False, True)
+_RATING_COMPLETE_FLAG = 4
+
+
+def pack_ratings_blob(all_ratings, album=False):
+    user_ids = array("I")
+    ratings = array("d" if album else "H")
+    flags = array("B")
+    for user_id in sorted(all_ratings):
+        rating = all_ratings[user_id]
+        user_ids.append(user_id)
+        if album:
+            if rating["rating_user"] is None:
+                ratings.append(math.nan)
+            else:
+                ratings.append(rating["rating_user"])
+        elif rating["rating_user"] is None:
+            ratings.append(0)
+        else:
+            ratings.append(int(round(rating["rating_user"] * 10)) + 1)
+        flag = _FAVE_TO_FLAG[rating["fave"]]
+        if rating.get("rating_complete"):
+            flag += _RATING_COMPLETE_FLAG
+        flags.append(flag)
+    return (user_ids.tobytes(), ratings.tobytes(), flags.tobytes())
+
+
+def _unpack_ratings_blob(blob, user_id, album):
+    user_ids = memoryview(blob[0]).cast("I")
+    i = bisect_left(user_ids, user_id)
+    if i == len(user_ids) or user_ids[i] != user_id:
+        return None
+    flag = blob[2][i]
+    if album:
+        rating_user = memoryview(blob[1]).cast("d")[i]
+        rating = {
+            "rating_user": None if math.isnan(rating_user) else rating_user,
+            "fave": _FLAG_TO_FAVE[flag & 3],
+            "rating_complete": bool(flag & _RATING_COMPLETE_FLAG),
+        }
+    else:
+        rating_user = memoryview(blob[1]).cast("H")[i]
+        rating = {
+            "rating_user": (rating_user - 1) / 10 if rating_user else None,
+            "fave": _FLAG_TO_FAVE[flag & 3],
+        }
+    return rating
+
+
+def _get_ratings_blob(key):
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    entry = _local_ratings_blobs.get(key)
+    now = monotonic()
+    if not entry or entry[0] < now:
+        if len(_local_ratings_blobs) >= _LOCAL_RATINGS_BLOBS_MAX:
+            _local_ratings_blobs.clear()
+        entry = (now + _LOCAL_RATINGS_BLOB_TTL, _memcache_ratings.get(key))
+        _local_ratings_blobs[key] = entry
+    return entry[1]
+
+
+def get_song_rating_from_blob(song_id, user_id):
+    """
+    Returns None when no blob exists for the song, the user's rating otherwise
+    (defaulting to unrated when they're not in it).
+    """
+    blob = _get_ratings_blob("rating_song_all_%s" % song_id)
+    if not blob:
+        return None
+    return _unpack_ratings_blob(blob, user_id, False) or {
+        "rating_user": 0,
+        "fave": None,
+    }
+
+
+def get_album_rating_from_blob(sid, album_id, user_id):
+    blob = _get_ratings_blob("rating_album_all_%s_%s" % (sid, album_id))
+    if not blob:
+        return None
+    rating = _unpack_ratings_blob(blob, user_id, True)
+    if not rating:
+        return {"rating_user": 0, "fave": False, "rating_complete": False}
+    rating["rating_user"] = rating["rating_user"] or 0
+    rating["fave"] = rating["fave"] or False
+    return rating
+
+
+def get_album_ratings(album_keys, user_id):
+    """album_keys is an iterable of (sid, album_id)"""
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    keys = {
+        "rating_album_%s_%s_%s" % (sid, album_id, user_id): (sid, album_id)
+        for sid, album_id in album_keys
+    }
+    found = _memcache_ratings.get_multi(list(keys))
+    return {keys[key]: rating for key, rating in found.items() if rating}
+
+
+def set_album_ratings(ratings, user_id):
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    _memcache_ratings.set_multi(
+        {
+            "rating_album_%s_%s_%s" % (sid, album_id, user_id): rating
+            for (sid, album_id), rating in ratings.items()
+        }
+    )
+
+
 def prime_rating_cache_for_events(sid, events, songs=None):
+    primed = set()
     for e in events:
         for song in e.songs:
-            prime_rating_cache_for_song(song, sid)
+            prime_rating_cache_for_song(song, sid, primed)
     if songs:
         for song in songs:
-            prime_rating_cache_for_song(song, sid)
+            prime_rating_cache_for_song(song, sid, primed)
 
 
-def prime_rating_cache_for_song(song, sid):
-    for user_id, rating in song.get_all_ratings().items():
-        set_song_rating(song.id, user_id, rating)
-    if song.album:
-        for user_id, rating in song.album.get_all_ratings(sid).items():
-            set_album_rating(sid, song.album.id, user_id, rating)
+def prime_rating_cache_for_song(song, sid, primed=None):
+    if primed is None:
+        primed = set()
+    if not ("song", song.id) in primed:
+        primed.add(("song", song.id))
+        _local_ratings_blobs.pop("rating_song_all_%s" % song.id, None)
+        _memcache_ratings.set(
+            "rating_song_all_%s" % song.id, pack_ratings_blob(song.get_all_ratings())
+        )
+    if song.album and not ("album", song.album.id) in primed:
+        primed.add(("album", song.album.id))
+        _local_ratings_blobs.pop("rating_album_all_%s_%s" % (sid, song.album.id), None)
+        _memcache_ratings.set(
+            "rating_album_all_%s_%s" % (sid, song.album.id),
+            pack_ratings_blob(song.album.get_all_ratings(sid), album=True),
+        )
 
 
 def refresh_local(key):
@@ -158,11 +527,75 @@ def refresh_local_station(sid, key):
     local["sid%s_%s" % (sid, key)] = _memcache.get("sid%s_%s" % (sid, key))
 
 
-def update_local_cache_for_sid(sid):
+class ScheduleSnapshot:
+    """
+    One station's deserialized sched_current/sched_next/sched_history objects at a
+    given sched_version.  Shared by everything in the process, so treat as read-only.
+    """
+
+    __slots__ = ("version", "current", "next", "history")
+
+    def __init__(self, version, current, next_events, history):
+        self.version = version
+        self.current = current
+        self.next = next_events or []
+        self.history = history or []
+
+
+# sid -> the ScheduleSnapshot for the newest sched_version this process has seen
+_schedule_snapshots = {}
+
+
+def set_schedule_snapshot(sid, current, next_events, history):
+    """Used by the backend: stores the schedule objects under a new sched_version."""
+    version = time_ns()
+    set_station(sid, "sched_current", current, True)
+    set_station(sid, "sched_next", next_events, True)
+    set_station(sid, "sched_history", history, True)
+    # written last, so anyone who sees the new version also sees the new objects
+    set_station(sid, "sched_version", version, True)
+    _schedule_snapshots[sid] = ScheduleSnapshot(version, current, next_events, history)
+    return version
+
+
+def load_schedule_snapshot(sid, version=None):
+    """Unpickles the station's schedule from memcache at most once per sched_version."""
+    if not _memcache:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    if version is None:
+        version = _memcache.get("sid%s_sched_version" % sid)
+    snapshot = _schedule_snapshots.get(sid)
+    if snapshot and version is not None and snapshot.version == version:
+        return snapshot
+    snapshot = ScheduleSnapshot(
+        version,
+        _memcache.get("sid%s_sched_current" % sid),
+        _memcache.get("sid%s_sched_next" % sid),
+        _memcache.get("sid%s_sched_history" % sid),
+    )
+    if not snapshot.current:
+        # the backend hasn't written a schedule yet, so don't pin an empty one
+        return snapshot
+    _schedule_snapshots[sid] = snapshot
+    # keep get_station() readers on the same objects
+    local["sid%s_sched_current" % sid] = snapshot.current
+    local["sid%s_sched_next" % sid] = snapshot.next
+    local["sid%s_sched_history" % sid] = snapshot.history
+    return snapshot
+
+
+def get_schedule_snapshot(sid):
+    snapshot = _schedule_snapshots.get(sid)
+    if snapshot and snapshot.current:
+        return snapshot
+    return load_schedule_snapshot(sid)
+
+
+def update_local_cache_for_sid(sid, sched_version=None):
+    # the backend re-primes ratings blobs before asking us to update
+    _local_ratings_blobs.clear()
     refresh_local_station(sid, "album_diff")
-    refresh_local_station(sid, "sched_next")
-    refresh_local_station(sid, "sched_history")
-    refresh_local_station(sid, "sched_current")
+    load_schedule_snapshot(sid, sched_version)
     refresh_local_station(sid, "sched_next_dict")
     refresh_local_station(sid, "sched_history_dict")
     refresh_local_station(sid, "sched_current_dict")
@@ -81,6 +81,16 @@ class PostgresCursor(psycopg2.extras.RealDictCursor):
             "SELECT nextval('" + table + "_" + column + "_seq'::regclass)"
         )
 
+    def get_next_ids(self, table, column, num):
+        return self.fetch_list(
+            "SELECT nextval('"
+            + table
+            + "_"
+            + column
+            + "_seq'::regclass) FROM generate_series(1, %s)",
+            (num,),
+        )
+
     def create_delete_fk(
         self, linking_table, foreign_table, key, create_idx=True, foreign_key=None
     ):
@@ -324,6 +334,18 @@ def create_tables():
         "CREATE INDEX song_title_trgm_gin ON r4_songs USING GIN(song_title_searchable gin_trgm_ops)"
     )
 
+    c.update(
+        " \
+		CREATE TABLE r4_replay_gain_cache ( \
+			rg_audio_hash				TEXT		PRIMARY KEY, \
+			rg_filename					TEXT		, \
+			rg_file_size				BIGINT		, \
+			rg_file_mtime				INTEGER		, \
+			rg_replay_gain				TEXT		NOT NULL \
+		)"
+    )
+    c.create_idx("r4_replay_gain_cache", "rg_filename")
+
     c.update(
         " \
 		CREATE TABLE r4_song_sid ( \
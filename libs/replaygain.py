@@ -1,3 +1,6 @@
+import concurrent.futures
+import hashlib
+import os
 import subprocess
 
 # from gi.repository import GLib
@@ -5,10 +8,167 @@ import subprocess
 # from rgain3.script import init_gstreamer
 
 from libs import config
+from libs import db
+from libs import log
 
 ref_level = 89
 # init_gstreamer()
 
+# Analysed gains are kept in r4_replay_gain_cache keyed by a hash of the audio
+# frames only, so re-tagging, renaming, or re-adding a file never re-decodes it.
+# The file's size and mtime are stored alongside so a file that hasn't changed
+# is matched without even being hashed.
+#
+# During scans, cache misses go to a pool of analysers instead of blocking the
+# scan on a full decode: the song is saved with a pending (NULL) gain that
+# backfill() writes once the analysis finishes.  get_gain() stops queueing once
+# PENDING_PER_WORKER analyses per worker are outstanding and writes finished ones
+# while it waits, so a scan can't walk arbitrarily far ahead of the analysers.
+PENDING_PER_WORKER = 4
+
+# future -> (song_id, filename, file_size, file_mtime, audio_hash)
+_pending = {}
+# (filename, exception) for analyses that failed, handed out by the next backfill()
+_failed = []
+_max_pending = 0
+_pool = None
+
+
+def get_audio_hash(file):
+    # SHA-1 of everything but the ID3v2 tags at the start and ID3v1 tag at the end
+    with open(file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        start = 0
+        f.seek(start)
+        header = f.read(10)
+        while len(header) == 10 and header[:3] == b"ID3":
+            size = 0
+            for b in header[6:10]:
+                size = (size << 7) | (b & 0x7F)
+            start += 10 + size + (10 if header[5] & 0x10 else 0)
+            f.seek(start)
+            header = f.read(10)
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b"TAG":
+                end -= 128
+        f.seek(start)
+        sha = hashlib.sha1()
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1048576))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+        return sha.hexdigest()
+
+
+def _get_cached_gain(file, file_size, file_mtime, audio_hash=None):
+    gain = db.c.fetch_var(
+        "SELECT rg_replay_gain FROM r4_replay_gain_cache WHERE rg_filename = %s AND rg_file_size = %s AND rg_file_mtime = %s",
+        (file, file_size, file_mtime),
+    )
+    if gain:
+        return gain, audio_hash
+    if not audio_hash:
+        audio_hash = get_audio_hash(file)
+    gain = db.c.fetch_var(
+        "SELECT rg_replay_gain FROM r4_replay_gain_cache WHERE rg_audio_hash = %s",
+        (audio_hash,),
+    )
+    if gain:
+        _save_cached_gain(audio_hash, file, file_size, file_mtime, gain)
+    return gain, audio_hash
+
+
+def _save_cached_gain(audio_hash, file, file_size, file_mtime, gain):
+    db.c.update(
+        "INSERT INTO r4_replay_gain_cache (rg_audio_hash, rg_filename, rg_file_size, rg_file_mtime, rg_replay_gain) "
+        "VALUES (%s, %s, %s, %s, %s) "
+        "ON CONFLICT (rg_audio_hash) DO UPDATE SET "
+        "rg_filename = EXCLUDED.rg_filename, rg_file_size = EXCLUDED.rg_file_size, "
+        "rg_file_mtime = EXCLUDED.rg_file_mtime, rg_replay_gain = EXCLUDED.rg_replay_gain",
+        (audio_hash, file, file_size, file_mtime, gain),
+    )
+
+
+def start_pool(workers):
+    # The analysis itself runs in a replaygain subprocess, so threads are enough
+    # to keep that many decoders busy at once.
+    global _pool
+    global _max_pending
+    if not _pool:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        _max_pending = workers * PENDING_PER_WORKER
+
+
+def stop_pool():
+    global _pool
+    if _pool:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def get_gain(song_id, file, audio_hash=None):
+    """
+    Returns the song's gain, or None if it has been queued for analysis and will be
+    written by backfill().  audio_hash can be passed in if it was already computed.
+    """
+    if config.has("disable_replaygain") and config.get("disable_replaygain"):
+        return "0.0 dB"
+
+    stat = os.stat(file)
+    file_size = stat.st_size
+    file_mtime = int(stat.st_mtime)
+    gain, audio_hash = _get_cached_gain(file, file_size, file_mtime, audio_hash)
+    if gain:
+        return gain
+
+    if _pool:
+        while len(_pending) >= _max_pending:
+            concurrent.futures.wait(
+                _pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            _write_finished()
+        future = _pool.submit(get_gain_for_song, file)
+        _pending[future] = (song_id, file, file_size, file_mtime, audio_hash)
+        return None
+
+    gain = get_gain_for_song(file)
+    _save_cached_gain(audio_hash, file, file_size, file_mtime, gain)
+    return gain
+
+
+def backfill(wait=False):
+    """
+    Writes finished analyses to their songs and the cache.  Returns a list of
+    (filename, exception) for analyses that failed.
+    """
+    if wait and _pending:
+        concurrent.futures.wait(_pending)
+    _write_finished()
+    failed = _failed[:]
+    del _failed[:]
+    return failed
+
+
+def _write_finished():
+    for future in [future for future in _pending if future.done()]:
+        song_id, file, file_size, file_mtime, audio_hash = _pending.pop(future)
+        try:
+            gain = future.result()
+        except Exception as e:
+            log.warn("replaygain", "Could not analyse %s: %s" % (file, e))
+            _failed.append((file, e))
+            continue
+        db.c.update(
+            "UPDATE r4_songs SET song_replay_gain = %s WHERE song_id = %s",
+            (gain, song_id),
+        )
+        _save_cached_gain(audio_hash, file, file_size, file_mtime, gain)
+
 
 def get_gain_for_song(file):
     if config.has("disable_replaygain") and config.get("disable_replaygain"):
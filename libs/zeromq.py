@@ -9,38 +9,166 @@ try:
 except ImportError:
     import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 _pub = None
 _sub_stream = None
+_sub_callback = None
+
+# Every publish goes out as a two-frame [topic, payload] message.  Topics look like
+# b"<sid>/<action>" (b"*/<action>" for messages without a station) so subscribers can
+# filter by prefix with ZMQ subscriptions instead of decoding everything.  The
+# payload is b"m" + a stream of msgpack objects, or b"j" + newline-separated JSON.
+# msgpack is only used when zeromq_msgpack is on, so every process sharing the
+# config agrees on it regardless of what each one has installed.
+_coalesce = False
+_use_msgpack = False
+# [topic, [encoded message, ...]] runs of consecutive messages waiting for the next tick
+_pending = []
+# (action, key) -> (list, index) of the queued message a newer one supersedes
+_pending_latest = {}
+_flush_scheduled = False
+
+# Actions where only the newest message for the same key is worth delivering
+_coalesce_keys = {
+    "update_all": "sid",
+    "update_dj": "sid",
+    "update_user": "user_id",
+    "update_ip": "ip",
+    "update_listen_key": "listen_key",
+}
 
 ioloop.install()
 
 
+def _load_format():
+    global _use_msgpack
+    _use_msgpack = config.has("zeromq_msgpack") and config.get("zeromq_msgpack")
+    if _use_msgpack and not msgpack:
+        raise Exception("zeromq_msgpack is enabled but msgpack is not installed.")
+
+
 def init_pub():
     global _pub
+    global _coalesce
+    _load_format()
     context = zmq.Context()
     _pub = context.socket(zmq.PUB)
     _pub.connect(config.get("zeromq_pub"))
+    _coalesce = config.has("zeromq_coalesce") and config.get("zeromq_coalesce")
 
 
-def init_sub():
+def init_sub(topics=None):
     global _sub_stream
+    _load_format()
     context = zmq.Context()
     sub = context.socket(zmq.SUB)
     sub.connect(config.get("zeromq_sub"))
-    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    if not topics:
+        topics = [""]
+        if config.has("zeromq_sub_topics") and config.get("zeromq_sub_topics"):
+            topics = config.get("zeromq_sub_topics")
+    for topic in topics:
+        sub.setsockopt(zmq.SUBSCRIBE, topic.encode("utf-8"))
     _sub_stream = zmqstream.ZMQStream(sub)
 
 
 def set_sub_callback(methd):
+    global _sub_callback
     if not _sub_stream:
         raise APIException("internal_error", http_code=500)
+    _sub_callback = methd
     _sub_stream.on_recv(methd)
 
 
+def drain_sub():
+    """Hands every message already waiting on the subscription to its callback, now."""
+    if not _sub_stream or not _sub_callback:
+        return
+    while True:
+        try:
+            frames = _sub_stream.socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        _sub_callback(frames)
+
+
+def get_topic(dct):
+    return ("%s/%s" % (dct.get("sid") or "*", dct.get("action"))).encode("utf-8")
+
+
+def _encode_one(dct):
+    if _use_msgpack:
+        return msgpack.packb(dct, use_bin_type=True)
+    return json.dumps(dct).encode("utf-8")
+
+
+def _frame(encoded_messages):
+    if _use_msgpack:
+        return b"m" + b"".join(encoded_messages)
+    return b"j" + b"\n".join(encoded_messages)
+
+
+def decode(frames):
+    payload = frames[-1]
+    if payload[:1] == b"m":
+        if not msgpack:
+            raise Exception(
+                "Received a msgpack ZeroMQ message but msgpack is not installed."
+            )
+        unpacker = msgpack.Unpacker(raw=False, strict_map_key=False)
+        unpacker.feed(payload[1:])
+        return list(unpacker)
+    return [json.loads(line) for line in payload[1:].split(b"\n")]
+
+
 def publish(dct):
+    global _flush_scheduled
+
     if not _pub:
         raise APIException("internal_error", http_code=500)
-    _pub.send_string(json.dumps(dct))
+    topic = get_topic(dct)
+    # encode right away, callers are free to keep modifying dct afterwards
+    encoded = _encode_one(dct)
+    if not _coalesce:
+        _pub.send_multipart([topic, _frame([encoded])])
+        return
+
+    action = dct.get("action")
+    latest_key = None
+    if action in _coalesce_keys:
+        latest_key = (action, dct.get(_coalesce_keys[action]))
+        if latest_key in _pending_latest:
+            # drop the stale copy and queue this one at the tail, so it still goes
+            # out after anything published between the two
+            run, index = _pending_latest[latest_key]
+            run[index] = None
+    if not _pending or _pending[-1][0] != topic:
+        _pending.append((topic, []))
+    run = _pending[-1][1]
+    run.append(encoded)
+    if latest_key:
+        _pending_latest[latest_key] = (run, len(run) - 1)
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        ioloop.IOLoop.current().add_callback(flush)
+
+
+def flush():
+    global _pending
+    global _flush_scheduled
+
+    pending = _pending
+    _pending = []
+    _pending_latest.clear()
+    _flush_scheduled = False
+    for topic, encoded_messages in pending:
+        encoded_messages = [encoded for encoded in encoded_messages if encoded]
+        if encoded_messages:
+            _pub.send_multipart([topic, _frame(encoded_messages)])
 
 
 def init_proxy():
@@ -156,6 +156,8 @@ class Election(event.BaseEvent):
     timed = False
     sched_id = None
     dj_user_id = None
+    # Subclasses that pick songs differently through _fill_get_song must turn this off
+    batch_fill = True
 
     @classmethod
     def load_by_id(cls, elec_id):
@@ -178,12 +180,19 @@ class Election(event.BaseEvent):
         elec.public = True
         elec.timed = False
         elec.sched_id = row["sched_id"]
-        for song_row in db.c.fetch_all(
+        song_rows = db.c.fetch_all(
             "SELECT * FROM r4_election_entries WHERE elec_id = %s", (elec_id,)
-        ):
-            try:
-                song = playlist.Song.load_from_id(song_row["song_id"], elec.sid)
-            except SongNonExistent:
+        )
+        songs = {
+            song.id: song
+            for song in playlist.Song.load_many(
+                [song_row["song_id"] for song_row in song_rows], elec.sid
+            )
+        }
+        for song_row in song_rows:
+            if song_row["song_id"] in songs:
+                song = songs[song_row["song_id"]]
+            else:
                 song = playlist.Song.load_from_id(
                     song_row["song_id"],
                     db.c.fetch_var(
@@ -237,6 +246,12 @@ class Election(event.BaseEvent):
         # ONLY RUN _ADD_REQUESTS ONCE PER FILL
         if not skip_requests:
             self._add_requests()
+        if self.batch_fill and len(self.songs) < self._num_songs:
+            try:
+                self._fill_batch(target_song_length)
+            except Exception as e:
+                log.exception("elec_fill", "Batched election fill failed.", e)
+        # Anything the batch could not fill is filled one song at a time
         for i in range(len(self.songs), self._num_songs):
             try:
                 if (
@@ -260,6 +275,7 @@ class Election(event.BaseEvent):
                 log.exception("elec_fill", "Song failed to fill in an election.", e)
         if len(self.songs) == 0:
             raise ElectionEmptyException
+        requesters = []
         for song in self.songs:
             if (
                 "elec_request_user_id" in song.data
@@ -272,11 +288,35 @@ class Election(event.BaseEvent):
                 )
                 u = User(song.data["elec_request_user_id"])
                 u.put_in_request_line(u.get_tuned_in_sid())
-        request.update_line(self.sid)
+                requesters.append(u.id)
+        # the songs, their albums and groups are election blocked now, so anyone with them at the top of their requests moves on too
+        request.refresh_line(self.sid, requesters, [song.id for song in self.songs])
 
     def _fill_get_song(self, target_song_length):
         return playlist.get_random_song_timed(self.sid, target_song_length)
 
+    def _fill_batch(self, target_song_length):
+        if (
+            not target_song_length
+            and len(self.songs) > 0
+            and "length" in self.songs[0].data
+        ):
+            target_song_length = self.songs[0].data["length"]
+        songs = playlist.get_random_songs_for_election(
+            self.sid, self._num_songs - len(self.songs), target_song_length
+        )
+        log.debug(
+            "elec_fill",
+            "Batch filled %s of %s songs."
+            % (len(songs), self._num_songs - len(self.songs)),
+        )
+        for song in songs:
+            song.data["entry_votes"] = 0
+            song.data["entry_type"] = ElecSongTypes.normal
+            song.data["elec_request_user_id"] = 0
+            song.data["elec_request_username"] = None
+        self.add_songs(songs)
+
     def add_song(self, song):
         if not song:
             return False
@@ -302,8 +342,59 @@ class Election(event.BaseEvent):
             self.sid, config.get_station(self.sid, "num_planned_elections") + 1
         )
         self.songs.append(song)
+        # its album and groups are blocked too, whether it was requested or not
+        requester_ids = []
         if song.data["entry_type"] == ElecSongTypes.request:
-            request.update_line(self.sid)
+            requester_ids.append(song.data.get("elec_request_user_id"))
+        request.refresh_line(self.sid, requester_ids, [song.id])
+        return True
+
+    def add_songs(self, songs):
+        """
+        Same as add_song for each song, with one round trip each for entry IDs,
+        entry rows, and each kind of election block.
+        """
+        songs = [song for song in songs if song]
+        if not songs:
+            return False
+        entry_ids = db.c.get_next_ids("r4_election_entries", "entry_id", len(songs))
+        values = []
+        for position, (song, entry_id) in enumerate(
+            zip(songs, entry_ids), len(self.songs)
+        ):
+            song.data["entry_id"] = entry_id
+            song.data["entry_position"] = position
+            if not "entry_type" in song.data:
+                song.data["entry_type"] = ElecSongTypes.normal
+            if not "entry_votes" in song.data:
+                song.data["entry_votes"] = 0
+            values += [
+                entry_id,
+                song.id,
+                self.id,
+                position,
+                song.data["entry_type"],
+                song.data["entry_votes"],
+            ]
+        db.c.update(
+            "INSERT INTO r4_election_entries (entry_id, song_id, elec_id, entry_position, entry_type, entry_votes) VALUES "
+            + ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(songs)),
+            values,
+        )
+        playlist.Song.start_election_block_many(
+            self.sid, songs, config.get_station(self.sid, "num_planned_elections") + 1
+        )
+        self.songs.extend(songs)
+        # their albums and groups are blocked too, whether they were requested or not
+        request.refresh_line(
+            self.sid,
+            [
+                song.data.get("elec_request_user_id")
+                for song in songs
+                if song.data["entry_type"] == ElecSongTypes.request
+            ],
+            [song.id for song in songs],
+        )
         return True
 
     def prepare_event(self):
@@ -553,15 +644,15 @@ class Election(event.BaseEvent):
             )
         self.has_priority = priority
 
-    def to_dict(self, user=None, check_rating_acl=False):
-        obj = super(Election, self).to_dict(user)
+    def to_dict(self, user=None, check_rating_acl=False, ratings=None):
+        obj = super(Election, self).to_dict(user, ratings=ratings)
         obj["used"] = self.used
         obj["length"] = self.length()
         obj["songs"] = []
         for song in self.songs:
             if check_rating_acl and user and not user.is_anonymous():
                 song.check_rating_acl(user)
-            obj["songs"].append(song.to_dict(user))
+            obj["songs"].append(song.to_dict(user, ratings))
         return obj
 
     def has_entry_id(self, entry_id):
@@ -587,8 +678,10 @@ class Election(event.BaseEvent):
 
     def add_vote_to_entry(self, entry_id, addition=1):
         # I hope you've verified this entry belongs to this event, cause I don't do that here.. :)
-        return db.c.update(
-            "UPDATE r4_election_entries SET entry_votes = entry_votes + %s WHERE entry_id = %s",
+        # Returns the entry's new vote count and the ID of the transaction that changed it,
+        # or None if the entry doesn't exist.
+        return db.c.fetch_row(
+            "UPDATE r4_election_entries SET entry_votes = entry_votes + %s WHERE entry_id = %s RETURNING entry_votes, txid_current() AS txid",
             (addition, entry_id),
         )
 
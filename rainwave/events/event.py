@@ -316,7 +316,7 @@ class BaseEvent:
             )
             return 0
 
-    def to_dict(self, user=None, check_rating_acl=False):
+    def to_dict(self, user=None, check_rating_acl=False, ratings=None):
         obj = {
             "id": self.id,
             "start": self.start,
@@ -340,7 +340,7 @@ class BaseEvent:
             for song in self.songs:
                 if check_rating_acl:
                     song.check_rating_acl(user)
-                obj["songs"].append(song.to_dict(user))
+                obj["songs"].append(song.to_dict(user, ratings))
         return obj
 
     def delete(self):
@@ -1,3 +1,4 @@
+import copy
 import random
 from time import time as timestamp
 
@@ -5,6 +6,7 @@ from libs import db
 from libs import config
 from rainwave import playlist
 from rainwave.events import event
+from rainwave.playlist_objects.song import SongNonExistent
 
 
 @event.register_producer
@@ -167,11 +169,26 @@ class OneUpProducer(event.BaseProducer):
 
     def load_all_songs(self):
         self.songs = []
-        for song_row in db.c.fetch_all(
+        song_rows = db.c.fetch_all(
             "SELECT * FROM r4_one_ups WHERE sched_id = %s ORDER BY one_up_order",
             (self.id,),
-        ):
-            s = playlist.Song.load_from_id(song_row["song_id"], song_row["one_up_sid"])
+        )
+        song_ids_by_sid = {}
+        for song_row in song_rows:
+            song_ids_by_sid.setdefault(song_row["one_up_sid"], []).append(
+                song_row["song_id"]
+            )
+        identity_map = {}
+        songs = {}
+        for sid, song_ids in song_ids_by_sid.items():
+            for song in playlist.Song.load_many(song_ids, sid, identity_map):
+                songs[(sid, song.id)] = song
+        for song_row in song_rows:
+            if (song_row["one_up_sid"], song_row["song_id"]) not in songs:
+                raise SongNonExistent
+            # A song can be in a OneUp more than once, each needs its own data
+            s = copy.copy(songs[(song_row["one_up_sid"], song_row["song_id"])])
+            s.data = copy.copy(s.data)
             s.data["one_up_used"] = song_row["one_up_used"]
             s.data["one_up_queued"] = song_row["one_up_queued"]
             s.data["one_up_id"] = song_row["one_up_id"]
@@ -12,5 +12,7 @@ class ShortestElectionProducer(election.ElectionProducer):
 
 
 class ShortestElection(election.Election):
+    batch_fill = False
+
     def _fill_get_song(self, target_song_length):
         return playlist.get_shortest_song(self.sid)
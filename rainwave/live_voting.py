@@ -0,0 +1,143 @@
+from libs import cache
+from libs import config
+from libs import db
+from libs import zeromq
+
+# Each API process keeps the live vote tallies of every station in memory.  They
+# are rebuilt only when the schedule version changes: from r4_election_entries, or
+# from the backend's "live_voting" cache key when the backend owns the tallies.
+# In between, votes arrive over ZeroMQ and are applied here instead of
+# re-SELECTing the entries.  API processes publish (elec_id, entry_id, +1/-1, txid)
+# increments, since their messages can arrive in any order; the tally service is
+# the only publisher when enabled and sends absolute entry_votes.  txid is the
+# Postgres transaction that changed the entry.  A rebuild from r4_election_entries
+# keeps the transaction snapshot it read with, and increments from transactions
+# that snapshot already saw are skipped rather than counted twice.
+#
+# Changes are handed out to websockets as deltas numbered by a per-station
+# sequence.  A snapshot always carries the sequence it is current as of, so a
+# client that sees a gap (or reconnects, possibly to another process) asks for
+# a snapshot and carries on from there.
+
+# sid -> {elec_id: {entry_id: {"entry_id", "entry_votes", "song_id"}}}
+_tallies = {}
+# sid -> schedule version the tallies were rebuilt for
+_versions = {}
+# sid -> (xmin, xmax, in-progress txids) of the snapshot the tallies were read in
+_snapshots = {}
+# sid -> sequence number of the last delta handed out
+_seqs = {}
+# sid -> {(elec_id, entry_id): entry_votes} applied but not yet handed out
+_pending = {}
+
+
+def publish(sid, changes, delayed=False, increments=False):
+    zeromq.publish(
+        {
+            "action": "live_voting_delta",
+            "sid": sid,
+            "changes": changes,
+            "delayed": delayed,
+            "increments": increments,
+        }
+    )
+
+
+def _parse_snapshot(snapshot):
+    xmin, xmax, xip = snapshot.split(":")
+    return (int(xmin), int(xmax), set(int(txid) for txid in xip.split(",") if txid))
+
+
+def _seen_by_snapshot(sid, txid):
+    snapshot = _snapshots.get(sid)
+    if not snapshot or txid is None:
+        return False
+    xmin, xmax, xip = snapshot
+    return txid < xmin or (txid < xmax and not txid in xip)
+
+
+def _fetch_tallies(sid):
+    """Returns the tallies and the transaction snapshot they were read in, if any."""
+    # with the tally service off, the database is always current
+    if config.has("vote_tally_service") and config.get("vote_tally_service"):
+        return (cache.get_station(sid, "live_voting") or {}, None)
+    elec_ids = [
+        event.id
+        for event in cache.get_schedule_snapshot(sid).next or []
+        if event.is_election
+    ]
+    tallies = {elec_id: [] for elec_id in elec_ids}
+    snapshot = None
+    if elec_ids:
+        for row in db.c.fetch_all(
+            "SELECT elec_id, entry_id, entry_votes, song_id, txid_current_snapshot()::text AS snapshot "
+            "FROM r4_election_entries WHERE elec_id IN %s",
+            (tuple(elec_ids),),
+        ):
+            snapshot = row.pop("snapshot")
+            tallies[row.pop("elec_id")].append(row)
+    return (tallies, _parse_snapshot(snapshot) if snapshot else None)
+
+
+def load(sid, version=None):
+    if version is not None and sid in _tallies and _versions.get(sid) == version:
+        return
+    fetched, snapshot = _fetch_tallies(sid)
+    tallies = {}
+    for elec_id, entries in fetched.items():
+        tallies[int(elec_id)] = {
+            entry["entry_id"]: dict(entry) for entry in entries or []
+        }
+    _tallies[sid] = tallies
+    _versions[sid] = version
+    _snapshots[sid] = snapshot
+    _pending[sid] = {}
+    _seqs.setdefault(sid, 0)
+
+
+def _get_tallies(sid):
+    if not sid in _tallies:
+        load(sid)
+    return _tallies[sid]
+
+
+def apply(sid, changes, increments=False):
+    tallies = _get_tallies(sid)
+    for change in changes:
+        elec_id, entry_id, votes = change[:3]
+        # votes that raced their election's start are not worth tracking
+        if not elec_id in tallies or not entry_id in tallies[elec_id]:
+            continue
+        entry = tallies[elec_id][entry_id]
+        if increments:
+            # already part of what the tallies were rebuilt from
+            if len(change) > 3 and _seen_by_snapshot(sid, change[3]):
+                continue
+            entry["entry_votes"] += votes
+        else:
+            entry["entry_votes"] = votes
+        _pending[sid][(elec_id, entry_id)] = entry["entry_votes"]
+
+
+def take_delta(sid):
+    if not _pending.get(sid):
+        return None
+    _seqs[sid] += 1
+    changes = [
+        [elec_id, entry_id, entry_votes]
+        for (elec_id, entry_id), entry_votes in _pending[sid].items()
+    ]
+    _pending[sid] = {}
+    return {"seq": _seqs[sid], "changes": changes}
+
+
+def get_seq(sid):
+    _get_tallies(sid)
+    return _seqs[sid]
+
+
+def get_snapshot(sid):
+    return {
+        elec_id: list(entries.values())
+        for elec_id, entries in _get_tallies(sid).items()
+    }
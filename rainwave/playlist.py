@@ -7,6 +7,7 @@ from libs import config
 
 from rainwave.playlist_objects.song import Song
 from rainwave.playlist_objects import cooldown
+from rainwave.playlist_objects import songpool
 
 # These sorts of single-function imports are to make sure
 # that any non-refactored code works with the way this module used to be.
@@ -16,6 +17,8 @@ from rainwave.playlist_objects import cooldown
 from rainwave.playlist_objects.album import Album
 from rainwave.playlist_objects.album import warm_cooled_albums
 from rainwave.playlist_objects.album import get_updated_albums_dict
+from rainwave.playlist_objects.album import refresh_art_index
+from rainwave.playlist_objects.album import add_to_art_index
 from rainwave.playlist_objects.artist import Artist
 from rainwave.playlist_objects.songgroup import SongGroup
 from rainwave.playlist_objects.cooldown import prepare_cooldown_algorithm
@@ -58,6 +61,35 @@ def get_average_song_length(sid):
     return cooldown.cooldown_config[sid]["average_song_length"]
 
 
+def _load_pool_song(sid, song_id):
+    """
+    Loads a song picked from the in-memory song pool.  The row loaded from the
+    database doubles as a check that the pool is current; if the song turns out
+    to be unavailable, the pool is corrected and None is returned so the caller
+    can fall back to SQL.
+    """
+    song = Song.load_from_id(song_id, sid)
+    if not _check_pool_song(sid, song):
+        return None
+    return song
+
+
+def _check_pool_song(sid, song):
+    songpool.sync_song(sid, song.id, song.data)
+    if (
+        song.data.get("cool")
+        or song.data.get("elec_blocked")
+        or song.data.get("request_only")
+        or not song.data.get("exists", True)
+    ):
+        log.warn(
+            "song_select",
+            "Song pool for SID %s was out of date for song ID %s." % (sid, song.id),
+        )
+        return False
+    return True
+
+
 def get_random_song_timed(sid, target_seconds=None, target_delta=None):
     """
     Fetch a random song abiding by all election block, request block, and
@@ -68,6 +100,31 @@ def get_random_song_timed(sid, target_seconds=None, target_delta=None):
         return get_random_song(sid)
     if not target_delta:
         target_delta = config.get_station(sid, "song_lookup_length_delta")
+    lower_target_bound = target_seconds - (target_delta / 2)
+    upper_target_bound = target_seconds + (target_delta / 2)
+
+    pool = songpool.get(sid)
+    if pool:
+        log.info(
+            "song_select",
+            "Song pool size (cooldown, blocks, requests, timed) [target %s delta %s]: %s"
+            % (
+                target_seconds,
+                target_delta,
+                pool.count_timed(lower_target_bound, upper_target_bound),
+            ),
+        )
+        song_id = pool.random_song_id_timed(lower_target_bound, upper_target_bound)
+        if not song_id:
+            log.warn(
+                "song_select",
+                "No songs available in song pool with target_seconds %s and target_delta %s."
+                % (target_seconds, target_delta),
+            )
+            return get_random_song(sid)
+        song = _load_pool_song(sid, song_id)
+        if song:
+            return song
 
     sql_query = (
         "FROM r4_song_sid "
@@ -81,8 +138,6 @@ def get_random_song_timed(sid, target_seconds=None, target_delta=None):
         "AND song_request_only = FALSE "
         "AND song_length >= %s AND song_length <= %s"
     )
-    lower_target_bound = target_seconds - (target_delta / 2)
-    upper_target_bound = target_seconds + (target_delta / 2)
     num_available = db.c.fetch_var(
         "SELECT COUNT(r4_song_sid.song_id) " + sql_query,
         (sid, lower_target_bound, upper_target_bound),
@@ -113,12 +168,119 @@ def get_random_song_timed(sid, target_seconds=None, target_delta=None):
         return Song.load_from_id(song_id, sid)
 
 
+def _election_candidates_sql(
+    sid, limit, lower_target_bound=None, upper_target_bound=None
+):
+    # One random song per album, since songs sharing an album can't share an election
+    sql_query = (
+        "SELECT DISTINCT ON (r4_songs.album_id) r4_song_sid.song_id, r4_songs.album_id, song_length "
+        "FROM r4_song_sid "
+        "JOIN r4_songs USING (song_id) "
+        "JOIN r4_album_sid ON (r4_album_sid.album_id = r4_songs.album_id AND r4_album_sid.sid = r4_song_sid.sid) "
+        "WHERE r4_song_sid.sid = %s "
+        "AND song_exists = TRUE "
+        "AND song_cool = FALSE "
+        "AND song_elec_blocked = FALSE "
+        "AND album_requests_pending IS NULL "
+        "AND song_request_only = FALSE "
+    )
+    params = [sid]
+    if lower_target_bound is not None:
+        sql_query += "AND song_length >= %s AND song_length <= %s "
+        params += [lower_target_bound, upper_target_bound]
+    sql_query += "ORDER BY r4_songs.album_id, RANDOM()"
+    return db.c.fetch_all(
+        "SELECT * FROM (" + sql_query + ") AS candidates ORDER BY RANDOM() LIMIT %s",
+        params + [limit],
+    )
+
+
+def get_random_songs_for_election(
+    sid, num_songs, target_seconds=None, target_delta=None
+):
+    """
+    Fetch up to num_songs songs for one election in a fixed number of queries,
+    abiding by all election block, request block, and availability rules.  No two
+    songs share an album or group, since the first of them added to the election
+    would block the rest.  Like filling an election one song at a time, the first
+    song follows target_seconds and the rest are aligned to its length.  Fewer
+    songs are returned when not enough are available.
+    """
+    if not target_delta:
+        target_delta = config.get_station(sid, "song_lookup_length_delta")
+
+    pool = songpool.get(sid)
+    if pool:
+        song_ids = pool.random_song_ids_for_election(
+            num_songs, target_seconds, target_delta
+        )
+        return [
+            song
+            for song in Song.load_many(song_ids, sid)
+            if _check_pool_song(sid, song)
+        ]
+
+    candidates = []
+    if not target_seconds:
+        candidates = _election_candidates_sql(sid, 1)
+        if not candidates:
+            return []
+        target_seconds = candidates[0]["song_length"]
+    # Over-fetch, some candidates will share groups
+    candidates += _election_candidates_sql(
+        sid,
+        num_songs * 4,
+        target_seconds - (target_delta / 2),
+        target_seconds + (target_delta / 2),
+    )
+    if not candidates:
+        return []
+    song_group_ids = {}
+    for row in db.c.fetch_all(
+        "SELECT song_id, group_id FROM r4_song_group WHERE song_id IN %s",
+        (tuple(row["song_id"] for row in candidates),),
+    ):
+        song_group_ids.setdefault(row["song_id"], set()).add(row["group_id"])
+
+    song_ids = []
+    album_ids = set()
+    group_ids = set()
+    for row in candidates:
+        if len(song_ids) >= num_songs:
+            break
+        groups = song_group_ids.get(row["song_id"], set())
+        if (
+            row["song_id"] in song_ids
+            or row["album_id"] in album_ids
+            or group_ids & groups
+        ):
+            continue
+        song_ids.append(row["song_id"])
+        album_ids.add(row["album_id"])
+        group_ids |= groups
+    return Song.load_many(song_ids, sid)
+
+
 def get_random_song(sid):
     """
     Fetch a random song, abiding by all election block, request block, and
     availability rules.  Falls back to get_random_ignore_requests on failure.
     """
 
+    pool = songpool.get(sid)
+    if pool:
+        log.info(
+            "song_select",
+            "Song pool size (cooldown, blocks, requests): %s" % len(pool.available),
+        )
+        song_id = pool.random_song_id()
+        if not song_id:
+            log.warn("song_select", "No songs available in song pool.")
+            return get_random_song_ignore_requests(sid)
+        song = _load_pool_song(sid, song_id)
+        if song:
+            return song
+
     sql_query = (
         "FROM r4_song_sid "
         "JOIN r4_songs USING (song_id) "
@@ -154,6 +316,14 @@ def get_shortest_song(sid):
     """
     Fetch the shortest song available abiding by election block and availability rules.
     """
+    pool = songpool.get(sid)
+    if pool:
+        song_id = pool.shortest_song_id()
+        if song_id:
+            song = _load_pool_song(sid, song_id)
+            if song:
+                return song
+
     sql_query = (
         "FROM r4_song_sid "
         "JOIN r4_songs USING (song_id) "
@@ -173,6 +343,19 @@ def get_random_song_ignore_requests(sid):
     Fetch a random song abiding by election block and availability rules,
     but ignoring request blocking rules.
     """
+    pool = songpool.get(sid)
+    if pool:
+        song_id = pool.random_song_id(ignore_requests=True)
+        if not song_id:
+            log.warn(
+                "song_select",
+                "No songs available in song pool while ignoring pending requests.",
+            )
+            return get_random_song_ignore_all(sid)
+        song = _load_pool_song(sid, song_id)
+        if song:
+            return song
+
     sql_query = (
         "FROM r4_song_sid "
         "WHERE r4_song_sid.sid = %s "
@@ -204,6 +387,12 @@ def get_random_song_ignore_all(sid):
     Fetches the most stale song (longest time since it's been played) in the db,
     ignoring all availability and election block rules.
     """
+    pool = songpool.get(sid)
+    if pool:
+        song_id = pool.random_song_id_any()
+        if song_id:
+            return Song.load_from_id(song_id, sid)
+
     sql_query = "FROM r4_song_sid WHERE r4_song_sid.sid = %s AND song_exists = TRUE "
     num_available = db.c.fetch_var("SELECT COUNT(song_id) " + sql_query, (sid,))
     offset = 0
@@ -226,6 +415,7 @@ def warm_cooled_songs(sid):
     """
     Makes songs whose cooldowns have expired available again.
     """
+    songpool.warm(sid, int(timestamp()))
     db.c.update(
         "UPDATE r4_song_sid SET song_cool = FALSE WHERE sid = %s AND song_cool_end < %s AND song_cool = TRUE",
         (sid, int(timestamp())),
@@ -248,6 +438,7 @@ def remove_all_locks(sid):
         "UPDATE r4_album_sid SET album_cool = FALSE AND album_cool_lowest = 0 WHERE sid = %s"
         % sid
     )
+    songpool.reset(sid)
 
 
 def get_all_albums_list_sql(sid, user):
@@ -329,6 +520,7 @@ def get_all_groups_for_power(sid):
 
 
 def reduce_song_blocks(sid):
+    songpool.reduce_election_blocks(sid)
     db.c.update(
         "UPDATE r4_song_sid SET song_elec_blocked_num = song_elec_blocked_num - 1 WHERE song_elec_blocked = TRUE AND sid = %s",
         (sid,),
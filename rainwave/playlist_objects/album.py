@@ -4,7 +4,7 @@ from time import time as timestamp
 
 from libs import cache, config, db, log
 from rainwave import rating
-from rainwave.playlist_objects import cooldown
+from rainwave.playlist_objects import cooldown, songpool
 from rainwave.playlist_objects.metadata import (
     AssociatedMetadata,
     MetadataNotFoundError,
@@ -15,6 +15,77 @@ num_albums = {}
 updated_album_ids = {}
 max_album_ids = {}
 
+# Which art exists in album_art_file_path, as "<sid>_<album_id>" and "a_<album_id>"
+# names, so get_art_url never has to stat the art directory.  Each process scans the
+# directory once; afterwards the scanner appends what it renders to the
+# "album_art_updates" cache key and processes pick those up in refresh_art_index.
+_art_index = None
+_art_index_version = 0
+ART_UPDATES_KEPT = 1000
+
+
+def _load_art_index():
+    global _art_index
+    global _art_index_version
+
+    # take the version first so anything rendered during the scan gets re-applied
+    updates = cache.get("album_art_updates")
+    _art_index_version = updates["version"] if updates else 0
+    _art_index = set()
+    if not config.get("album_art_file_path"):
+        return
+    try:
+        with os.scandir(config.get("album_art_file_path")) as entries:
+            for entry in entries:
+                if entry.name.endswith("_320.jpg"):
+                    _art_index.add(entry.name[:-8])
+    except OSError as e:
+        log.warn("album_art", "Could not index album art: %s" % e)
+
+
+def _get_art_index():
+    if _art_index is None:
+        _load_art_index()
+    return _art_index
+
+
+def refresh_art_index():
+    global _art_index_version
+
+    if _art_index is None:
+        _load_art_index()
+        return
+    updates = cache.get("album_art_updates")
+    version = updates["version"] if updates else 0
+    if version == _art_index_version:
+        return
+    missed = version - _art_index_version
+    # missed too many updates, or the cache was reset
+    if missed < 0 or missed > len(updates["names"]):
+        _load_art_index()
+        return
+    _art_index.update(updates["names"][-missed:])
+    _art_index_version = version
+
+
+def add_to_art_index(names):
+    """Called by the scanner with the art names it has just rendered."""
+    if not names:
+        return
+
+    def append_names(updates):
+        updates = updates or {"version": 0, "names": []}
+        updates["names"] = (updates["names"] + list(names))[-ART_UPDATES_KEPT:]
+        updates["version"] += len(names)
+        return updates
+
+    # rw_scanner and the file monitor can both be rendering art at once
+    if not cache.update_global("album_art_updates", append_names):
+        log.warn("album_art", "Could not record art updates, indexes will reload.")
+        cache.set_global("album_art_updates", None)
+    if _art_index is not None:
+        refresh_art_index()
+
 
 def clear_updated_albums(sid):
     global updated_album_ids
@@ -26,6 +97,8 @@ def get_updated_albums_dict(sid):
     if not sid in updated_album_ids:
         return []
 
+    refresh_art_index()
+
     previous_newest_album = cache.get_station(sid, "newest_album")
     if not previous_newest_album:
         cache.set_station(sid, "newest_album", timestamp())
@@ -94,6 +167,35 @@ class Album(AssociatedMetadata):
         instance.sid = sid
         return instance
 
+    @classmethod
+    def load_many_from_id_sid(cls, album_ids, sid, identity_map=None):
+        """
+        Returns a dict of album_id => Album, in one query.  Albums that
+        cannot be found are left out.  Albums already in identity_map
+        are not loaded again.
+        """
+        if identity_map is None:
+            identity_map = {}
+        to_load = [
+            album_id
+            for album_id in album_ids
+            if (cls.__name__, sid, album_id) not in identity_map
+        ]
+        if to_load:
+            for row in db.c.fetch_all(
+                "SELECT r4_albums.*, album_rating, album_rating_count, album_cool, album_cool_lowest, album_cool_multiply, album_cool_override FROM r4_album_sid JOIN r4_albums USING (album_id) WHERE r4_album_sid.album_id IN %s AND r4_album_sid.sid = %s",
+                (tuple(to_load), sid),
+            ):
+                instance = cls()
+                instance._assign_from_dict(row, sid)
+                instance.sid = sid
+                identity_map[(cls.__name__, sid, instance.id)] = instance
+        return {
+            album_id: identity_map[(cls.__name__, sid, album_id)]
+            for album_id in album_ids
+            if (cls.__name__, sid, album_id) in identity_map
+        }
+
     @classmethod
     def load_from_id_with_songs(cls, album_id, sid, user=None, sort=None):
         row = db.c.fetch_row(
@@ -134,15 +236,10 @@ class Album(AssociatedMetadata):
     def get_art_url(cls, album_id, sid=None):
         if not config.get("album_art_file_path"):
             return ""
-        elif sid and os.path.isfile(
-            os.path.join(
-                config.get("album_art_file_path"), "%s_%s_320.jpg" % (sid, album_id)
-            )
-        ):
+        art_index = _get_art_index()
+        if sid and "%s_%s" % (sid, album_id) in art_index:
             return "%s/%s_%s" % (config.get("album_art_url_path"), sid, album_id)
-        elif os.path.isfile(
-            os.path.join(config.get("album_art_file_path"), "a_%s_320.jpg" % album_id)
-        ):
+        elif "a_%s" % album_id in art_index:
             return "%s/a_%s" % (config.get("album_art_url_path"), album_id)
         return ""
 
@@ -282,9 +379,18 @@ class Album(AssociatedMetadata):
         if sid == 0:
             return
 
-        if cool_time:
-            pass
-        elif self.data["cool_override"]:
+        if not cool_time:
+            cool_time = self.get_cool_time(sid)
+        updated_album_ids[sid][self.id] = True
+        log.debug(
+            "cooldown",
+            "Album ID %s Station ID %s cool_time period: %s"
+            % (self.id, sid, cool_time),
+        )
+        self._start_cooldown_db(sid, cool_time)
+
+    def get_cool_time(self, sid):
+        if self.data["cool_override"]:
             cool_time = self.data["cool_override"]
         else:
             cool_rating = self.rating_precise
@@ -350,13 +456,7 @@ class Album(AssociatedMetadata):
                     cool_time,
                 ),
             )
-        updated_album_ids[sid][self.id] = True
-        log.debug(
-            "cooldown",
-            "Album ID %s Station ID %s cool_time period: %s"
-            % (self.id, sid, cool_time),
-        )
-        self._start_cooldown_db(sid, cool_time)
+        return cool_time
 
     def _start_cooldown_db(self, sid, cool_time):
         cool_end = int(cool_time + timestamp())
@@ -378,6 +478,7 @@ class Album(AssociatedMetadata):
             "AND song_request_only_end IS NOT NULL",
             (request_only_end, self.id, sid, cool_end),
         )
+        songpool.start_album_cooldown(sid, self.id, cool_end, request_only_end)
 
     def solve_cool_lowest(self, sid):
         self.data["cool_lowest"] = (
@@ -398,6 +499,7 @@ class Album(AssociatedMetadata):
         return self.data["cool_lowest"]
 
     def update_rating(self):
+        aggregates_before = cooldown.get_aggregate_contributions([self.id])
         for sid in db.c.fetch_list(
             "SELECT sid FROM r4_album_sid WHERE album_id = %s AND album_exists = TRUE",
             (self.id,),
@@ -436,6 +538,9 @@ class Album(AssociatedMetadata):
                     "UPDATE r4_album_sid SET album_rating = %s, album_rating_count = %s WHERE album_id = %s AND sid = %s",
                     (self.rating_precise, potential_points, self.id, sid),
                 )
+        cooldown.update_aggregates(
+            aggregates_before, cooldown.get_aggregate_contributions([self.id])
+        )
 
     def update_last_played(self, sid):
         return db.c.update(
@@ -444,17 +549,16 @@ class Album(AssociatedMetadata):
         )
 
     def get_all_ratings(self, sid):
+        # only users with a rating or fave row, everyone else is unrated
         table = db.c.fetch_all(
             "SELECT "
-            "phpbb_users.user_id AS user_id, "
+            "user_id, "
             "album_rating_user, "
             "album_rating_complete, "
             "album_fave "
             "FROM "
-            "phpbb_users "
-            "LEFT JOIN r4_album_ratings ON (r4_album_ratings.user_id = phpbb_users.user_id AND r4_album_ratings.album_id = %s AND sid = %s) "
-            "LEFT JOIN r4_album_faves ON (r4_album_faves.user_id = phpbb_users.user_id AND r4_album_faves.album_id = %s) "
-            "WHERE phpbb_users.radio_inactive = FALSE",
+            "(SELECT user_id, album_rating_user, album_rating_complete FROM r4_album_ratings WHERE album_id = %s AND sid = %s) AS ratings "
+            "FULL OUTER JOIN (SELECT user_id, album_fave FROM r4_album_faves WHERE album_id = %s) AS faves USING (user_id)",
             (self.id, sid, self.id),
         )
         all_ratings = {}
@@ -493,6 +597,9 @@ class Album(AssociatedMetadata):
                 "  ON CONFLICT DO NOTHING",
                 (num_songs, self.id, sid),
             )
+        # Overlays rebuilt before the rewrite would pin the old ratings, so
+        # only bump the generation once the new rows are in place.
+        rating.invalidate_album_overlays()
 
     def reset_user_completed_flags(self):
         db.c.update(
@@ -508,6 +615,7 @@ class Album(AssociatedMetadata):
             "WHERE r4_album_ratings.album_id = status.album_id AND r4_album_ratings.sid = status.sid AND r4_album_ratings.user_id = status.user_id ",
             (self.id,),
         )
+        rating.invalidate_album_overlays()
 
     def _start_election_block_db(self, sid, num_elections):
         # refer to song.set_election_block for base SQL
@@ -518,6 +626,7 @@ class Album(AssociatedMetadata):
             "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_elec_blocked_num <= %s",
             ("album", num_elections, self.id, sid, num_elections),
         )
+        songpool.set_album_election_block(sid, self.id, num_elections)
 
     def load_extra_detail(self, sid, get_all_groups=False):
         global num_albums
@@ -608,14 +717,14 @@ class Album(AssociatedMetadata):
             (count, self.id, sid),
         )
 
-    def to_dict(self, user=None):
+    def to_dict(self, user=None, ratings=None):
         d = {}
         d["id"] = self.id
         for v in ["rating", "art", "name"]:
             d[v] = self.data[v]
 
         if user:
-            d.update(rating.get_album_rating(self.sid, self.id, user.id))
+            d.update((ratings or rating).get_album_rating(self.sid, self.id, user.id))
         else:
             d["rating_user"] = None
             d["fave"] = None
@@ -1,30 +1,31 @@
 from time import time as timestamp
 import math
 
+from libs import cache
 from libs import config
 from libs import log
 from libs import db
+from rainwave.playlist_objects import songpool
 
 cooldown_config = {}
 
 
-def prepare_cooldown_algorithm(sid):
-    """
-    Prepares pre-calculated variables that relate to calculating cooldown.
-    Should pull all variables fresh from the DB, for algorithm
-    refer to jfinalfunk.
-    """
-    global cooldown_config
+# Aggregates are recomputed from scratch after this many seconds, which also
+# corrects any floating point drift from the incremental updates in update_aggregates
+AGGREGATES_MAX_AGE = 3600
 
-    if not sid in cooldown_config:
-        cooldown_config[sid] = {"time": 0}
-    if cooldown_config[sid]["time"] > (timestamp() - 3600):
-        return
 
+def compute_aggregates(sid):
+    """
+    Runs the aggregate queries behind the cooldown algorithm and publishes
+    the raw sums through the cache, where every process picks them up.
+    """
     # Variable names from here on down are from jf's proposal at: http://rainwave.cc/forums/viewtopic.php?f=13&t=1267
-    sum_aasl = db.c.fetch_var(
-        "SELECT SUM(aasl) FROM ("
-        "SELECT AVG(song_length) AS aasl "
+    album_sums = db.c.fetch_row(
+        "SELECT SUM(aasl) AS sum_aasl, SUM(multiply_aasl) AS sum_multiply_aasl, SUM(rating_aasl) AS sum_rating_aasl FROM ("
+        "SELECT AVG(song_length) AS aasl, "
+        "AVG(album_cool_multiply) * AVG(song_length) AS multiply_aasl, "
+        "AVG(album_rating) * AVG(song_length) AS rating_aasl "
         "FROM r4_album_sid "
         "JOIN r4_songs USING (album_id) "
         "JOIN r4_song_sid USING (song_id) "
@@ -32,21 +33,140 @@ def prepare_cooldown_algorithm(sid):
         "GROUP BY r4_album_sid.album_id) AS jfiscrazy",
         (sid,),
     )
+    album_ratings = db.c.fetch_row(
+        "SELECT SUM(album_rating) AS album_rating_sum, COUNT(album_rating) AS album_rating_count FROM r4_album_sid WHERE r4_album_sid.sid = %s AND r4_album_sid.album_exists = TRUE",
+        (sid,),
+    )
+    song_sums = db.c.fetch_row(
+        "SELECT SUM(song_length) AS song_length_sum, COUNT(song_length) AS song_length_count, COUNT(song_id) AS number_songs FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE song_exists = TRUE AND sid = %s",
+        (sid,),
+    )
+    aggregates = {"time": int(timestamp())}
+    for row in (album_sums, album_ratings, song_sums):
+        for key, value in (row or {}).items():
+            aggregates[key] = float(value or 0)
+    cache.set_station(sid, "cooldown_aggregates", aggregates)
+    return aggregates
+
+
+def get_aggregate_contributions(album_ids=None, song_ids=None):
+    """
+    Returns what the given albums and songs currently add to each station's
+    cooldown aggregates.  Take one before and one after changing them and
+    pass both to update_aggregates.
+    """
+    contributions = {}
+    album_ids = tuple(album_id for album_id in album_ids or [] if album_id)
+    song_ids = tuple(song_id for song_id in song_ids or [] if song_id)
+    if album_ids:
+        for row in db.c.fetch_all(
+            "SELECT r4_album_sid.sid, r4_album_sid.album_id, "
+            "AVG(song_length) AS sum_aasl, "
+            "AVG(album_cool_multiply) * AVG(song_length) AS sum_multiply_aasl, "
+            "AVG(album_rating) * AVG(song_length) AS sum_rating_aasl "
+            "FROM r4_album_sid "
+            "JOIN r4_songs USING (album_id) "
+            "JOIN r4_song_sid USING (song_id) "
+            "WHERE r4_album_sid.album_id IN %s AND r4_songs.song_verified = TRUE "
+            "GROUP BY r4_album_sid.sid, r4_album_sid.album_id",
+            (album_ids,),
+        ):
+            contributions[(row["sid"], "album", row["album_id"])] = {
+                "sum_aasl": float(row["sum_aasl"] or 0),
+                "sum_multiply_aasl": float(row["sum_multiply_aasl"] or 0),
+                "sum_rating_aasl": float(row["sum_rating_aasl"] or 0),
+            }
+        for row in db.c.fetch_all(
+            "SELECT sid, album_id, album_rating FROM r4_album_sid WHERE album_id IN %s AND album_exists = TRUE",
+            (album_ids,),
+        ):
+            contributions[(row["sid"], "album_rating", row["album_id"])] = {
+                "album_rating_sum": float(row["album_rating"]),
+                "album_rating_count": 1,
+            }
+    if song_ids:
+        for row in db.c.fetch_all(
+            "SELECT sid, song_id, song_length FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE song_id IN %s AND song_exists = TRUE",
+            (song_ids,),
+        ):
+            contributions[(row["sid"], "song", row["song_id"])] = {
+                "song_length_sum": float(row["song_length"] or 0),
+                "song_length_count": 0 if row["song_length"] is None else 1,
+                "number_songs": 1,
+            }
+    return contributions
+
+
+def update_aggregates(before, after):
+    """
+    Applies the difference between two get_aggregate_contributions calls to
+    the cached aggregates.  Stations without cached aggregates are skipped,
+    they get computed from scratch when next needed.
+    """
+    deltas = {}
+    for key in set(before) | set(after):
+        sid = key[0]
+        old = before.get(key, {})
+        new = after.get(key, {})
+        for name in set(old) | set(new):
+            change = new.get(name, 0) - old.get(name, 0)
+            if change:
+                deltas.setdefault(sid, {})
+                deltas[sid][name] = deltas[sid].get(name, 0) + change
+    for sid, delta in deltas.items():
+        if not sid in config.station_ids:
+            continue
+
+        def apply_delta(aggregates):
+            if not aggregates:
+                return None
+            for name, change in delta.items():
+                aggregates[name] += change
+            return aggregates
+
+        # The scanner, backend, and admin tools all write this key, so a plain
+        # get and set would lose each other's changes
+        if cache.update_station(sid, "cooldown_aggregates", apply_delta):
+            log.debug("cooldown", "SID %s: aggregates changed by %s" % (sid, delta))
+        else:
+            log.warn(
+                "cooldown",
+                "SID %s: could not update aggregates, recomputing them." % sid,
+            )
+            cache.set_station(sid, "cooldown_aggregates", None)
+
+
+def prepare_cooldown_algorithm(sid):
+    """
+    Prepares pre-calculated variables that relate to calculating cooldown.
+    Variables come from the aggregates published through the cache, which are
+    kept current by update_aggregates and recomputed from the DB when missing
+    or old.  For algorithm refer to jfinalfunk.
+    """
+    global cooldown_config
+
+    if not sid in cooldown_config:
+        cooldown_config[sid] = {"time": 0}
+
+    aggregates = cache.get_station(sid, "cooldown_aggregates")
+    if not aggregates or aggregates["time"] < (timestamp() - AGGREGATES_MAX_AGE):
+        aggregates = compute_aggregates(sid)
+    if cooldown_config[sid].get("aggregates") == aggregates:
+        return
+
+    sum_aasl = aggregates["sum_aasl"]
     if not sum_aasl:
         sum_aasl = 100000
     log.debug("cooldown", "SID %s: sumAASL: %s" % (sid, sum_aasl))
-    avg_album_rating = db.c.fetch_var(
-        "SELECT AVG(album_rating) FROM r4_album_sid WHERE r4_album_sid.sid = %s AND r4_album_sid.album_exists = TRUE",
-        (sid,),
-    )
-    if not avg_album_rating:
+    if aggregates["album_rating_count"]:
+        avg_album_rating = (
+            aggregates["album_rating_sum"] / aggregates["album_rating_count"]
+        )
+    else:
         avg_album_rating = 3.5
     avg_album_rating = min(max(1, avg_album_rating), 5)
     log.debug("cooldown", "SID %s: avg_album_rating: %s" % (sid, avg_album_rating))
-    multiplier_adjustment = db.c.fetch_var(
-        "SELECT SUM(tempvar) FROM (SELECT r4_album_sid.album_id, AVG(album_cool_multiply) * AVG(song_length) AS tempvar FROM r4_album_sid JOIN r4_songs USING (album_id) JOIN r4_song_sid USING (song_id) WHERE r4_album_sid.sid = %s AND r4_songs.song_verified = TRUE GROUP BY r4_album_sid.album_id) AS hooooboy",
-        (sid,),
-    )
+    multiplier_adjustment = aggregates["sum_multiply_aasl"]
     if not multiplier_adjustment:
         multiplier_adjustment = 1
     multiplier_adjustment = multiplier_adjustment / float(sum_aasl)
@@ -59,17 +179,7 @@ def prepare_cooldown_algorithm(sid):
     )
     base_album_cool = max(min(base_album_cool, 1000000), 1)
     log.debug("cooldown", "SID %s: base_album_cool: %s" % (sid, base_album_cool))
-    base_rating = db.c.fetch_var(
-        "SELECT SUM(tempvar) FROM ("
-        "SELECT r4_album_sid.album_id, AVG(album_rating) * AVG(song_length) AS tempvar "
-        "FROM r4_album_sid "
-        "JOIN r4_songs USING (album_id) "
-        "JOIN r4_song_sid USING (song_id) "
-        "WHERE r4_album_sid.sid = %s AND r4_songs.song_verified = TRUE "
-        "GROUP BY r4_album_sid.album_id"
-        ") AS hooooboy",
-        (sid,),
-    )
+    base_rating = aggregates["sum_rating_aasl"]
     if not base_rating:
         base_rating = 4
     base_rating = min(max(1, float(base_rating) / float(sum_aasl)), 5)
@@ -92,23 +202,19 @@ def prepare_cooldown_algorithm(sid):
     cooldown_config[sid]["max_album_cool"] = int(max_album_cool)
     cooldown_config[sid]["time"] = int(timestamp())
 
-    average_song_length = (
-        db.c.fetch_var(
-            "SELECT AVG(song_length) FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE song_exists = TRUE AND sid = %s",
-            (sid,),
+    if aggregates["song_length_count"]:
+        average_song_length = (
+            aggregates["song_length_sum"] / aggregates["song_length_count"]
         )
-        or 0
-    )
+    else:
+        average_song_length = 0
     log.debug(
         "cooldown", "SID %s: average_song_length: %s" % (sid, average_song_length)
     )
     cooldown_config[sid]["average_song_length"] = float(average_song_length)
     if not average_song_length:
         average_song_length = 160
-    number_songs = db.c.fetch_var(
-        "SELECT COUNT(song_id) FROM r4_song_sid WHERE song_exists = TRUE AND sid = %s",
-        (sid,),
-    )
+    number_songs = int(aggregates["number_songs"])
     if not number_songs:
         number_songs = 1
     log.debug("cooldown", "SID %s: number_songs: %s" % (sid, number_songs))
@@ -118,6 +224,120 @@ def prepare_cooldown_algorithm(sid):
     cooldown_config[sid]["min_song_cool"] = cooldown_config[sid][
         "max_song_cool"
     ] * config.get_station(sid, "cooldown_song_min_multiplier")
+    # A copy, since update_aggregates may change a locally cached dict in place
+    cooldown_config[sid]["aggregates"] = dict(aggregates)
+
+
+def get_song_cooldowns(sid, song):
+    """
+    Works out every cooldown that playing a song starts without writing anything:
+    its groups', its album's, then its own, in the order Song.start_cooldown used
+    to apply them one UPDATE at a time.  The album's cool time still reads its
+    song count from the database.
+    """
+    cooldowns = []
+    if not config.has_station(
+        sid, "cooldown_enable_for_categories"
+    ) or config.get_station(sid, "cooldown_enable_for_categories"):
+        for metadata in song.groups:
+            # Groups only cool down when they have a cooldown of their own
+            if metadata.cool_time is not None and metadata.cool_time > 0:
+                cool_end = int(metadata.cool_time + timestamp())
+                cooldowns.append(
+                    {
+                        "type": "group",
+                        "id": metadata.id,
+                        "cool_end": cool_end,
+                        "request_only_end": cool_end + 300,
+                    }
+                )
+    request_only_period = config.get_station(sid, "cooldown_request_only_period")
+    if song.album:
+        cool_end = int(song.album.get_cool_time(sid) + timestamp())
+        cooldowns.append(
+            {
+                "type": "album",
+                "id": song.album.id,
+                "cool_end": cool_end,
+                "request_only_end": cool_end + request_only_period,
+            }
+        )
+    cool_end = int(song.get_cool_time(sid) + timestamp())
+    cooldowns.append(
+        {
+            "type": "song",
+            "id": song.id,
+            "cool_end": cool_end,
+            "request_only_end": cool_end + request_only_period,
+        }
+    )
+    return cooldowns
+
+
+def apply_cooldowns(sid, cooldowns):
+    """
+    Applies cooldowns from get_song_cooldowns with one UPDATE.
+
+    Cooldowns only ever get extended.  Each song takes the longest cooldown
+    that covers it and the request-only period that came with it, except for
+    the played song itself, which always takes its own request-only period.
+    """
+    if not cooldowns:
+        return
+    for c in cooldowns:
+        log.debug(
+            "cooldown",
+            "SID %s: %s ID %s cool_end %s request_only_end %s"
+            % (sid, c["type"], c["id"], c["cool_end"], c["request_only_end"]),
+        )
+    values = []
+    for order, c in enumerate(cooldowns):
+        values += [c["type"], c["id"], c["cool_end"], c["request_only_end"], order]
+    db.c.update(
+        "WITH cooldowns (cool_type, cool_id, cool_end, request_only_end, cool_order) AS (VALUES "
+        + ", ".join(["(%s, %s, %s, %s, %s)"] * len(cooldowns))
+        + "), "
+        "song_cooldowns AS ("
+        "SELECT group_song_sid.song_id, cooldowns.* "
+        "FROM cooldowns "
+        "JOIN r4_song_group ON (cool_type = 'group' AND r4_song_group.group_id = cool_id) "
+        "JOIN r4_song_sid AS group_song_sid ON (group_song_sid.song_id = r4_song_group.song_id AND group_song_sid.sid = %s AND group_song_sid.song_exists = TRUE) "
+        "UNION ALL "
+        "SELECT r4_songs.song_id, cooldowns.* "
+        "FROM cooldowns JOIN r4_songs ON (cool_type = 'album' AND r4_songs.album_id = cool_id) "
+        "UNION ALL "
+        "SELECT cool_id AS song_id, cooldowns.* FROM cooldowns WHERE cool_type = 'song'"
+        "), "
+        "final_cooldowns AS ("
+        "SELECT DISTINCT ON (song_id) song_id, cool_type, request_only_end, "
+        "MAX(cool_end) OVER (PARTITION BY song_id) AS max_cool_end "
+        "FROM song_cooldowns "
+        "ORDER BY song_id, cool_type = 'song' DESC, cool_end DESC, cool_order DESC"
+        ") "
+        "UPDATE r4_song_sid SET "
+        "song_cool = TRUE, "
+        "song_cool_end = GREATEST(song_cool_end, max_cool_end), "
+        "song_request_only = (song_request_only OR song_request_only_end IS NOT NULL), "
+        "song_request_only_end = CASE WHEN song_request_only_end IS NULL THEN NULL ELSE final_cooldowns.request_only_end END "
+        "FROM final_cooldowns "
+        "WHERE r4_song_sid.song_id = final_cooldowns.song_id AND r4_song_sid.sid = %s "
+        "AND (cool_type = 'song' OR song_cool_end <= max_cool_end)",
+        values + [sid, sid],
+    )
+
+    for c in cooldowns:
+        if c["type"] == "group":
+            songpool.start_group_cooldown(
+                sid, c["id"], c["cool_end"], c["request_only_end"]
+            )
+        elif c["type"] == "album":
+            songpool.start_album_cooldown(
+                sid, c["id"], c["cool_end"], c["request_only_end"]
+            )
+        else:
+            songpool.start_song_cooldown(
+                sid, c["id"], c["cool_end"], c["request_only_end"]
+            )
 
 
 def get_age_cooldown_multiplier(added_on):
@@ -37,6 +37,7 @@ class AssociatedMetadata:
     select_by_name_query = None  # one %s argument: name
     select_by_id_query = None  # one %s argument: self.id
     select_by_song_id_query = None  # one %s argument: song_id
+    select_by_song_ids_query = None  # one %s argument: tuple of song_ids
     disassociate_song_id_query = None  # two %s argument: song_id, self.id
     associate_song_id_query = None  # three %s argument: song_id, self.id, is_tag
     check_self_size_query = None  # one argument: self.id
@@ -86,6 +87,34 @@ class AssociatedMetadata:
             instances.append(instance)
         return instances
 
+    @classmethod
+    def load_lists_from_song_ids(cls, song_ids, identity_map=None):
+        """
+        Returns a dict of song_id => list of instances, in one query.
+        """
+        if not song_ids:
+            return {}
+        return cls._lists_from_song_rows(
+            song_ids,
+            db.c.fetch_all(cls.select_by_song_ids_query, (tuple(song_ids),)),
+            identity_map,
+        )
+
+    @classmethod
+    def _lists_from_song_rows(cls, song_ids, rows, identity_map=None):
+        # Rows that are the same down to the song-specific columns share one
+        # instance through identity_map, which can be shared between calls.
+        if identity_map is None:
+            identity_map = {}
+        lists = {song_id: [] for song_id in song_ids}
+        for row in rows:
+            key = (cls.__name__, row["id"], row.get("is_tag"), row.get("order"))
+            if key not in identity_map:
+                identity_map[key] = cls()
+                identity_map[key]._assign_from_dict(row)
+            lists[row["song_id"]].append(identity_map[key])
+        return lists
+
     def __init__(self):
         self.id = None
         self.is_tag = False
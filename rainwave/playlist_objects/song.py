@@ -11,8 +11,8 @@ from time import time as timestamp
 from libs import cache, config, db, log, replaygain
 from mutagen.mp3 import MP3
 from rainwave import rating
-from rainwave.playlist_objects import cooldown
-from rainwave.playlist_objects.album import Album
+from rainwave.playlist_objects import cooldown, songpool
+from rainwave.playlist_objects.album import Album, updated_album_ids
 from rainwave.playlist_objects.artist import Artist
 from rainwave.playlist_objects.metadata import (
     MetadataUpdateError,
@@ -122,10 +122,72 @@ class Song:
         return s
 
     @classmethod
-    def load_from_file(cls, filename, sids):
+    def load_many(cls, song_ids, sid, identity_map=None):
+        """
+        Loads several songs for one station with a handful of set-based queries
+        rather than load_from_id's queries per song.  Songs are returned in the
+        order of song_ids; songs that do not exist on the station are left out.
+
+        Albums, artists, and groups are shared between songs through identity_map,
+        so songs from the same album share one Album.  Pass the same dict to
+        several calls to share them between calls as well.
+        """
+        if not song_ids:
+            return []
+        if identity_map is None:
+            identity_map = {}
+        rows = {
+            row["song_id"]: row
+            for row in db.c.fetch_all(
+                "SELECT * FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE r4_songs.song_id IN %s AND r4_song_sid.sid = %s",
+                (tuple(song_ids), sid),
+            )
+        }
+        song_ids = [song_id for song_id in song_ids if song_id in rows]
+        if not song_ids:
+            return []
+
+        sids = {song_id: [] for song_id in song_ids}
+        for row in db.c.fetch_all(
+            "SELECT song_id, sid FROM r4_song_sid WHERE song_id IN %s",
+            (tuple(song_ids),),
+        ):
+            sids[row["song_id"]].append(row["sid"])
+        albums = Album.load_many_from_id_sid(
+            {rows[song_id]["album_id"] for song_id in song_ids} - {None},
+            sid,
+            identity_map,
+        )
+        artists = Artist.load_lists_from_song_ids(song_ids, identity_map)
+        groups = SongGroup.load_lists_from_song_ids(
+            song_ids, sid, identity_map=identity_map
+        )
+
+        songs = []
+        for song_id in song_ids:
+            d = rows[song_id]
+            s = cls()
+            s.id = song_id
+            s.sid = sid
+            s.filename = d["song_filename"]
+            s.verified = d["song_verified"]
+            s.replay_gain = d["song_replay_gain"]
+            s.data["sids"] = sids[song_id]
+            s.data["sid"] = sid
+            s.data["rank"] = None
+            s._assign_from_dict(d)
+            s.album = albums.get(d["album_id"])
+            s.artists = artists[song_id]
+            s.groups = groups[song_id]
+            songs.append(s)
+        return songs
+
+    @classmethod
+    def load_from_file(cls, filename, sids, file_tags=None):
         """
         Produces an instance of the Song class with all album, group, and artist IDs loaded from only a filename.
         All metadata is saved to the database and updated where necessary.
+        file_tags is read_file_tags() output for the file, if it was already read elsewhere.
         """
 
         kept_artists = []
@@ -160,7 +222,13 @@ class Song:
         else:
             s = cls()
 
-        s.load_tag_from_file(filename)
+        old_album_ids = [s.album.id] if s.album else []
+        aggregates_before = cooldown.get_aggregate_contributions(old_album_ids, [s.id])
+
+        if file_tags:
+            s.assign_file_tags(filename, file_tags)
+        else:
+            s.load_tag_from_file(filename)
         s.save(sids)
 
         new_artists = Artist.load_list_from_tag(s.artist_tag)
@@ -177,6 +245,8 @@ class Song:
             metadata.associate_song_id(s.id)
 
         s.album = Album.load_from_name(s.album_tag)
+        if s.album.id not in old_album_ids:
+            aggregates_before.update(cooldown.get_aggregate_contributions([s.album.id]))
         s.album.associate_song_id(s.id)
 
         s.update_artist_parseable()
@@ -189,11 +259,20 @@ class Song:
             )
             is None
         ):
-            s.replay_gain = s.get_replay_gain()
-            db.c.update(
-                "UPDATE r4_songs SET song_replay_gain = %s WHERE song_id = %s",
-                (s.replay_gain, s.id),
+            # None here means the analysis was queued and will be backfilled
+            s.replay_gain = replaygain.get_gain(
+                s.id, filename, file_tags["audio_hash"] if file_tags else None
             )
+            if s.replay_gain:
+                db.c.update(
+                    "UPDATE r4_songs SET song_replay_gain = %s WHERE song_id = %s",
+                    (s.replay_gain, s.id),
+                )
+
+        cooldown.update_aggregates(
+            aggregates_before,
+            cooldown.get_aggregate_contributions(old_album_ids + [s.album.id], [s.id]),
+        )
 
         return s
 
@@ -288,6 +367,37 @@ class Song:
 
             self.data["length"] = int(f.info.length)
 
+    @classmethod
+    def read_file_tags(cls, filename, with_audio_hash=False):
+        """
+        Everything load_from_file needs from the file itself, read without touching the
+        database so that it can be done in a worker process.
+        """
+        s = cls()
+        # only keep what load_tag_from_file sets, so assign_file_tags won't clobber anything else
+        s.data = {}
+        s.load_tag_from_file(filename)
+        return {
+            "data": s.data,
+            "artist_tag": s.artist_tag,
+            "album_tag": s.album_tag,
+            "genre_tag": s.genre_tag,
+            "audio_hash": (
+                replaygain.get_audio_hash(filename) if with_audio_hash else None
+            ),
+        }
+
+    def assign_file_tags(self, filename, file_tags):
+        """
+        Same as load_tag_from_file, from read_file_tags() output.
+        """
+        self.filename = filename
+        self.data.update(file_tags["data"])
+        self.artist_tag = file_tags["artist_tag"]
+        self.album_tag = file_tags["album_tag"]
+        if file_tags["genre_tag"]:
+            self.genre_tag = file_tags["genre_tag"]
+
     def get_replay_gain(self):
         return replaygain.get_gain_for_song(self.filename)
 
@@ -449,6 +559,8 @@ class Song:
             log.critical("song_disable", "Tried to disable a song without a song ID.")
             return
         log.info("song_disable", "Disabling ID %s / file %s" % (self.id, self.filename))
+        album_ids = [self.album.id] if self.album else []
+        aggregates_before = cooldown.get_aggregate_contributions(album_ids, [self.id])
         db.c.update(
             "UPDATE r4_songs SET song_verified = FALSE WHERE song_id = %s", (self.id,)
         )
@@ -461,6 +573,10 @@ class Song:
         if self.groups:
             for metadata in self.groups:
                 metadata.reconcile_sids()
+        cooldown.update_aggregates(
+            aggregates_before,
+            cooldown.get_aggregate_contributions(album_ids, [self.id]),
+        )
 
     def _assign_from_dict(self, d):
         for key, val in d.items():
@@ -472,28 +588,35 @@ class Song:
             else:
                 self.data[key] = val
 
-    def start_cooldown(self, sid):
+    def start_cooldown(self, sid, dry_run=False):
         """
         Calculates cooldown based on jfinalfunk's crazy algorithms.
         Cooldown may be overriden by song_cool_* rules found in database.
         Cooldown is only applied if the song exists on the given station
+
+        Cooldowns for the song's groups, album, and the song itself are all
+        applied at once by cooldown.apply_cooldowns.  With dry_run, nothing is
+        applied and the cooldowns that would have been are returned.
         """
 
         if (self.sid != sid) or (not self.sid in self.data["sids"]) or sid == 0:
-            return
+            return []
 
-        for metadata in self.groups:
-            log.debug(
-                "song_cooldown", "Starting group cooldown on group %s" % metadata.id
-            )
-            metadata.start_cooldown(sid)
-        # Albums always have to go last since album records in the DB store cached cooldown values
+        cooldowns = cooldown.get_song_cooldowns(sid, self)
+        if dry_run:
+            return cooldowns
+
+        cooldown.apply_cooldowns(sid, cooldowns)
         if self.album:
-            log.debug(
-                "song_cooldown", "Starting album cooldown on album %s" % self.album.id
-            )
-            self.album.start_cooldown(sid)
+            updated_album_ids[sid][self.album.id] = True
 
+        self.data["cool"] = True
+        self.data["cool_end"] = cooldowns[-1]["cool_end"]
+        self.data["request_only_end"] = cooldowns[-1]["request_only_end"]
+        self.data["request_only"] = True
+        return cooldowns
+
+    def get_cool_time(self, sid):
         cool_time = cooldown.cooldown_config[sid]["max_song_cool"]
         if self.data["cool_override"]:
             cool_time = self.data["cool_override"]
@@ -519,23 +642,7 @@ class Song:
             "cooldown",
             "Song ID %s Station ID %s cool_time period: %s" % (self.id, sid, cool_time),
         )
-        cool_time = int(cool_time + timestamp())
-        db.c.update(
-            "UPDATE r4_song_sid SET song_cool = TRUE, song_cool_end = %s WHERE song_id = %s AND sid = %s AND song_cool_end < %s",
-            (cool_time, self.id, sid, cool_time),
-        )
-        self.data["cool"] = True
-        self.data["cool_end"] = cool_time
-
-        # if 'request_only_end' in self.data and self.data['request_only_end'] != None:
-        self.data["request_only_end"] = self.data["cool_end"] + config.get_station(
-            sid, "cooldown_request_only_period"
-        )
-        self.data["request_only"] = True
-        db.c.update(
-            "UPDATE r4_song_sid SET song_request_only = TRUE, song_request_only_end = %s WHERE song_id = %s AND sid = %s AND song_request_only_end IS NOT NULL",
-            (self.data["request_only_end"], self.id, sid),
-        )
+        return cool_time
 
     def start_election_block(self, sid, num_elections):
         if sid == 0:
@@ -547,11 +654,87 @@ class Song:
             self.album.start_election_block(sid, num_elections)
         self.set_election_block(sid, "in_election", num_elections)
 
+    @staticmethod
+    def start_election_block_many(sid, songs, num_elections):
+        """
+        Same as calling start_election_block on each song, but with one UPDATE
+        for all of the songs' groups, one for their albums, and one for the
+        songs themselves.  Groups, albums, then songs are blocked in that order
+        so the end result matches the one-song-at-a-time path.
+        """
+        if sid == 0 or not songs:
+            return
+
+        group_blocks = {}
+        for song in songs:
+            for metadata in song.groups:
+                if metadata.elec_block is not None:
+                    if metadata.elec_block > 0:
+                        group_blocks[metadata.id] = metadata.elec_block
+                elif num_elections:
+                    group_blocks[metadata.id] = num_elections
+        if group_blocks:
+            log.debug(
+                "elec_block",
+                "SongGroup SID %s blocking IDs %s" % (sid, group_blocks),
+            )
+            # refer to songgroup._start_election_block_db for base SQL
+            db.c.update(
+                "UPDATE r4_song_sid "
+                "SET song_elec_blocked = TRUE, song_elec_blocked_by = 'group', song_elec_blocked_num = blocks.num "
+                "FROM ("
+                "SELECT song_id, MAX(num) AS num "
+                "FROM r4_song_group JOIN (VALUES "
+                + ", ".join(["(%s, %s)"] * len(group_blocks))
+                + ") AS group_blocks (group_id, num) USING (group_id) "
+                "GROUP BY song_id"
+                ") AS blocks "
+                "WHERE r4_song_sid.song_id = blocks.song_id AND r4_song_sid.sid = %s AND song_elec_blocked_num < blocks.num",
+                [value for item in group_blocks.items() for value in item] + [sid],
+            )
+            for group_id, num in group_blocks.items():
+                songpool.set_group_election_block(sid, group_id, num)
+
+        album_ids = {song.album.id for song in songs if song.album}
+        if album_ids and num_elections:
+            log.debug(
+                "elec_block",
+                "Album SID %s blocking IDs %s for normal %s"
+                % (sid, album_ids, num_elections),
+            )
+            # refer to album._start_election_block_db for base SQL
+            db.c.update(
+                "UPDATE r4_song_sid "
+                "SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s "
+                "FROM r4_songs "
+                "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id IN %s AND sid = %s AND song_elec_blocked_num <= %s",
+                ("album", num_elections, tuple(album_ids), sid, num_elections),
+            )
+            for album_id in album_ids:
+                songpool.set_album_election_block(sid, album_id, num_elections)
+
+        db.c.update(
+            "UPDATE r4_song_sid SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s WHERE song_id IN %s AND sid = %s AND song_elec_blocked_num <= %s",
+            (
+                "in_election",
+                num_elections,
+                tuple(song.id for song in songs),
+                sid,
+                num_elections,
+            ),
+        )
+        for song in songs:
+            songpool.set_song_election_block(sid, song.id, num_elections)
+            song.data["elec_blocked_num"] = num_elections
+            song.data["elec_blocked_by"] = "in_election"
+            song.data["elec_blocked"] = True
+
     def set_election_block(self, sid, blocked_by, block_length):
         db.c.update(
             "UPDATE r4_song_sid SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s WHERE song_id = %s AND sid = %s AND song_elec_blocked_num <= %s",
             (blocked_by, block_length, self.id, sid, block_length),
         )
+        songpool.set_song_election_block(sid, self.id, block_length)
         self.data["elec_blocked_num"] = block_length
         self.data["elec_blocked_by"] = blocked_by
         self.data["elec_blocked"] = True
@@ -708,7 +891,8 @@ class Song:
                     "rating_user_count"
                 ]
 
-    def to_dict(self, user=None):
+    def to_dict(self, user=None, ratings=None):
+        # ratings: a rating.BatchRatings already holding this user's ratings, if any
         d = {}
         d["title"] = self.data["title"]
         d["id"] = self.id
@@ -726,7 +910,7 @@ class Song:
         d["albums"] = []
         d["groups"] = []
         if self.album:
-            d["albums"] = [self.album.to_dict(user)]
+            d["albums"] = [self.album.to_dict(user, ratings)]
         if self.artists:
             for metadata in self.artists:
                 d["artists"].append(metadata.to_dict(user))
@@ -738,7 +922,7 @@ class Song:
         d["fave"] = None
         d["rating_allowed"] = self.data["rating_allowed"]
         if user:
-            d.update(rating.get_song_rating(self.id, user.id))
+            d.update((ratings or rating).get_song_rating(self.id, user.id))
             if user.data["rate_anything"]:
                 d["rating_allowed"] = True
 
@@ -768,7 +952,7 @@ class Song:
 
     def get_all_ratings(self):
         table = db.c.fetch_all(
-            "SELECT song_rating_user, song_fave, user_id FROM r4_song_ratings JOIN phpbb_users USING (user_id) WHERE radio_inactive = FALSE AND song_id = %s",
+            "SELECT song_rating_user, song_fave, user_id FROM r4_song_ratings WHERE song_id = %s",
             (self.id,),
         )
         all_ratings = {}
@@ -4,6 +4,7 @@ from libs import db
 from libs import log
 from libs import config
 
+from rainwave.playlist_objects import songpool
 from rainwave.playlist_objects.metadata import AssociatedMetadata
 from rainwave.playlist_objects.metadata import make_searchable_string
 
@@ -12,6 +13,7 @@ class SongGroup(AssociatedMetadata):
     select_by_name_query = "SELECT group_id AS id, group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time FROM r4_groups WHERE lower(group_name) = lower(%s)"
     select_by_id_query = "SELECT group_id AS id, group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time FROM r4_groups WHERE group_id = %s"
     select_by_song_id_query = "SELECT r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag FROM r4_song_group JOIN r4_groups USING (group_id) WHERE song_id = %s ORDER BY group_name"
+    select_by_song_ids_query = "SELECT r4_song_group.song_id, r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag FROM r4_song_group JOIN r4_groups USING (group_id) WHERE song_id IN %s ORDER BY group_name"
     disassociate_song_id_query = (
         "DELETE FROM r4_song_group WHERE song_id = %s AND group_id = %s"
     )
@@ -50,6 +52,33 @@ class SongGroup(AssociatedMetadata):
             instances.append(instance)
         return instances
 
+    @classmethod
+    def load_lists_from_song_ids(
+        cls, song_ids, sid=None, all_categories=False, identity_map=None
+    ):
+        if not sid or not song_ids:
+            return super(SongGroup, cls).load_lists_from_song_ids(
+                song_ids, identity_map
+            )
+
+        show_all_condition = (
+            "" if all_categories else "AND r4_group_sid.group_display = TRUE"
+        )
+
+        rows = db.c.fetch_all(
+            "SELECT r4_song_sid.song_id, r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag "
+            "FROM r4_song_sid "
+            "JOIN r4_song_group USING (song_id) "
+            "JOIN r4_group_sid ON (r4_song_group.group_id = r4_group_sid.group_id AND r4_group_sid.sid = %s "
+            + show_all_condition
+            + ") "
+            "JOIN r4_groups ON (r4_group_sid.group_id = r4_groups.group_id) "
+            "WHERE r4_song_sid.song_id IN %s AND r4_song_sid.sid = %s AND song_exists = TRUE "
+            "ORDER BY r4_groups.group_name",
+            (sid, tuple(song_ids), sid),
+        )
+        return cls._lists_from_song_rows(song_ids, rows, identity_map)
+
     def associate_song_id(self, song_id, is_tag=None):
         super(SongGroup, self).associate_song_id(song_id, is_tag)
         self.reconcile_sids()
@@ -129,6 +158,7 @@ class SongGroup(AssociatedMetadata):
             "AND song_request_only_end IS NOT NULL",
             (request_only_end, self.id, sid, cool_end),
         )
+        songpool.start_group_cooldown(sid, self.id, cool_end, request_only_end)
 
     def _start_election_block_db(self, sid, num_elections):
         # refer to song.set_election_block for base SQL
@@ -140,6 +170,7 @@ class SongGroup(AssociatedMetadata):
             "r4_song_group.group_id = %s AND r4_song_sid.sid = %s AND song_elec_blocked_num < %s",
             ("group", num_elections, self.id, sid, num_elections),
         )
+        songpool.set_group_election_block(sid, self.id, num_elections)
 
     def set_elec_block(self, num_elections):
         db.c.update(
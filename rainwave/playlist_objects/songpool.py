@@ -0,0 +1,515 @@
+import bisect
+import heapq
+import random
+from array import array
+from time import time as timestamp
+
+from libs import config, db, log
+
+# Per-song flags, mirroring the availability columns of r4_song_sid and r4_album_sid
+COOL = 1
+ELEC_BLOCKED = 2
+REQUEST_ONLY = 4
+REQUESTS_PENDING = 8
+MISSING = 16
+# The song's album has no r4_album_sid row for the station.  get_random_song and
+# get_random_song_timed inner join r4_album_sid and skip these songs, the
+# request-ignoring selections don't join it and still pick them.
+NO_ALBUM_SID = 32
+
+UNAVAILABLE = (
+    COOL | ELEC_BLOCKED | REQUEST_ONLY | REQUESTS_PENDING | MISSING | NO_ALBUM_SID
+)
+UNAVAILABLE_IGNORING_REQUESTS = COOL | ELEC_BLOCKED | REQUEST_ONLY | MISSING
+
+# Pools are rebuilt from the database after this many seconds, which picks up
+# changes made outside the backend process (scanner, admin tools, etc).
+MAX_AGE = 3600
+
+# Random picks per song an election fill makes before giving up on finding
+# songs that don't share an album or group
+_ELECTION_PROBES = 8
+
+pools = {}
+
+
+class FenwickTree:
+    """
+    Binary indexed tree of 0/1 counts by song position.  Counts positions in a
+    range and finds the k-th counted position in O(log n).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = array("l", [0]) * (size + 1)
+        self._top_bit = 1 << size.bit_length()
+
+    def add(self, i, delta):
+        i += 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """
+        Number of counted positions before position i.
+        """
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k):
+        """
+        Position of the k-th (0-based) counted position.
+        """
+        pos = 0
+        bit = self._top_bit
+        while bit:
+            nxt = pos + bit
+            if nxt <= self.size and self.tree[nxt] <= k:
+                pos = nxt
+                k -= self.tree[nxt]
+            bit >>= 1
+        return pos
+
+
+class IndexSet:
+    """
+    A set of song positions with O(1) add, discard, and random choice, plus
+    O(log n) counting and random choice within a range of positions.
+    """
+
+    def __init__(self, size):
+        self.members = array("l")
+        self.positions = array("l", [-1]) * size
+        self.counts = FenwickTree(size)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, i):
+        return self.positions[i] != -1
+
+    def add(self, i):
+        if self.positions[i] == -1:
+            self.positions[i] = len(self.members)
+            self.members.append(i)
+            self.counts.add(i, 1)
+
+    def discard(self, i):
+        pos = self.positions[i]
+        if pos == -1:
+            return
+        last = self.members.pop()
+        if last != i:
+            self.members[pos] = last
+            self.positions[last] = pos
+        self.positions[i] = -1
+        self.counts.add(i, -1)
+
+    def choice(self):
+        return self.members[random.randrange(len(self.members))]
+
+    def count_range(self, start, end):
+        return self.counts.prefix(end) - self.counts.prefix(start)
+
+    def choice_in_range(self, start, end):
+        before = self.counts.prefix(start)
+        num = self.counts.prefix(end) - before
+        if num <= 0:
+            return None
+        return self.counts.find(before + random.randrange(num))
+
+    def first(self):
+        if not self.members:
+            return None
+        return self.counts.find(0)
+
+
+class SongPool:
+    """
+    Election eligibility of every song on a station, kept in memory so that
+    random song selection does not need COUNT + OFFSET queries.  Songs are
+    stored in parallel arrays ordered by song length; "positions" below are
+    indexes into those arrays.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.loaded_at = 0
+        self.song_ids = array("l")
+        self.lengths = array("l")
+        self.flags = array("B")
+        self.cool_ends = array("q")
+        # -1 stands in for a NULL song_request_only_end
+        self.request_only_ends = array("q")
+        self.elec_blocked_nums = array("l")
+        # 0 stands in for a NULL album_id
+        self.album_ids = array("l")
+        self.song_positions = {}
+        self.album_positions = {}
+        self.group_positions = {}
+        self.song_group_ids = {}
+        self.pending_album_ids = set()
+        self.existing = IndexSet(0)
+        self.available = IndexSet(0)
+        self.available_ignoring_requests = IndexSet(0)
+        self._blocked = set()
+        self._cool_heap = []
+        self._request_only_heap = []
+
+    def load(self):
+        rows = db.c.fetch_all(
+            "SELECT r4_song_sid.song_id, song_length, r4_songs.album_id, "
+            "song_cool, song_cool_end, song_elec_blocked, song_elec_blocked_num, "
+            "song_request_only, song_request_only_end, album_requests_pending, "
+            "r4_album_sid.album_id IS NULL AS no_album_sid "
+            "FROM r4_song_sid "
+            "JOIN r4_songs USING (song_id) "
+            "LEFT JOIN r4_album_sid ON (r4_album_sid.album_id = r4_songs.album_id AND r4_album_sid.sid = r4_song_sid.sid) "
+            "WHERE r4_song_sid.sid = %s AND song_exists = TRUE "
+            "ORDER BY song_length, r4_song_sid.song_id",
+            (self.sid,),
+        )
+        size = len(rows)
+        self.existing = IndexSet(size)
+        self.available = IndexSet(size)
+        self.available_ignoring_requests = IndexSet(size)
+        for i, row in enumerate(rows):
+            flags = 0
+            if row["song_cool"]:
+                flags |= COOL
+                self._cool_heap.append((row["song_cool_end"] or 0, i))
+            if row["song_elec_blocked"]:
+                flags |= ELEC_BLOCKED
+                self._blocked.add(i)
+            if row["song_request_only"]:
+                flags |= REQUEST_ONLY
+            if row["song_request_only_end"] is not None:
+                self._request_only_heap.append((row["song_request_only_end"], i))
+            if row["no_album_sid"]:
+                flags |= NO_ALBUM_SID
+            if row["album_requests_pending"]:
+                flags |= REQUESTS_PENDING
+                self.pending_album_ids.add(row["album_id"])
+            self.song_ids.append(row["song_id"])
+            self.lengths.append(row["song_length"] or 0)
+            self.flags.append(flags)
+            self.cool_ends.append(row["song_cool_end"] or 0)
+            self.request_only_ends.append(
+                -1
+                if row["song_request_only_end"] is None
+                else row["song_request_only_end"]
+            )
+            self.elec_blocked_nums.append(row["song_elec_blocked_num"] or 0)
+            self.album_ids.append(row["album_id"] or 0)
+            self.song_positions[row["song_id"]] = i
+            self.album_positions.setdefault(row["album_id"], []).append(i)
+            self.existing.add(i)
+            self._refresh(i)
+        heapq.heapify(self._cool_heap)
+        heapq.heapify(self._request_only_heap)
+
+        for row in db.c.fetch_all(
+            "SELECT r4_song_group.song_id, group_id "
+            "FROM r4_song_group JOIN r4_song_sid USING (song_id) "
+            "WHERE r4_song_sid.sid = %s AND song_exists = TRUE",
+            (self.sid,),
+        ):
+            if row["song_id"] in self.song_positions:
+                i = self.song_positions[row["song_id"]]
+                self.group_positions.setdefault(row["group_id"], []).append(i)
+                self.song_group_ids.setdefault(i, []).append(row["group_id"])
+
+        self.loaded_at = timestamp()
+        log.debug(
+            "song_pool",
+            "SID %s: loaded %s songs, %s available."
+            % (self.sid, size, len(self.available)),
+        )
+
+    def _refresh(self, i):
+        flags = self.flags[i]
+        if flags & UNAVAILABLE:
+            self.available.discard(i)
+        else:
+            self.available.add(i)
+        if flags & UNAVAILABLE_IGNORING_REQUESTS:
+            self.available_ignoring_requests.discard(i)
+        else:
+            self.available_ignoring_requests.add(i)
+        if flags & MISSING:
+            self.existing.discard(i)
+
+    def _set_flag(self, i, flag, on):
+        if on:
+            self.flags[i] |= flag
+        else:
+            self.flags[i] &= ~flag
+        self._refresh(i)
+
+    def start_cooldown(self, positions, cool_end, request_only_end, from_song=False):
+        # Mirrors the SQL: cooldowns only ever get extended.  Album and group cooldowns
+        # apply where song_cool_end <= cool_end and only make those songs request-only,
+        # a song's own cooldown uses < and always makes the song request-only.
+        for i in positions:
+            if from_song:
+                extended = self.cool_ends[i] < cool_end
+            else:
+                extended = self.cool_ends[i] <= cool_end
+            if extended:
+                self.cool_ends[i] = cool_end
+                heapq.heappush(self._cool_heap, (cool_end, i))
+                self._set_flag(i, COOL, True)
+            if (extended or from_song) and self.request_only_ends[i] != -1:
+                self.request_only_ends[i] = request_only_end
+                heapq.heappush(self._request_only_heap, (request_only_end, i))
+                self._set_flag(i, REQUEST_ONLY, True)
+
+    def start_election_block(self, positions, num_elections, from_group=False):
+        # Mirrors the SQL: group blocks apply where song_elec_blocked_num < num_elections,
+        # song and album blocks where song_elec_blocked_num <= num_elections.
+        for i in positions:
+            if from_group:
+                extended = self.elec_blocked_nums[i] < num_elections
+            else:
+                extended = self.elec_blocked_nums[i] <= num_elections
+            if extended:
+                self.elec_blocked_nums[i] = num_elections
+                self._blocked.add(i)
+                self._set_flag(i, ELEC_BLOCKED, True)
+
+    def reduce_election_blocks(self):
+        for i in list(self._blocked):
+            self.elec_blocked_nums[i] -= 1
+            if self.elec_blocked_nums[i] <= 0:
+                self.elec_blocked_nums[i] = 0
+                self._blocked.discard(i)
+                self._set_flag(i, ELEC_BLOCKED, False)
+
+    def warm(self, now):
+        while self._cool_heap and self._cool_heap[0][0] < now:
+            _cool_end, i = heapq.heappop(self._cool_heap)
+            # Stale heap entries are left behind when a cooldown gets extended
+            if self.flags[i] & COOL and self.cool_ends[i] < now:
+                self._set_flag(i, COOL, False)
+        while self._request_only_heap and self._request_only_heap[0][0] < now:
+            _request_only_end, i = heapq.heappop(self._request_only_heap)
+            if (
+                self.flags[i] & REQUEST_ONLY
+                and self.request_only_ends[i] != -1
+                and self.request_only_ends[i] < now
+            ):
+                self._set_flag(i, REQUEST_ONLY, False)
+
+    def set_requests_pending(self, album_ids):
+        album_ids = set(album_ids)
+        for album_id in self.pending_album_ids ^ album_ids:
+            for i in self.album_positions.get(album_id, []):
+                self._set_flag(i, REQUESTS_PENDING, album_id in album_ids)
+        self.pending_album_ids = album_ids
+
+    def sync_song(self, song_id, data):
+        """
+        Brings a song's entry up to date with a freshly loaded r4_song_sid row.
+        """
+        i = self.song_positions.get(song_id)
+        if i is None:
+            return
+        if not data.get("exists", True):
+            self._set_flag(i, MISSING, True)
+            return
+        self.cool_ends[i] = data.get("cool_end") or 0
+        self.elec_blocked_nums[i] = data.get("elec_blocked_num") or 0
+        if data.get("request_only_end") is None:
+            self.request_only_ends[i] = -1
+        else:
+            self.request_only_ends[i] = data["request_only_end"]
+        if data.get("cool"):
+            heapq.heappush(self._cool_heap, (self.cool_ends[i], i))
+        if data.get("elec_blocked"):
+            self._blocked.add(i)
+        else:
+            self._blocked.discard(i)
+        if self.request_only_ends[i] != -1:
+            heapq.heappush(self._request_only_heap, (self.request_only_ends[i], i))
+        self._set_flag(i, COOL, data.get("cool"))
+        self._set_flag(i, ELEC_BLOCKED, data.get("elec_blocked"))
+        self._set_flag(i, REQUEST_ONLY, data.get("request_only"))
+
+    def random_song_id(self, ignore_requests=False):
+        pool = self.available_ignoring_requests if ignore_requests else self.available
+        if not len(pool):
+            return None
+        return self.song_ids[pool.choice()]
+
+    def random_song_id_any(self):
+        if not len(self.existing):
+            return None
+        return self.song_ids[self.existing.choice()]
+
+    def _length_range(self, lower_bound, upper_bound):
+        return (
+            bisect.bisect_left(self.lengths, lower_bound),
+            bisect.bisect_right(self.lengths, upper_bound),
+        )
+
+    def count_timed(self, lower_bound, upper_bound):
+        start, end = self._length_range(lower_bound, upper_bound)
+        if start >= end:
+            return 0
+        return self.available.count_range(start, end)
+
+    def random_song_id_timed(self, lower_bound, upper_bound):
+        start, end = self._length_range(lower_bound, upper_bound)
+        if start >= end:
+            return None
+        i = self.available.choice_in_range(start, end)
+        if i is None:
+            return None
+        return self.song_ids[i]
+
+    def random_song_ids_for_election(self, num_songs, target_seconds, target_delta):
+        """
+        Picks up to num_songs songs for one election, none of which share an
+        album or group since the first of them to be added to the election
+        would election block the rest.  Without target_seconds the first song
+        is picked at random and the rest are aligned to its length.
+        """
+        picked = []
+        album_ids = set()
+        group_ids = set()
+        for _i in range(num_songs * _ELECTION_PROBES):
+            if len(picked) >= num_songs:
+                break
+            if target_seconds:
+                start, end = self._length_range(
+                    target_seconds - (target_delta / 2),
+                    target_seconds + (target_delta / 2),
+                )
+                i = self.available.choice_in_range(start, end)
+            elif len(self.available):
+                i = self.available.choice()
+            else:
+                i = None
+            if i is None:
+                break
+            if i in picked or self.album_ids[i] in album_ids:
+                continue
+            song_group_ids = self.song_group_ids.get(i, ())
+            if group_ids.intersection(song_group_ids):
+                continue
+            picked.append(i)
+            if self.album_ids[i]:
+                album_ids.add(self.album_ids[i])
+            group_ids.update(song_group_ids)
+            if not target_seconds:
+                target_seconds = self.lengths[i]
+        return [self.song_ids[i] for i in picked]
+
+    def shortest_song_id(self):
+        # Matches get_shortest_song's SQL, which does not look at album_requests_pending
+        i = self.available_ignoring_requests.first()
+        if i is None:
+            return None
+        return self.song_ids[i]
+
+
+def enabled():
+    return not config.has("song_pool_enabled") or config.get("song_pool_enabled")
+
+
+def get(sid):
+    """
+    Returns the song pool for a station, (re)building it from the database as
+    necessary.  Returns None if song pools are disabled.
+    """
+    if not enabled():
+        return None
+    pool = pools.get(sid)
+    if not pool or pool.loaded_at < (timestamp() - MAX_AGE):
+        pool = SongPool(sid)
+        pool.load()
+        pools[sid] = pool
+    return pool
+
+
+def reset(sid):
+    pools.pop(sid, None)
+
+
+# The functions below keep a station's pool in step with UPDATEs made to r4_song_sid.
+# They do nothing in processes that have never selected a song for that station.
+
+
+def start_song_cooldown(sid, song_id, cool_end, request_only_end):
+    pool = pools.get(sid)
+    if pool and song_id in pool.song_positions:
+        pool.start_cooldown(
+            [pool.song_positions[song_id]],
+            cool_end,
+            request_only_end,
+            from_song=True,
+        )
+
+
+def start_album_cooldown(sid, album_id, cool_end, request_only_end):
+    pool = pools.get(sid)
+    if pool:
+        pool.start_cooldown(
+            pool.album_positions.get(album_id, []), cool_end, request_only_end
+        )
+
+
+def start_group_cooldown(sid, group_id, cool_end, request_only_end):
+    pool = pools.get(sid)
+    if pool:
+        pool.start_cooldown(
+            pool.group_positions.get(group_id, []), cool_end, request_only_end
+        )
+
+
+def set_song_election_block(sid, song_id, num_elections):
+    pool = pools.get(sid)
+    if pool and song_id in pool.song_positions:
+        pool.start_election_block([pool.song_positions[song_id]], num_elections)
+
+
+def set_album_election_block(sid, album_id, num_elections):
+    pool = pools.get(sid)
+    if pool:
+        pool.start_election_block(pool.album_positions.get(album_id, []), num_elections)
+
+
+def set_group_election_block(sid, group_id, num_elections):
+    pool = pools.get(sid)
+    if pool:
+        pool.start_election_block(
+            pool.group_positions.get(group_id, []), num_elections, from_group=True
+        )
+
+
+def reduce_election_blocks(sid):
+    pool = pools.get(sid)
+    if pool:
+        pool.reduce_election_blocks()
+
+
+def warm(sid, now):
+    pool = pools.get(sid)
+    if pool:
+        pool.warm(now)
+
+
+def set_requests_pending(sid, album_ids):
+    pool = pools.get(sid)
+    if pool:
+        pool.set_requests_pending(album_ids)
+
+
+def sync_song(sid, song_id, data):
+    pool = pools.get(sid)
+    if pool:
+        pool.sync_song(song_id, data)
@@ -30,6 +30,10 @@ def rating_calculator(ratings):
 def get_song_rating(song_id, user_id):
     rating = cache.get_song_rating(song_id, user_id)
     if not rating:
+        # songs on the schedule have every user's rating primed in one blob
+        rating = cache.get_song_rating_from_blob(song_id, user_id)
+        if rating:
+            return rating
         rating = db.c.fetch_row(
             "SELECT song_rating_user AS rating_user, song_fave AS fave FROM r4_song_ratings WHERE user_id = %s AND song_id = %s",
             (user_id, song_id),
@@ -43,6 +47,9 @@ def get_song_rating(song_id, user_id):
 def get_album_rating(sid, album_id, user_id):
     rating = cache.get_album_rating(sid, album_id, user_id)
     if not rating:
+        rating = cache.get_album_rating_from_blob(sid, album_id, user_id)
+        if rating:
+            return rating
         rating = db.c.fetch_row(
             "SELECT album_rating_user AS rating_user, album_rating_complete AS rating_complete "
             "FROM r4_album_ratings "
@@ -62,6 +69,103 @@ def get_album_rating(sid, album_id, user_id):
     return rating
 
 
+def get_song_ratings(song_ids, user_id):
+    """
+    Batched get_song_rating: one memcache get_multi, then the ratings blobs,
+    then one SQL query and one set_multi for whatever is left.  Returns {song_id: rating}.
+    """
+    song_ids = set(song_ids)
+    ratings = cache.get_song_ratings(song_ids, user_id) if song_ids else {}
+    missing = []
+    for song_id in song_ids - set(ratings):
+        rating = cache.get_song_rating_from_blob(song_id, user_id)
+        if rating:
+            ratings[song_id] = rating
+        else:
+            missing.append(song_id)
+    if missing:
+        fetched = {song_id: {"rating_user": 0, "fave": None} for song_id in missing}
+        for row in db.c.fetch_all(
+            "SELECT song_id, song_rating_user AS rating_user, song_fave AS fave FROM r4_song_ratings WHERE user_id = %s AND song_id IN %s",
+            (user_id, tuple(missing)),
+        ):
+            fetched[row["song_id"]] = {
+                "rating_user": row["rating_user"],
+                "fave": row["fave"],
+            }
+        cache.set_song_ratings(fetched, user_id)
+        ratings.update(fetched)
+    return ratings
+
+
+def get_album_ratings(album_keys, user_id):
+    """
+    Batched get_album_rating for an iterable of (sid, album_id).  Returns {(sid, album_id): rating}.
+    """
+    album_keys = set(album_keys)
+    ratings = cache.get_album_ratings(album_keys, user_id) if album_keys else {}
+    missing = []
+    for sid, album_id in album_keys - set(ratings):
+        rating = cache.get_album_rating_from_blob(sid, album_id, user_id)
+        if rating:
+            ratings[(sid, album_id)] = rating
+        else:
+            missing.append((sid, album_id))
+    if missing:
+        fetched = {
+            key: {"rating_user": 0, "rating_complete": False, "fave": False}
+            for key in missing
+        }
+        for row in db.c.fetch_all(
+            "SELECT sid, album_id, album_rating_user AS rating_user, album_rating_complete AS rating_complete "
+            "FROM r4_album_ratings "
+            "WHERE user_id = %s AND (sid, album_id) IN %s",
+            (user_id, tuple(missing)),
+        ):
+            fetched[(row["sid"], row["album_id"])].update(
+                {
+                    "rating_user": row["rating_user"],
+                    "rating_complete": row["rating_complete"],
+                }
+            )
+        faves = set(
+            db.c.fetch_list(
+                "SELECT album_id FROM r4_album_faves WHERE user_id = %s AND album_id IN %s AND album_fave = TRUE",
+                (user_id, tuple(set(album_id for _sid, album_id in missing))),
+            )
+        )
+        for (sid, album_id), rating in fetched.items():
+            rating["fave"] = album_id in faves
+        cache.set_album_ratings(fetched, user_id)
+        ratings.update(fetched)
+    return ratings
+
+
+class BatchRatings:
+    """
+    One user's song and album ratings for a whole payload, resolved up front with
+    get_song_ratings/get_album_ratings.  Has the same get_song_rating/get_album_rating
+    signatures as this module, so to_dict() can use either as its ratings source.
+    """
+
+    def __init__(self, user_id, songs):
+        self.user_id = user_id
+        self.songs = get_song_ratings([song.id for song in songs], user_id)
+        self.albums = get_album_ratings(
+            [(song.album.sid, song.album.id) for song in songs if song.album], user_id
+        )
+
+    def get_song_rating(self, song_id, user_id):
+        if user_id == self.user_id and song_id in self.songs:
+            return self.songs[song_id]
+        return get_song_rating(song_id, user_id)
+
+    def get_album_rating(self, sid, album_id, user_id):
+        if user_id == self.user_id and (sid, album_id) in self.albums:
+            return self.albums[(sid, album_id)]
+        return get_album_rating(sid, album_id, user_id)
+
+
 CLEAR_RATING_FLAG = "__clear_rating__"
 
 
@@ -204,13 +308,22 @@ def set_album_fave(sid, album_id, user_id, fave):
                 % ("album", album_id, fave),
             )
             return False
+    # keep the user's album rating, the cached value outlives schedule priming
+    current = get_album_rating(sid, album_id, user_id)
     cache.set_album_rating(
         sid,
         album_id,
         user_id,
-        {"rating_user": rating, "fave": fave, "rating_complete": rating_complete},
+        {
+            "rating_user": current.get("rating_user", rating),
+            "fave": fave,
+            "rating_complete": current.get("rating_complete", rating_complete),
+        },
     )
     db.c.commit()
+    # faves aren't per-station
+    for overlay_sid in config.station_ids:
+        _clear_album_overlay(overlay_sid, user_id)
     return True
 
 
@@ -257,8 +370,13 @@ def update_album_ratings(target_sid, song_id, user_id):
             sid,
             album_id,
             user_id,
-            {"rating_user": album_rating, "rating_complete": rating_complete},
+            {
+                "rating_user": album_rating,
+                "rating_complete": rating_complete,
+                "fave": get_album_rating(sid, album_id, user_id).get("fave", False),
+            },
         )
+        _clear_album_overlay(sid, user_id)
         if target_sid == sid:
             toret.append(
                 {
@@ -269,3 +387,55 @@ def update_album_ratings(target_sid, song_id, user_id):
                 }
             )
     return toret
+
+
+# A user's album ratings and faves for one station, album_id -> {"rating_user", "fave",
+# "rating_complete"}, only for albums the user has touched.  The album list is the
+# station's cached all_albums with this laid on top, instead of joining every album
+# against the user's ratings on each request.  Bulk recalculations that can change
+# anyone's album ratings bump album_overlay_generation, which rebuilds every overlay
+# on its next read.  A user's own changes clear their overlay rather than patching it,
+# since two requests patching it at once would lose one of the changes, and overlays
+# are rebuilt after ALBUM_OVERLAY_TTL seconds regardless.
+ALBUM_OVERLAY_TTL = 600
+
+
+def get_album_overlay(sid, user_id):
+    generation = cache.get("album_overlay_generation") or 0
+    overlay = cache.get_user(user_id, "album_overlay_%s" % sid)
+    if (
+        overlay
+        and overlay["generation"] == generation
+        and overlay.get("built", 0) > timestamp() - ALBUM_OVERLAY_TTL
+    ):
+        return overlay["albums"]
+
+    albums = {}
+    for row in db.c.fetch_all(
+        "SELECT "
+        "album_id, "
+        "COALESCE(album_rating_user, 0) AS rating_user, "
+        "COALESCE(album_fave, FALSE) AS fave, "
+        "COALESCE(album_rating_complete, FALSE) AS rating_complete "
+        "FROM "
+        "(SELECT album_id, album_rating_user, album_rating_complete FROM r4_album_ratings WHERE user_id = %s AND sid = %s) AS ratings "
+        "FULL OUTER JOIN (SELECT album_id, album_fave FROM r4_album_faves WHERE user_id = %s) AS faves USING (album_id)",
+        (user_id, sid, user_id),
+    ):
+        albums[row.pop("album_id")] = row
+    cache.set_user(
+        user_id,
+        "album_overlay_%s" % sid,
+        {"generation": generation, "built": timestamp(), "albums": albums},
+    )
+    return albums
+
+
+def _clear_album_overlay(sid, user_id):
+    cache.set_user(user_id, "album_overlay_%s" % sid, None)
+
+
+def invalidate_album_overlays():
+    cache.set_global(
+        "album_overlay_generation", (cache.get("album_overlay_generation") or 0) + 1
+    )
@@ -1,16 +1,151 @@
+import copy
 from time import time as timestamp
 from libs import db
 from libs import cache
 from libs import log
+from libs import zeromq
 from rainwave import playlist
+from rainwave.playlist_objects import songpool
 from rainwave.user import User
 
 LINE_SQL = "SELECT COALESCE(radio_username, username) AS username, user_id, line_expiry_tune_in, line_expiry_election, line_wait_start, line_has_had_valid FROM r4_request_line JOIN phpbb_users USING (user_id) WHERE r4_request_line.sid = %s AND radio_requests_paused = FALSE ORDER BY line_wait_start"
 
 
+# Everything _process_line needs about each person in line, in one query: whether they're
+# tuned in to the station and their top request that's currently eligible to be played.
+LINE_DETAIL_SQL = (
+    "SELECT COALESCE(radio_username, username) AS username, r4_request_line.user_id, line_expiry_tune_in, line_expiry_election, line_wait_start, line_has_had_valid, "
+    "EXISTS (SELECT 1 FROM r4_listeners WHERE r4_listeners.user_id = r4_request_line.user_id AND r4_listeners.sid = r4_request_line.sid AND listener_purge = FALSE) AS tuned_in, "
+    "top_request.song_id, top_request.album_id, top_request.song_title, top_request.album_name "
+    "FROM r4_request_line JOIN phpbb_users USING (user_id) "
+    "LEFT JOIN LATERAL ("
+    "SELECT r4_request_store.song_id, r4_songs.album_id, song_title, album_name "
+    "FROM r4_request_store JOIN r4_song_sid USING (song_id) JOIN r4_songs USING (song_id) JOIN r4_albums USING (album_id) "
+    "WHERE r4_request_store.user_id = r4_request_line.user_id AND r4_song_sid.sid = r4_request_line.sid "
+    "AND song_exists = TRUE AND song_cool = FALSE AND song_elec_blocked = FALSE "
+    "ORDER BY reqstor_order, reqstor_id LIMIT 1"
+    ") AS top_request ON TRUE "
+    "WHERE r4_request_line.sid = %s AND radio_requests_paused = FALSE "
+)
+
+# The backend keeps each station's LINE_DETAIL_SQL rows in memory, in line order, so
+# discrete events only have to re-fetch the people they touch.  _process_line keeps
+# the rows in step with the writes it makes.
+_line_details = {}
+# sid -> (request_line, request_user_positions, request_valid_positions, albums) last cached
+_published = {}
+# columns that must match between the in-memory rows and the database
+_CHECKED_COLUMNS = (
+    "line_wait_start",
+    "line_expiry_tune_in",
+    "line_expiry_election",
+    "line_has_had_valid",
+    "tuned_in",
+    "song_id",
+)
+# the station whose line this process maintains, only ever set in that station's backend
+_served_sid = None
+
+
+def start(sid):
+    """Maintains the station's request line in this process, which must be its backend."""
+    global _served_sid
+    _served_sid = sid
+
+
+def notify_user_changed(user_id):
+    # Lets every station's backend know a user's requests or line status changed
+    zeromq.publish({"action": "request_line_user", "user_id": user_id})
+
+
 def update_line(sid):
     # Get everyone in the line
-    line = db.c.fetch_all(LINE_SQL, (sid,))
+    line = db.c.fetch_all(LINE_DETAIL_SQL + "ORDER BY line_wait_start", (sid,))
+    _line_details[sid] = line
+    _process_line(line, sid)
+
+
+def refresh_line(sid, user_ids=None, song_ids=None):
+    """
+    Re-fetches only the given users and the users in line who requested one of the
+    given songs, or anything sharing an album or group with them, then re-processes
+    the line from memory.  Songs going into an election block their album and groups,
+    so those requesters' top eligible requests can change too.
+
+    Outside the station's backend (e.g. an API process building a DJ election) the
+    refresh is handed to the backend, since only its in-memory line feeds get_next.
+    """
+    if sid != _served_sid:
+        zeromq.publish(
+            {
+                "sid": sid,
+                "action": "refresh_line",
+                "user_ids": [user_id for user_id in user_ids or [] if user_id],
+                "song_ids": list(song_ids or []),
+            }
+        )
+        return
+    if not sid in _line_details:
+        update_line(sid)
+        return
+    user_ids = set(user_id for user_id in user_ids or [] if user_id)
+    song_ids = tuple(set(song_ids or []))
+    conditions = []
+    params = [sid]
+    if user_ids:
+        conditions.append("r4_request_line.user_id IN %s")
+        params.append(tuple(user_ids))
+    if song_ids:
+        conditions.append(
+            "r4_request_line.user_id IN ("
+            "SELECT user_id FROM r4_request_store JOIN r4_songs USING (song_id) "
+            "WHERE r4_songs.album_id IN (SELECT album_id FROM r4_songs WHERE song_id IN %s) "
+            "OR r4_request_store.song_id IN (SELECT song_id FROM r4_song_group WHERE group_id IN (SELECT group_id FROM r4_song_group WHERE song_id IN %s))"
+            ")"
+        )
+        params.extend((song_ids, song_ids))
+    fresh = []
+    if conditions:
+        fresh = db.c.fetch_all(
+            LINE_DETAIL_SQL + "AND (" + " OR ".join(conditions) + ")", tuple(params)
+        )
+    # anyone asked about who didn't come back has left this station's line
+    replaced = user_ids | set(row["user_id"] for row in fresh)
+    line = [row for row in _line_details[sid] if not row["user_id"] in replaced]
+    line.extend(fresh)
+    line.sort(key=lambda row: row["line_wait_start"])
+    _line_details[sid] = line
+    _process_line(line, sid)
+
+
+def check_line(sid):
+    """
+    Consistency check for the incremental line: rebuilds it from scratch, logs
+    anyone the events missed, and re-caches everything regardless.
+    """
+    line = db.c.fetch_all(LINE_DETAIL_SQL + "ORDER BY line_wait_start", (sid,))
+    if sid in _line_details:
+        expected = {
+            row["user_id"]: tuple(row[column] for column in _CHECKED_COLUMNS)
+            for row in line
+        }
+        incremental = {
+            row["user_id"]: tuple(row[column] for column in _CHECKED_COLUMNS)
+            for row in _line_details[sid]
+        }
+        drifted = [
+            user_id
+            for user_id in set(expected) | set(incremental)
+            if expected.get(user_id) != incremental.get(user_id)
+        ]
+        if drifted:
+            log.warn(
+                "request_line",
+                "%s: In-memory request line drifted for user IDs %s."
+                % (sid, sorted(drifted)),
+            )
+    _line_details[sid] = line
+    _published.pop(sid, None)
     _process_line(line, sid)
 
 
@@ -24,125 +159,166 @@ def _process_line(line, sid):
     position = 1
     user_viewable_position = 1
     valid_positions = 0
+    # Line changes are collected and written with one query each at the end
+    tune_in_expired = []
+    now_valid = []
+    election_expiry_started = []
+    tune_in_expiry_started = []
+    # users who are no longer in this line once processing is done
+    removed = set()
     # For each person
-    for row in line:
+    for detail in line:
+        row = dict(detail)
         add_to_line = False
-        u = User(row["user_id"])
+        user_id = row["user_id"]
+        tuned_in = row.pop("tuned_in")
+        song_id = row.pop("song_id")
+        album_id = row.pop("album_id")
+        song = {
+            "id": song_id,
+            "title": row.pop("song_title"),
+            "album_name": row.pop("album_name"),
+        }
         row["song_id"] = None
         # If their time is up, remove them and don't add them to the new line
         if row["line_expiry_tune_in"] and row["line_expiry_tune_in"] <= t:
             log.debug(
                 "request_line",
                 "%s: Removed user ID %s from line for tune in timeout, expiry time %s current time %s"
-                % (sid, u.id, row["line_expiry_tune_in"], t),
-            )
-            u.remove_from_request_line()
-        else:
-            tuned_in_sid = db.c.fetch_var(
-                "SELECT sid FROM r4_listeners WHERE user_id = %s AND sid = %s AND listener_purge = FALSE",
-                (u.id, sid),
+                % (sid, user_id, row["line_expiry_tune_in"], t),
             )
-            tuned_in = True if tuned_in_sid == sid else False
-            if tuned_in:
-                # Get their top song ID
-                song_id = u.get_top_request_song_id(sid)
-                if song_id and not row["line_has_had_valid"]:
-                    row["line_has_had_valid"] = True
-                    db.c.update(
-                        "UPDATE r4_request_line SET line_has_had_valid = TRUE WHERE user_id = %s",
-                        (u.id,),
-                    )
-                if row["line_has_had_valid"]:
-                    valid_positions += 1
-                # If they have no song and their line expiry has arrived, boot 'em
-                if (
-                    not song_id
-                    and row["line_expiry_election"]
-                    and (row["line_expiry_election"] <= t)
-                ):
-                    log.debug(
-                        "request_line",
-                        "%s: Removed user ID %s from line for election timeout, expiry time %s current time %s"
-                        % (sid, u.id, row["line_expiry_election"], t),
-                    )
-                    u.remove_from_request_line()
-                    # Give them more chances if they still have requests
-                    # They'll get added to the line of whatever station they're tuned in to (if any!)
-                    if u.has_requests():
-                        u.put_in_request_line(u.get_tuned_in_sid())
-                # If they have no song and they're in 2nd or 1st, start the expiry countdown
-                elif not song_id and not row["line_expiry_election"] and position <= 2:
-                    log.debug(
-                        "request_line",
-                        "%s: User ID %s has no valid requests, beginning boot countdown."
-                        % (sid, u.id),
-                    )
-                    row["line_expiry_election"] = t + 900
-                    db.c.update(
-                        "UPDATE r4_request_line SET line_expiry_election = %s WHERE user_id = %s",
-                        ((t + 900), row["user_id"]),
-                    )
-                    add_to_line = True
-                # Keep 'em in line
-                else:
-                    log.debug(
-                        "request_line", "%s: User ID %s is in line." % (sid, u.id)
-                    )
-                    if song_id:
-                        albums_with_requests.append(
-                            db.c.fetch_var(
-                                "SELECT album_id FROM r4_songs WHERE song_id = %s",
-                                (song_id,),
-                            )
-                        )
-                        row["song"] = db.c.fetch_row(
-                            "SELECT song_id AS id, song_title AS title, album_name FROM r4_songs JOIN r4_albums USING (album_id) WHERE song_id = %s",
-                            (song_id,),
-                        )
-                    else:
-                        row["song"] = None
-                    row["song_id"] = song_id
-                    add_to_line = True
-            elif not row["line_expiry_tune_in"] or row["line_expiry_tune_in"] == 0:
+            tune_in_expired.append(user_id)
+            removed.add(user_id)
+        elif tuned_in:
+            if song_id and not row["line_has_had_valid"]:
+                row["line_has_had_valid"] = True
+                detail["line_has_had_valid"] = True
+                now_valid.append(user_id)
+            if row["line_has_had_valid"]:
+                valid_positions += 1
+            # If they have no song and their line expiry has arrived, boot 'em
+            if (
+                not song_id
+                and row["line_expiry_election"]
+                and (row["line_expiry_election"] <= t)
+            ):
                 log.debug(
                     "request_line",
-                    "%s: User ID %s being marked as tuned out." % (sid, u.id),
-                )
-                db.c.update(
-                    "UPDATE r4_request_line SET line_expiry_tune_in = %s WHERE user_id = %s",
-                    ((t + 600), row["user_id"]),
+                    "%s: Removed user ID %s from line for election timeout, expiry time %s current time %s"
+                    % (sid, user_id, row["line_expiry_election"], t),
                 )
-                add_to_line = True
-            else:
+                u = User(user_id)
+                u.remove_from_request_line()
+                removed.add(user_id)
+                # Give them more chances if they still have requests
+                # They'll get added to the line of whatever station they're tuned in to (if any!)
+                if u.has_requests():
+                    u.put_in_request_line(u.get_tuned_in_sid())
+            # If they have no song and they're in 2nd or 1st, start the expiry countdown
+            elif not song_id and not row["line_expiry_election"] and position <= 2:
                 log.debug(
                     "request_line",
-                    "%s: User ID %s not tuned in, waiting on expiry for action."
-                    % (sid, u.id),
+                    "%s: User ID %s has no valid requests, beginning boot countdown."
+                    % (sid, user_id),
                 )
+                row["line_expiry_election"] = t + 900
+                detail["line_expiry_election"] = t + 900
+                election_expiry_started.append(user_id)
+                add_to_line = True
+            # Keep 'em in line
+            else:
+                log.debug("request_line", "%s: User ID %s is in line." % (sid, user_id))
+                if song_id:
+                    albums_with_requests.append(album_id)
+                    row["song"] = song
+                else:
+                    row["song"] = None
+                row["song_id"] = song_id
                 add_to_line = True
+        elif not row["line_expiry_tune_in"] or row["line_expiry_tune_in"] == 0:
+            log.debug(
+                "request_line",
+                "%s: User ID %s being marked as tuned out." % (sid, user_id),
+            )
+            detail["line_expiry_tune_in"] = t + 600
+            tune_in_expiry_started.append(user_id)
+            add_to_line = True
+        else:
+            log.debug(
+                "request_line",
+                "%s: User ID %s not tuned in, waiting on expiry for action."
+                % (sid, user_id),
+            )
+            add_to_line = True
         row["skip"] = not add_to_line
         row["position"] = user_viewable_position
         new_line.append(row)
-        user_positions[u.id] = user_viewable_position
+        user_positions[user_id] = user_viewable_position
         user_viewable_position = user_viewable_position + 1
         if add_to_line:
             position = position + 1
 
-    log.debug("request_line", "Request line valid positions: %s" % valid_positions)
-    cache.set_station(sid, "request_valid_positions", valid_positions)
-    cache.set_station(sid, "request_line", new_line, True)
-    cache.set_station(sid, "request_user_positions", user_positions, True)
-
-    db.c.update(
-        "UPDATE r4_album_sid SET album_requests_pending = NULL WHERE album_requests_pending = TRUE AND sid = %s",
-        (sid,),
-    )
-    for album_id in albums_with_requests:
+    if tune_in_expired:
+        db.c.update(
+            "DELETE FROM r4_request_line WHERE user_id IN %s", (tuple(tune_in_expired),)
+        )
+    if now_valid:
+        db.c.update(
+            "UPDATE r4_request_line SET line_has_had_valid = TRUE WHERE user_id IN %s",
+            (tuple(now_valid),),
+        )
+    if election_expiry_started:
+        db.c.update(
+            "UPDATE r4_request_line SET line_expiry_election = %s WHERE user_id IN %s",
+            ((t + 900), tuple(election_expiry_started)),
+        )
+    if tune_in_expiry_started:
         db.c.update(
-            "UPDATE r4_album_sid SET album_requests_pending = TRUE WHERE album_id = %s AND sid = %s",
-            (album_id, sid),
+            "UPDATE r4_request_line SET line_expiry_tune_in = %s WHERE user_id IN %s",
+            ((t + 600), tuple(tune_in_expiry_started)),
         )
 
+    if removed:
+        line[:] = [detail for detail in line if not detail["user_id"] in removed]
+        # people booted for an election timeout may have been put straight back in line
+        line.extend(
+            db.c.fetch_all(
+                LINE_DETAIL_SQL + "AND r4_request_line.user_id IN %s",
+                (sid, tuple(removed)),
+            )
+        )
+        line.sort(key=lambda detail: detail["line_wait_start"])
+
+    log.debug("request_line", "Request line valid positions: %s" % valid_positions)
+    # Only write what changed since the last time the line was processed
+    last_line, last_positions, last_valid, last_albums = _published.get(
+        sid, (None, None, None, None)
+    )
+    albums = set(albums_with_requests)
+    # callers pop entries off the cached line, so we keep a copy of our own to compare against
+    _published[sid] = (copy.deepcopy(new_line), user_positions, valid_positions, albums)
+
+    if valid_positions != last_valid:
+        cache.set_station(sid, "request_valid_positions", valid_positions)
+    if new_line != last_line:
+        cache.set_station(sid, "request_line", new_line, True)
+    if user_positions != last_positions:
+        cache.set_station(sid, "request_user_positions", user_positions, True)
+
+    if albums != last_albums:
+        if albums:
+            db.c.update(
+                "UPDATE r4_album_sid SET album_requests_pending = CASE WHEN album_id IN %s THEN TRUE ELSE NULL END "
+                "WHERE sid = %s AND (album_requests_pending = TRUE OR album_id IN %s)",
+                (tuple(albums), sid, tuple(albums)),
+            )
+        else:
+            db.c.update(
+                "UPDATE r4_album_sid SET album_requests_pending = NULL WHERE album_requests_pending = TRUE AND sid = %s",
+                (sid,),
+            )
+        songpool.set_requests_pending(sid, albums_with_requests)
+
     return new_line
 
 
@@ -11,6 +11,7 @@ import rainwave.playlist_objects.album
 from rainwave import listeners
 from rainwave import request
 from rainwave import user
+from rainwave import vote_tally
 from libs import db
 from libs import config
 from libs import cache
@@ -59,11 +60,14 @@ def load():
         history[sid] = cache.get_station(sid, "sched_history")
         if not history[sid]:
             history[sid] = []
-            for song_id in db.c.fetch_list(
-                "SELECT song_id FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) WHERE sid = %s AND song_exists = TRUE AND song_verified = TRUE ORDER BY songhist_time DESC LIMIT 5",
-                (sid,),
+            for song in playlist.Song.load_many(
+                db.c.fetch_list(
+                    "SELECT song_id FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) WHERE sid = %s AND song_exists = TRUE AND song_verified = TRUE ORDER BY songhist_time DESC LIMIT 5",
+                    (sid,),
+                ),
+                sid,
             ):
-                history[sid].insert(0, SingleSong(song_id, sid))
+                history[sid].insert(0, SingleSong(song, sid))
             # create a fake history in case clients expect it without checking
             if not history[sid]:
                 for i in range(1, 5):
@@ -153,6 +157,8 @@ def set_upnext_crossfade(sid, crossfade):
 
 
 def advance_station(sid):
+    if vote_tally.enabled():
+        vote_tally.close_election(sid, upnext[sid][0] if upnext[sid] else None)
     db.c.start_transaction()
     try:
         log.debug("advance", "Advancing station %s." % sid)
@@ -451,9 +457,7 @@ def _trim(sid):
 
 
 def _update_schedule_memcache(sid):
-    cache.set_station(sid, "sched_current", current[sid], True)
-    cache.set_station(sid, "sched_next", upnext[sid], True)
-    cache.set_station(sid, "sched_history", history[sid], True)
+    cache.set_schedule_snapshot(sid, current[sid], upnext[sid], history[sid])
 
     sched_current_dict = current[sid].to_dict()
     cache.set_station(sid, "sched_current_dict", sched_current_dict, True)
@@ -488,6 +492,8 @@ def _update_schedule_memcache(sid):
 
 def update_memcache(sid):
     _update_schedule_memcache(sid)
+    if vote_tally.enabled():
+        vote_tally.flush()
     update_live_voting(sid)
     cache.prime_rating_cache_for_events(
         sid, [current[sid]] + upnext[sid] + history[sid]
@@ -519,7 +525,7 @@ def update_memcache(sid):
 
 def update_live_voting(sid):
     live_voting = {}
-    upnext_sid = cache.get_station(sid, "sched_next")
+    upnext_sid = cache.get_schedule_snapshot(sid).next
     if not upnext_sid:
         return live_voting
     for event in upnext_sid:
@@ -533,7 +539,7 @@ def update_live_voting(sid):
 
 
 def get_elec_id_for_entry(sid, entry_id):
-    sched_next = cache.get_station(sid, "sched_next")
+    sched_next = cache.get_schedule_snapshot(sid).next
     if sched_next:
         for event in sched_next:
             if event.is_election and event.has_entry_id(entry_id):
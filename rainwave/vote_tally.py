@@ -0,0 +1,252 @@
+from time import time as timestamp
+
+import tornado.ioloop
+
+from libs import cache
+from libs import config
+from libs import db
+from libs import log
+from libs import zeromq
+from rainwave import live_voting
+
+# When enabled, election tallies are owned by the station's backend process.
+# API processes still record who voted for what (r4_vote_history, listener
+# locks) but instead of UPDATEing r4_election_entries on every vote they publish
+# a "tally_vote" message.  The backend dedupes by voter, broadcasts the changed
+# elections' live_voting at a fixed cadence and writes the tallies to Postgres in
+# one batch, always before the election is prepared.
+#
+# Closing an election before it is prepared is decided in Postgres: the backend
+# sets elec_used, and API processes only record a vote while elec_used is FALSE,
+# holding a row lock (see api_requests/vote.py).  A vote that loses that race gets
+# an explicit "cannot_vote_for_this_now" rejection instead of being recorded.  The
+# backend then recounts every vote recorded before the close from r4_vote_history
+# and r4_listeners, so "tally_vote" messages still queued in ZeroMQ don't matter,
+# and ignores any that arrive for the closed election afterwards.
+
+LIVE_VOTING_INTERVAL = 1000
+FLUSH_INTERVAL = 5000
+# elections without votes for this long are dropped from memory
+FORGET_AFTER = 3600
+
+# elec_id -> {entry_id: {"entry_id", "entry_votes", "song_id"}}
+_totals = {}
+# elec_id -> {voter: entry_id}
+_voters = {}
+# elec_id -> time of last vote
+_last_vote = {}
+# (elec_id, entry_id) -> votes not yet written to r4_election_entries
+_pending = {}
+# (elec_id, entry_id) with tally changes not yet broadcast
+_changed = set()
+# elec_id -> time it was closed, late messages for these are ignored
+_closed = {}
+_sid = None
+
+
+def enabled():
+    return config.has("vote_tally_service") and config.get("vote_tally_service")
+
+
+def submit_vote(
+    sid, elec_id, entry_id, voter, previous_entry_id=None, autovote_entry_id=None
+):
+    """Called by API processes after a vote has been recorded for the voter."""
+    zeromq.publish(
+        {
+            "action": "tally_vote",
+            "sid": sid,
+            "elec_id": elec_id,
+            "entry_id": entry_id,
+            "voter": voter,
+            "previous_entry_id": previous_entry_id,
+            "autovote_entry_id": autovote_entry_id,
+        }
+    )
+
+
+def start(sid):
+    """Runs the tally service for the station inside its backend process."""
+    global _sid
+    _sid = sid
+    tornado.ioloop.PeriodicCallback(publish_live_voting, LIVE_VOTING_INTERVAL).start()
+    tornado.ioloop.PeriodicCallback(_periodic_flush, FLUSH_INTERVAL).start()
+
+
+def on_message(message):
+    if message["sid"] == _sid:
+        if message["elec_id"] in _closed:
+            log.debug(
+                "vote_tally",
+                "Ignoring vote for closed election ID %s, it was recounted."
+                % message["elec_id"],
+            )
+            return
+        add_vote(
+            message["elec_id"],
+            message["entry_id"],
+            message["voter"],
+            message.get("previous_entry_id"),
+            message.get("autovote_entry_id"),
+        )
+
+
+def close_election(sid, event):
+    """
+    Called before an election is prepared.  API processes stop accepting votes for
+    it, and every vote they recorded before that is counted before the final flush.
+    """
+    if not event or not event.is_election:
+        flush()
+        return
+    # lets API processes turn votes away without touching the DB
+    cache.set_station(sid, "tally_closed_elec_id", event.id)
+    # the authoritative cut-off, waits for votes being recorded right now
+    db.c.update(
+        "UPDATE r4_elections SET elec_used = TRUE WHERE elec_id = %s", (event.id,)
+    )
+    zeromq.drain_sub()
+    _recount(event)
+    _closed[event.id] = timestamp()
+    flush()
+
+
+def _recount(event):
+    # Applies votes recorded in the DB that haven't arrived as messages yet, the
+    # same way add_vote would have once they did.
+    elec_id = event.id
+    totals = _load_election(elec_id)
+    if not totals:
+        return
+    voters = _voters[elec_id]
+    recorded = {}
+    for row in db.c.fetch_all(
+        "SELECT user_id, entry_id FROM r4_vote_history WHERE elec_id = %s",
+        (elec_id,),
+    ):
+        autovoted_entry = event.has_request_by_user(row["user_id"])
+        recorded["u%s" % row["user_id"]] = (
+            row["entry_id"],
+            autovoted_entry.data["entry_id"] if autovoted_entry else None,
+        )
+    for row in db.c.fetch_all(
+        "SELECT listener_id, listener_voted_entry FROM r4_listeners WHERE listener_voted_entry IN %s",
+        (tuple(totals),),
+    ):
+        recorded["l%s" % row["listener_id"]] = (row["listener_voted_entry"], None)
+    for voter, (entry_id, autovote_entry_id) in recorded.items():
+        if voters.get(voter) != entry_id:
+            log.debug(
+                "vote_tally",
+                "Recounting vote by %s for entry ID %s." % (voter, entry_id),
+            )
+            add_vote(elec_id, entry_id, voter, autovote_entry_id=autovote_entry_id)
+
+
+def is_closed(sid, elec_id):
+    return cache.get_station(sid, "tally_closed_elec_id") == elec_id
+
+
+def _load_election(elec_id):
+    if not elec_id in _totals:
+        _totals[elec_id] = {}
+        for row in db.c.fetch_all(
+            "SELECT entry_id, entry_votes, song_id FROM r4_election_entries WHERE elec_id = %s",
+            (elec_id,),
+        ):
+            _totals[elec_id][row["entry_id"]] = dict(row)
+        _voters[elec_id] = {}
+    return _totals[elec_id]
+
+
+def _add(elec_id, entry_id, addition):
+    totals = _load_election(elec_id)
+    if not entry_id in totals:
+        log.warn(
+            "vote_tally",
+            "Entry ID %s is not part of election ID %s." % (entry_id, elec_id),
+        )
+        return
+    totals[entry_id]["entry_votes"] += addition
+    _pending[(elec_id, entry_id)] = _pending.get((elec_id, entry_id), 0) + addition
+    _changed.add((elec_id, entry_id))
+
+
+def add_vote(elec_id, entry_id, voter, previous_entry_id=None, autovote_entry_id=None):
+    _load_election(elec_id)
+    _last_vote[elec_id] = timestamp()
+    voters = _voters[elec_id]
+    # what we saw last for this voter beats what the API process read from the DB,
+    # which can be stale when the same voter's votes race across processes
+    previous = voters.get(voter, previous_entry_id)
+    if previous == entry_id:
+        return
+    if previous:
+        _add(elec_id, previous, -1)
+    elif autovote_entry_id:
+        _add(elec_id, autovote_entry_id, -1)
+    _add(elec_id, entry_id, 1)
+    voters[voter] = entry_id
+
+
+def publish_live_voting():
+    if not _changed:
+        return
+    cached = cache.get_station(_sid, "live_voting") or {}
+    # votes that raced an election's start are not worth broadcasting
+    changes = [
+        [elec_id, entry_id, _totals[elec_id][entry_id]["entry_votes"]]
+        for elec_id, entry_id in _changed
+        if not cached or elec_id in cached
+    ]
+    _changed.clear()
+    if not changes:
+        return
+    for elec_id in set(change[0] for change in changes):
+        cached[elec_id] = list(_totals[elec_id].values())
+    cache.set_station(_sid, "live_voting", cached)
+    live_voting.publish(_sid, changes)
+
+
+def flush():
+    """Writes pending tallies to r4_election_entries in one statement."""
+    if _pending:
+        pending = list(_pending.items())
+        _pending.clear()
+        try:
+            # elections that have started have had their votes counted already
+            db.c.update(
+                "UPDATE r4_election_entries SET entry_votes = entry_votes + tally.votes "
+                "FROM (VALUES "
+                + ", ".join(["(%s, %s)"] * len(pending))
+                + ") AS tally (entry_id, votes), r4_elections "
+                "WHERE r4_election_entries.entry_id = tally.entry_id "
+                "AND r4_elections.elec_id = r4_election_entries.elec_id "
+                "AND r4_elections.elec_start_actual IS NULL",
+                tuple(
+                    value
+                    for (_elec_id, entry_id), votes in pending
+                    for value in (entry_id, votes)
+                ),
+            )
+        except:
+            for key, votes in pending:
+                _pending[key] = _pending.get(key, 0) + votes
+            raise
+    forget_before = timestamp() - FORGET_AFTER
+    for elec_id in [e for e, t in _closed.items() if t < forget_before]:
+        del _closed[elec_id]
+    for elec_id in [e for e, t in _last_vote.items() if t < forget_before]:
+        if not any(key[0] == elec_id for key in _pending):
+            _totals.pop(elec_id, None)
+            _voters.pop(elec_id, None)
+            _last_vote.pop(elec_id, None)
+            for entry_id in [key[1] for key in _changed if key[0] == elec_id]:
+                _changed.discard((elec_id, entry_id))
+
+
+def _periodic_flush():
+    try:
+        flush()
+    except Exception as e:
+        log.exception("vote_tally", "Could not flush vote tallies.", e)
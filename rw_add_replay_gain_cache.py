@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+from libs import db
+from libs import cache
+from libs import config
+from libs import log
+
+config.load()
+cache.connect()
+log.init()
+db.connect()
+
+db.c.update(" \
+		CREATE TABLE r4_replay_gain_cache ( \
+			rg_audio_hash				TEXT		PRIMARY KEY, \
+			rg_filename					TEXT		, \
+			rg_file_size				BIGINT		, \
+			rg_file_mtime				INTEGER		, \
+			rg_replay_gain				TEXT		NOT NULL \
+		)")
+db.c.create_idx("r4_replay_gain_cache", "rg_filename")
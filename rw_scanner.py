@@ -16,6 +16,12 @@ if __name__ == "__main__":
     parser.add_argument("--full", action="store_true")
     parser.add_argument("--reset", action="store_true")
     parser.add_argument("--art", action="store_true")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes reading tags, analysing replay gain, and resizing album art during --full or --art.",
+    )
     args = parser.parse_args()
     libs.config.load(args.config)
     libs.log.init(
@@ -32,10 +38,10 @@ if __name__ == "__main__":
 
         if args.art:
             backend.filemonitor.set_on_screen(True)
-            backend.filemonitor.full_art_update()
+            backend.filemonitor.full_art_update(args.workers)
         elif args.full:
             backend.filemonitor.set_on_screen(True)
-            backend.filemonitor.full_music_scan(args.reset)
+            backend.filemonitor.full_music_scan(args.reset, args.workers)
         else:
             backend.filemonitor.monitor()
     finally:
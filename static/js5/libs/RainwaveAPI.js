@@ -25,6 +25,10 @@ var RainwaveAPI = (function () {
   var requestQueue = [];
   var sentRequests = [];
   var callbacks = {};
+  var syncBase = null;
+  var liveVotingTallies = null;
+  var liveVotingSeq = null;
+  var liveVotingSnapshotRequested = false;
   var noop = function () {};
 
   var netLatencies,
@@ -110,6 +114,8 @@ var RainwaveAPI = (function () {
             action: "auth",
             user_id: _userID,
             key: _apiKey,
+            sync_overlay: true,
+            live_voting_delta: true,
           })
         );
       } catch (exc) {
@@ -188,6 +194,9 @@ var RainwaveAPI = (function () {
     self.onErrorRemove("sync_retrying");
     self.ok = true;
     isOK = true;
+    // sequence numbers are per server process, and this may be a different one
+    liveVotingSeq = null;
+    liveVotingSnapshotRequested = false;
 
     if (!pingInterval) {
       pingInterval = setInterval(ping, 20000);
@@ -359,6 +368,30 @@ var RainwaveAPI = (function () {
       asyncRequest.drawStart = new Date();
     }
 
+    if ("sync_base" in json) {
+      syncBase = json.sync_base;
+      delete json.sync_base;
+    }
+    if ("sync_overlay" in json) {
+      if (syncBase) {
+        applySyncOverlay(json, syncBase, json.sync_overlay);
+        syncBase = null;
+      }
+      delete json.sync_overlay;
+    }
+
+    if ("live_voting_delta" in json) {
+      applyLiveVotingDelta(json);
+    }
+    if ("live_voting" in json) {
+      liveVotingTallies = json.live_voting;
+      if ("live_voting_seq" in json) {
+        liveVotingSeq = json.live_voting_seq;
+        liveVotingSnapshotRequested = false;
+      }
+    }
+    delete json.live_voting_seq;
+
     if ("sync_result" in json) {
       if (json.sync_result.tl_key == "station_offline") {
         self.onError(json.sync_result);
@@ -377,9 +410,83 @@ var RainwaveAPI = (function () {
     nextRequest();
   };
 
+  // Schedule updates arrive as a sync_base shared by every listener, followed by a message
+  // carrying this user's sync_overlay.  Merge the two back into a regular sync.
+  var applySyncOverlay = function (json, base, overlay) {
+    var events = [base.sched_current]
+      .concat(base.sched_next || [])
+      .concat(base.sched_history || []);
+    var i, j, k, evt, song, album, songRating, albumRating;
+    for (i = 0; i < events.length; i++) {
+      evt = events[i];
+      if (!evt) {
+        continue;
+      }
+      if (overlay.voting_allowed.indexOf(evt.id) !== -1) {
+        evt.voting_allowed = true;
+      }
+      for (j = 0; evt.songs && j < evt.songs.length; j++) {
+        song = evt.songs[j];
+        songRating = overlay.song_ratings[song.id];
+        if (songRating) {
+          song.rating_user = songRating.rating_user;
+          song.fave = songRating.fave;
+          song.rating_allowed = songRating.rating_allowed;
+        }
+        for (k = 0; song.albums && k < song.albums.length; k++) {
+          album = song.albums[k];
+          albumRating = overlay.album_ratings[album.id];
+          if (albumRating) {
+            album.rating_user = albumRating.rating_user;
+            album.rating_complete = albumRating.rating_complete;
+            album.fave = albumRating.fave;
+          }
+        }
+      }
+    }
+    for (i in base) {
+      if (!(i in json)) {
+        json[i] = base[i];
+      }
+    }
+  };
+
+  // Live voting arrives as changes numbered by a per-station sequence.  They're applied to the
+  // last full tallies and handed to callbacks as full tallies again.  After a gap in the sequence,
+  // ask for a fresh snapshot and skip changes until it arrives.
+  var applyLiveVotingDelta = function (json) {
+    var delta = json.live_voting_delta;
+    delete json.live_voting_delta;
+    if (liveVotingSeq !== null && delta.seq <= liveVotingSeq) {
+      return;
+    }
+    if (
+      !liveVotingTallies ||
+      liveVotingSeq === null ||
+      delta.seq !== liveVotingSeq + 1
+    ) {
+      if (!liveVotingSnapshotRequested) {
+        liveVotingSnapshotRequested = true;
+        self.request("live_voting_snapshot");
+      }
+      return;
+    }
+    var i, j, entries;
+    for (i = 0; i < delta.changes.length; i++) {
+      entries = liveVotingTallies[delta.changes[i][0]] || [];
+      for (j = 0; j < entries.length; j++) {
+        if (entries[j].entry_id === delta.changes[i][1]) {
+          entries[j].entry_votes = delta.changes[i][2];
+        }
+      }
+    }
+    liveVotingSeq = delta.seq;
+    json.live_voting = liveVotingTallies;
+  };
+
   // Calls To API ******************************************************************************************
 
-  var statelessRequests = ["ping", "pong"];
+  var statelessRequests = ["ping", "pong", "live_voting_snapshot"];
 
   self.onRequestError = null;
 